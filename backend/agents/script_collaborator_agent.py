@@ -293,14 +293,14 @@ def get_script_context(params: GetScriptContextParams) -> ScriptContextResponse:
                     response_kwargs["available_categories"] = [{"id": cat_id, "name": cat_name} for cat_id, cat_name in unique_cats.items()]
                     logger.info(f"[get_script_context] Populated available_categories from distinct line categories, found {len(response_kwargs['available_categories'])}.")
 
-        # --- Add detailed logging before returning --- 
-        logger.info(f"[get_script_context] Raw response_kwargs before creating ScriptContextResponse: {response_kwargs}")
         final_response_obj = ScriptContextResponse(**response_kwargs)
-        try:
-            logger.info(f"[get_script_context] Attempting to return ScriptContextResponse (JSON): {final_response_obj.model_dump_json(indent=2)}")
-        except Exception as serialization_exc:
-            logger.error(f"[get_script_context] Error serializing ScriptContextResponse for logging: {serialization_exc}")
-            logger.info(f"[get_script_context] Returning ScriptContextResponse (object form): {final_response_obj}")
+        # Full payload dumps carry every script line; only serialize them when debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            try:
+                logger.debug(f"[get_script_context] Returning ScriptContextResponse (JSON): {final_response_obj.model_dump_json()}")
+            except Exception as serialization_exc:
+                logger.error(f"[get_script_context] Error serializing ScriptContextResponse for logging: {serialization_exc}")
+        logger.info(f"[get_script_context] Returning ScriptContextResponse for script {params.script_id} ({len(final_response_obj.all_script_lines or [])} lines).")
         return final_response_obj
     except Exception as e:
         logger.error(f"[get_script_context] Unhandled error: {e}", exc_info=True)
@@ -310,7 +310,7 @@ def get_script_context(params: GetScriptContextParams) -> ScriptContextResponse:
             error=f"Unhandled error in get_script_context: {str(e)}"
         )
         try:
-            logger.info(f"[get_script_context] Attempting to return ERROR ScriptContextResponse (JSON): {error_response.model_dump_json(indent=2)}")
+            logger.info(f"[get_script_context] Attempting to return ERROR ScriptContextResponse (JSON): {error_response.model_dump_json()}")
         except Exception as serialization_exc_err:
             logger.error(f"[get_script_context] Error serializing ERROR ScriptContextResponse for logging: {serialization_exc_err}")
             logger.info(f"[get_script_context] Returning ERROR ScriptContextResponse (object form): {error_response}")
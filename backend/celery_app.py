@@ -39,6 +39,15 @@ celery = Celery(
     redis_backend_use_ssl=ssl_opts or None, # Use redis_backend_use_ssl for Celery >= 5.2
 )
 
+# Queues: crop work is CPU-bound (ffmpeg) while line regen/STS mostly wait on
+# ElevenLabs, so they get their own queues that can be consumed by separately
+# sized workers. Full generation runs are long and I/O-bound too, but get a queue
+# of their own so they can't hold up short line regens. The default worker
+# command consumes all of them.
+AUDIO_CPU_QUEUE = 'audio_cpu'
+IO_NET_QUEUE = 'io_net'
+GENERATION_IO_QUEUE = 'generation_io'
+
 # Update other Celery configuration settings
 celery.conf.update(
     task_serializer='json',
@@ -49,6 +58,15 @@ celery.conf.update(
     result_expires=86400,  # Keep results for a day (in seconds)
     worker_prefetch_multiplier=1,  # Handle one task at a time to prevent overloading
     task_reject_on_worker_lost=True,  # Reject tasks if worker is lost
+    # Recycle pool processes so RSS left behind by large TTS batches is returned to the OS
+    worker_max_tasks_per_child=int(os.getenv('CELERY_MAX_TASKS_PER_CHILD', '50')),
+    worker_max_memory_per_child=int(os.getenv('CELERY_MAX_MEMORY_PER_CHILD_KB', '400000')),  # KiB
+    task_routes={
+        'tasks.crop_audio_take': {'queue': AUDIO_CPU_QUEUE},
+        'tasks.run_speech_to_speech_line': {'queue': IO_NET_QUEUE},
+        'tasks.regenerate_line_takes': {'queue': IO_NET_QUEUE},
+        'tasks.run_generation': {'queue': GENERATION_IO_QUEUE},
+    },
     timezone='UTC',
     enable_utc=True,
 )
@@ -1,9 +1,11 @@
 # backend/models.py
 from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, JSON, ForeignKey, func, Boolean, Index, UniqueConstraint
-from sqlalchemy import sql
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship, declared_attr, joinedload
+from sqlalchemy import sql, delete, insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base, relationship, declared_attr, joinedload
 from sqlalchemy.dialects import postgresql # Import postgresql dialect
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 
 # Database setup (PostgreSQL or SQLite)
@@ -20,10 +22,20 @@ else:
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
     # Standard engine args for PostgreSQL
-    engine_args = {"pool_pre_ping": True, "pool_size": 10, "max_overflow": 20}
+    engine_args = {"pool_pre_ping": True, "pool_size": 10, "max_overflow": 20, "pool_recycle": 1800}
+    if make_url(DATABASE_URL).get_dialect().driver == "psycopg2":
+        # Batch executemany UPDATEs/INSERTs (bulk line updates, take rows) into a few round trips
+        engine_args.update({
+            "executemany_mode": "values_plus_batch",
+            "executemany_batch_page_size": 500,
+            "insertmanyvalues_page_size": 1000,
+        })
 
 engine = create_engine(DATABASE_URL, **engine_args)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Thread-local session for Celery tasks; call TaskSession.remove() when the task finishes
+# to hand its connection back to the pool and drop the session.
+TaskSession = scoped_session(SessionLocal)
 Base = declarative_base()
 
 class GenerationJob(Base):
@@ -32,7 +44,7 @@ class GenerationJob(Base):
     id = Column(Integer, primary_key=True, index=True)
     celery_task_id = Column(String, index=True, unique=True, nullable=True)
     status = Column(String, default="PENDING", index=True)
-    submitted_at = Column(DateTime, default=datetime.utcnow)
+    submitted_at = Column(DateTime, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None)) # Naive UTC column
     started_at = Column(DateTime, nullable=True)
     completed_at = Column(DateTime, nullable=True)
     # Use JSONB variant for Postgres
@@ -45,6 +57,57 @@ class GenerationJob(Base):
     job_type = Column(String, default="full_batch") # E.g., 'full_batch', 'line_regen', 'sts_line_regen', 'script_creation'
     target_batch_id = Column(String, nullable=True) # For line_regen jobs
     target_line_key = Column(String, nullable=True) # For line_regen jobs
+    processed_count = Column(Integer, nullable=True) # Items saved so far (category generation), for resume
+
+# --- Take Index Model --- #
+# Row-per-take mirror of the takes listed in each batch's R2 metadata. R2 metadata
+# remains the source of truth; tasks insert rows in bulk as takes are generated.
+
+class Take(Base):
+    __tablename__ = "takes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    generation_job_id = Column(Integer, ForeignKey("generation_jobs.id"), nullable=True, index=True)
+    batch_prefix = Column(String, nullable=False, index=True) # skin/voice/batch_id
+    line_key = Column(String(255), nullable=False)
+    take_number = Column(Integer, nullable=False)
+    file = Column(String(255), nullable=False)
+    r2_key = Column(String, nullable=False, index=True)
+    generation_settings = Column(JSON().with_variant(postgresql.JSONB, "postgresql"), nullable=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_takes_batch_prefix_line_key', 'batch_prefix', 'line_key'),
+    )
+
+def record_takes(db, generation_job_id, batch_prefix: str, takes_meta: list, deleted_r2_keys: list = ()) -> None:
+    """Mirrors a batch's take changes (R2 metadata take dicts) into the takes table.
+
+    New takes go in with one multi-row INSERT (executemany) instead of an ORM
+    add per take. Runs in a savepoint and only logs on error, since R2 metadata
+    is still the source of truth. The caller commits.
+    """
+    if not takes_meta and not deleted_r2_keys:
+        return
+    try:
+        with db.begin_nested():
+            if deleted_r2_keys:
+                db.execute(delete(Take).where(Take.r2_key.in_(deleted_r2_keys)))
+            if takes_meta:
+                db.execute(insert(Take), [
+                    {
+                        'generation_job_id': generation_job_id,
+                        'batch_prefix': batch_prefix,
+                        'line_key': t['line'],
+                        'take_number': t['take_number'],
+                        'file': t['file'],
+                        'r2_key': t['r2_key'],
+                        'generation_settings': t.get('generation_settings'),
+                    }
+                    for t in takes_meta
+                ])
+    except SQLAlchemyError as e:
+        print(f"[DB ID: {generation_job_id}] Warning: Could not record takes for {batch_prefix} in DB: {e}")
 
 # --- NEW: Script Management Models --- #
 
@@ -10,13 +10,19 @@ from backend.utils.response_utils import make_api_response
 from backend.tasks import regenerate_line_takes, run_speech_to_speech_line
 import logging
 import json
+import orjson
 from datetime import datetime, timezone
 import io
+import base64
+import uuid
 import zipfile
 from urllib.parse import unquote_plus # Use unquote_plus for path decoding
 
 batch_bp = Blueprint('batch', __name__, url_prefix='/api')
 
+# Scratch location for STS source audio; run_speech_to_speech_line deletes its blob when done
+STS_SOURCE_PREFIX = "sts-sources/"
+
 @batch_bp.route('/batches', methods=['GET'])
 def list_batches():
     """Lists available batches by querying successful jobs from the database."""
@@ -94,11 +100,13 @@ def get_batch_metadata(batch_prefix):
             logging.warning(f"Metadata blob not found for prefix '{batch_prefix}'") # Use logging
             return make_api_response(error=f"Metadata not found for batch prefix '{batch_prefix}'", status_code=404)
 
-        # Decode and parse JSON
+        # Decode (zstd or plain) and parse JSON
         try:
-            metadata = json.loads(metadata_bytes.decode('utf-8'))
+            metadata = utils_r2.loads_json_blob(metadata_bytes)
+            # Overlay per-line shards written by STS that haven't been compacted yet
+            utils_r2.merge_line_meta_shards(batch_prefix, metadata)
             return make_api_response(data=metadata)
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        except ValueError as e:
             logging.error(f"Failed to parse metadata JSON for {metadata_blob_key}: {e}")
             return make_api_response(error="Failed to parse batch metadata", status_code=500)
 
@@ -131,44 +139,40 @@ def update_take_rank(batch_prefix, filename):
     logging.info(f"Updating rank for take '{filename}' in prefix '{batch_prefix}'. New rank: {new_rank}") # Use logging
 
     try:
-        # 1. Download current metadata
-        logging.info(f"Downloading metadata: {metadata_blob_key}") # Use logging
-        metadata_bytes = utils_r2.download_blob_to_memory(metadata_blob_key)
-        if not metadata_bytes:
-            return make_api_response(error=f"Metadata not found for batch '{batch_prefix}'", status_code=404)
-        try:
-            metadata = json.loads(metadata_bytes.decode('utf-8'))
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
-             logging.error(f"Failed to parse metadata JSON for {metadata_blob_key}: {e}")
-             return make_api_response(error="Failed to parse batch metadata for update", status_code=500)
-
-        # 2. Find and update the take
-        take_updated = False
+        metadata_found = False
+        merged_shard_keys = {}
         updated_take_info = None
-        for take in metadata.get('takes', []):
-             if take.get('file') == filename:
-                 take['rank'] = new_rank
-                 take['ranked_at'] = datetime.now(timezone.utc).isoformat() if new_rank is not None else None
-                 take_updated = True
-                 updated_take_info = take
-                 logging.info(f"Found and updated take metadata for {filename}") # Use logging
-                 break
-
-        if not take_updated:
-            return make_api_response(error=f"Take '{filename}' not found in batch '{batch_prefix}'", status_code=404)
 
-        # 3. Upload the modified metadata (overwrite)
-        logging.info(f"Uploading updated metadata: {metadata_blob_key}") # Use logging
-        updated_metadata_bytes = json.dumps(metadata, indent=2).encode('utf-8')
-        upload_success = utils_r2.upload_blob(
-            blob_name=metadata_blob_key,
-            data=updated_metadata_bytes,
-            content_type='application/json'
-        )
-
-        if not upload_success:
+        def apply_rank(metadata):
+            # Re-run on every conditional-PUT retry, against the freshly read metadata
+            nonlocal metadata_found, merged_shard_keys, updated_take_info
+            metadata_found = True
+            # Fold in any per-line shards; the full rewrite supersedes them
+            merged_shard_keys = utils_r2.merge_line_meta_shards(batch_prefix, metadata)
+            updated_take_info = None
+            for take in metadata.get('takes', []):
+                if take.get('file') == filename:
+                    take['rank'] = new_rank
+                    take['ranked_at'] = datetime.now(timezone.utc).isoformat() if new_rank is not None else None
+                    updated_take_info = take
+                    logging.info(f"Found and updated take metadata for {filename}") # Use logging
+                    return True
+            return False
+
+        # 1-3. Download, update the take and upload with a conditional PUT, so a concurrent
+        # rank update or shard compaction on the same batch isn't silently overwritten
+        logging.info(f"Updating metadata: {metadata_blob_key}") # Use logging
+        written = utils_r2.update_json_blob(metadata_blob_key, apply_rank)
+
+        if not metadata_found:
+            return make_api_response(error=f"Metadata not found for batch '{batch_prefix}'", status_code=404)
+        if updated_take_info is None:
+            return make_api_response(error=f"Take '{filename}' not found in batch '{batch_prefix}'", status_code=404)
+        if written is None:
              logging.error(f"Failed to upload updated metadata for {metadata_blob_key}")
              return make_api_response(error="Failed to save updated rank to storage", status_code=500)
+        # Shards rewritten since they were merged stay for the next compaction
+        utils_r2.delete_blobs_if_unchanged(merged_shard_keys)
 
         logging.info(f"Successfully updated rank for {filename} in {batch_prefix}") # Use logging
         return make_api_response(data={
@@ -263,17 +267,25 @@ def start_speech_to_speech_line(batch_prefix):
         return make_api_response(error='Invalid audio data URI', status_code=400)
     if not isinstance(num_new_takes, int) or num_new_takes <= 0: 
         return make_api_response(error='Invalid num_new_takes', status_code=400)
-    try: header, encoded = source_audio_b64.split(';base64,', 1)
-    except: return make_api_response(error='Failed to decode source audio data', status_code=400)
+    try:
+        header, encoded = source_audio_b64.split(';base64,', 1)
+        source_audio_bytes = base64.b64decode(encoded)
+    except Exception: return make_api_response(error='Failed to decode source audio data', status_code=400)
 
     db: Session = next(models.get_db())
     db_job = None
+    source_audio_r2_key = None
+    task = None
     try:
         # Check if target batch metadata exists in R2
         metadata_blob_key = f"{batch_prefix}/metadata.json"
         if not utils_r2.blob_exists(metadata_blob_key):
              return make_api_response(error=f"Target batch prefix '{batch_prefix}' not found for STS", status_code=404)
 
+        source_audio_r2_key = f"{STS_SOURCE_PREFIX}{uuid.uuid4().hex}"
+        if not utils_r2.upload_blob(source_audio_r2_key, source_audio_bytes, content_type=header[len('data:'):]):
+            return make_api_response(error="Failed to store source audio for STS", status_code=500)
+
         # Create Job DB record
         db_job = models.GenerationJob(
             status="PENDING", job_type="sts_line_regen",
@@ -285,10 +297,11 @@ def start_speech_to_speech_line(batch_prefix):
         db_job_id = db_job.id
         logging.info(f"Created STS Line Job DB ID: {db_job_id} for prefix {batch_prefix}") # Use logging
 
-        # Enqueue Celery task, passing BATCH PREFIX and base64 string
+        # Enqueue Celery task, passing BATCH PREFIX and the source audio's scratch key
         task = run_speech_to_speech_line.delay(
-            db_job_id, batch_prefix, line_key, source_audio_b64, # Pass prefix
-            num_new_takes, target_voice_id, model_id, settings_json, replace_existing
+            db_job_id, batch_prefix, line_key, source_audio_r2_key, # Pass prefix
+            num_new_takes, target_voice_id, model_id, settings_json, replace_existing,
+            source_audio_info=header
         )
         logging.info(f"Enqueued STS line task: Celery ID {task.id}, DB Job ID {db_job_id}") # Use logging
         db_job.celery_task_id = task.id; db.commit()
@@ -298,6 +311,8 @@ def start_speech_to_speech_line(batch_prefix):
         if db_job and db_job.id: # Mark job as failed
             try: db_job.status = "SUBMIT_FAILED"; db_job.result_message = f"Enqueue failed: {e}"; db.commit()
             except: db.rollback()
+        if source_audio_r2_key and task is None: # No task will ever clean up the scratch upload
+            utils_r2.delete_blob(source_audio_r2_key)
         return make_api_response(error="Failed to start speech-to-speech task", status_code=500)
     finally: db.close()
 
@@ -337,7 +352,7 @@ def crop_take(batch_prefix, filename):
     try:
         metadata_bytes = utils_r2.download_blob_to_memory(metadata_blob_key)
         if metadata_bytes:
-            metadata = json.loads(metadata_bytes.decode('utf-8'))
+            metadata = utils_r2.loads_json_blob(metadata_bytes)
             if metadata.get('ranked_at_utc') is not None:
                 logging.warning(f"Attempted to crop take in locked batch: {batch_prefix}")
                 return make_api_response(error="Cannot crop takes in a locked batch.", status_code=403) # 403 Forbidden
@@ -384,10 +399,13 @@ def download_batch_zip(batch_prefix):
             logging.warning(f"Metadata blob not found: {metadata_blob_key}")
             return make_api_response(error=f"Batch prefix '{batch_prefix}' metadata not found.", status_code=404)
         try:
-            metadata = json.loads(metadata_bytes.decode('utf-8'))
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            metadata = utils_r2.loads_json_blob(metadata_bytes)
+        except ValueError as e:
             logging.error(f"Failed to parse metadata JSON for zip: {metadata_blob_key}: {e}")
             return make_api_response(error="Failed to parse batch metadata for zip.", status_code=500)
+        utils_r2.merge_line_meta_shards(batch_prefix, metadata)
+        # The stored blob may be compressed; the zip always gets a readable, indented copy
+        metadata_bytes = orjson.dumps(metadata, option=orjson.OPT_INDENT_2)
 
         with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
             # 2. Add metadata.json to zip
@@ -4,8 +4,6 @@ from flask import Blueprint, request, jsonify
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import func
 import logging
-import csv
-import io
 
 # Assuming models and helpers are accessible, adjust imports as necessary
 from backend import models
@@ -6,6 +6,12 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.attributes import flag_modified # Import flag_modified
 import logging
 import json # Added import
+import hashlib
+import asyncio
+import uuid
+import time
+import openai
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 import os
 from datetime import datetime, timezone # Import datetime utils
 import io # For in-memory file handling
@@ -23,6 +29,7 @@ from backend.models import get_db
 from backend.utils.response_utils import make_api_response, model_to_dict # NEW imports
 from backend import utils_openai # Import for direct OpenAI calls
 from backend import utils_voscript # Import for DB utils
+from backend import utils_redis # Shared Redis client for the batch response cache
 from backend.utils_prompts import _get_elevenlabs_rules # NEW IMPORT
 from backend.tasks.script_tasks import run_script_collaborator_chat_task # Import the Celery task
 
@@ -1556,6 +1563,32 @@ def accept_vo_script_line(script_id: int, line_id: int):
             db.close()
 
 # --- NEW: Batch Category Generation Endpoint --- #
+# Categories with more pending lines than this are split into sub-batches of SMALL_BATCH_SIZE
+SPLIT_BATCH_THRESHOLD = 10
+SMALL_BATCH_SIZE = 8
+# Upper bound on nearby-line text sent as context with each batch (~4k tokens)
+CONTEXT_MAX_CHARS = 16000
+# Opt-in Redis cache of batch responses. Off by default: the prompt samples at temperature
+# 0.8, so a user re-running a category expects fresh lines rather than the last answer.
+# In-flight sharing rides on the same cache and is off with it.
+LINES_BATCH_CACHE_ENABLED = os.getenv('LINES_BATCH_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Identical batch prompts (re-runs, retries) are answered from Redis for this long
+LINES_BATCH_CACHE_TTL_SECONDS = int(os.getenv('LINES_BATCH_CACHE_TTL_SECONDS', '86400'))
+# A request identical to one already in flight waits up to ~60s for that answer instead of
+# paying for its own; the claim expires on its own if the first worker dies. Web requests
+# only wait a few seconds so a Flask thread isn't parked on another worker's call.
+LINES_INFLIGHT_CLAIM_TTL_SECONDS = 120
+LINES_INFLIGHT_POLL_SECONDS = 0.5
+LINES_INFLIGHT_WAIT_POLLS = 120
+LINES_INFLIGHT_WEB_WAIT_POLLS = 6
+# Deletes the in-flight claim only if it still holds this caller's token
+_RELEASE_CLAIM_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
 @vo_script_bp.route('/vo-scripts/<int:script_id>/categories/<category_name>/generate-batch', methods=['POST'])
 def generate_category_lines_batch(script_id: int, category_name: str):
     """Generates text for all pending lines in a category together, ensuring variety.
@@ -1607,32 +1640,30 @@ def generate_category_lines_batch(script_id: int, category_name: str):
             
         logging.info(f"Found {len(pending_lines)} pending lines to generate for category '{category_name}' in script {script_id}.")
 
-        # 2. Find any existing generated lines in the same category (for context and variety)
-        existing_lines = [line for line in lines_to_process if line.get('status') not in ['pending', None] and 
-                           line.get('current_text') and
-                           line.get('line_id') not in [pl.get('line_id') for pl in pending_lines]]
+        # 2. Context (nearby lines) is fetched per batch inside _generate_lines_batch
         
         # 3. If we have 10 or fewer pending lines, use batch generation approach
-        if len(pending_lines) <= 10:
+        batches = _split_line_batches(pending_lines)
+        if len(batches) == 1:
             # APPROACH 1: Batch Generation (Ideal for smaller batches)
-            updated_lines_data = _generate_lines_batch(db, script_id, pending_lines, existing_lines, target_model)
+            updated_lines_data = _generate_lines_batch(db, script_id, pending_lines, target_model,
+                                                       inflight_wait_polls=LINES_INFLIGHT_WEB_WAIT_POLLS)
         else:
             # APPROACH 2: Split into smaller batches (For larger sets)
             logging.info(f"Large batch of {len(pending_lines)} lines detected. Splitting into smaller batches.")
             
-            # Process in batches of 8 lines
-            batch_size = 8
-            for i in range(0, len(pending_lines), batch_size):
-                batch = pending_lines[i:i+batch_size]
-                batch_existing = existing_lines + updated_lines_data  # Include already generated lines as context
-                
-                logging.info(f"Processing batch {i//batch_size + 1} with {len(batch)} lines")
-                batch_results = _generate_lines_batch(db, script_id, batch, batch_existing, target_model)
-                
-                if batch_results:
+            # Process in batches of 8 lines. Each batch fetches its own nearby-line
+            # context, so they're independent and can all be in flight at once.
+            logging.info(f"Dispatching {len(batches)} batches concurrently")
+            batch_results_list = asyncio.run(_generate_line_batches_concurrently(
+                db, script_id, batches, target_model, inflight_wait_polls=LINES_INFLIGHT_WEB_WAIT_POLLS))
+
+            for batch_num, batch_results in enumerate(batch_results_list, start=1):
+                if isinstance(batch_results, Exception):
+                    logging.error(f"Batch {batch_num} failed: {batch_results}")
+                    errors_occurred = True
+                elif batch_results:
                     updated_lines_data.extend(batch_results)
-                    # Update existing_lines for next iteration
-                    existing_lines = [line for line in existing_lines if line.get('line_id') not in [l.get('id') for l in batch_results]]
                 else:
                     errors_occurred = True
                 
@@ -1666,9 +1697,17 @@ def generate_category_lines_batch(script_id: int, category_name: str):
             db.close()
 
 # --- Helper for Batch Generation --- #
+def _split_line_batches(lines: list) -> list[list]:
+    """Returns lines as one batch, or as SMALL_BATCH_SIZE slices when there are more than
+    SPLIT_BATCH_THRESHOLD of them. The split decision lives here so the route and the
+    Celery task always agree on it."""
+    if len(lines) <= SPLIT_BATCH_THRESHOLD:
+        return [lines]
+    return [lines[i:i + SMALL_BATCH_SIZE] for i in range(0, len(lines), SMALL_BATCH_SIZE)]
+
 # @limits.limit("10 per minute") # Rate limit if needed
-# @retry(stop=stop_after_attempt(3), wait=wait_fixed(2)) # Retry logic if needed
-def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, existing_lines: list | None, target_model: str) -> list:
+def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, target_model: str, prompt_prefix: str | None = None,
+                          inflight_wait_polls: int = LINES_INFLIGHT_WAIT_POLLS) -> list:
     """Helper function to generate multiple lines in a batch with variety.
        Fetches its own limited context based on order_index of pending_lines.
 
@@ -1676,15 +1715,114 @@ def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, exis
         db: Database session.
         script_id: Parent VO Script ID.
         pending_lines: List of line context dicts for lines needing generation in this batch.
-        existing_lines: (No longer used effectively - kept for signature compatibility but ignored)
         target_model: OpenAI model name.
+        prompt_prefix: Shared prompt prefix from _build_batch_prompt_prefix; built here if None.
+        inflight_wait_polls: Polls (LINES_INFLIGHT_POLL_SECONDS apart) to wait for an identical
+            in-flight request's answer before making our own call.
 
     Returns:
         List of updated line context dicts with 'generated_text'.
     """
-    logging.info(f"_generate_lines_batch called for script {script_id} with {len(pending_lines)} pending lines. Model: {target_model}")
+    updated_lines, pending_lines, full_prompt, target_model = _prepare_lines_batch(db, script_id, pending_lines, target_model, prompt_prefix)
+    if full_prompt is None:
+        return updated_lines
+
+    try:
+        logging.info(f"Sending batch generation request to OpenAI model {target_model} for {len(pending_lines)} lines.")
+        
+        # Log the pending lines and their keys for debugging
+        logging.info(f"Pending lines data: {[{'id': l.get('id', l.get('line_id')), 'line_key': l.get('line_key')} for l in pending_lines]}")
+        
+        request_kwargs = _lines_batch_request(target_model, full_prompt)
+        cache_key = _lines_batch_cache_key(request_kwargs)
+        generated_json_str, claim_token, in_flight_elsewhere = _lookup_or_claim_lines_request(cache_key)
+        if in_flight_elsewhere:
+            # An identical request is already in flight elsewhere; reuse its answer
+            for _ in range(inflight_wait_polls):
+                time.sleep(LINES_INFLIGHT_POLL_SECONDS)
+                generated_json_str = _get_cached_lines_response(cache_key)
+                if generated_json_str is not None:
+                    break
+        if generated_json_str is None:
+            try:
+                generated_json_str = _record_lines_response(cache_key, _create_lines_batch_completion(request_kwargs))
+            finally:
+                _release_lines_request(cache_key, claim_token)
+    except Exception as e:
+        logging.exception(f"Error during OpenAI call in _generate_lines_batch: {e}")
+        # Re-raise to be caught by the task
+        raise Exception(f"OpenAI API call failed: {e}") from e
+
+    return _parse_lines_batch_response(generated_json_str, pending_lines, updated_lines)
+
+async def _generate_lines_batch_async(db: Session, script_id: int, pending_lines: list, target_model: str, async_client: openai.AsyncOpenAI, prompt_prefix: str | None = None,
+                                      inflight_wait_polls: int = LINES_INFLIGHT_WAIT_POLLS) -> list:
+    """Async variant of _generate_lines_batch, awaiting the OpenAI call on an AsyncOpenAI client
+    so independent sub-batches can be in flight at the same time."""
+    updated_lines, pending_lines, full_prompt, target_model = _prepare_lines_batch(db, script_id, pending_lines, target_model, prompt_prefix)
+    if full_prompt is None:
+        return updated_lines
+
+    try:
+        logging.info(f"Sending async batch generation request to OpenAI model {target_model} for {len(pending_lines)} lines.")
+        request_kwargs = _lines_batch_request(target_model, full_prompt)
+        cache_key = _lines_batch_cache_key(request_kwargs)
+        generated_json_str, claim_token, in_flight_elsewhere = _lookup_or_claim_lines_request(cache_key)
+        if in_flight_elsewhere:
+            # An identical request is already in flight elsewhere; reuse its answer
+            for _ in range(inflight_wait_polls):
+                await asyncio.sleep(LINES_INFLIGHT_POLL_SECONDS)
+                generated_json_str = _get_cached_lines_response(cache_key)
+                if generated_json_str is not None:
+                    break
+        if generated_json_str is None:
+            try:
+                generated_json_str = _record_lines_response(cache_key, await _create_lines_batch_completion_async(async_client, request_kwargs))
+            finally:
+                _release_lines_request(cache_key, claim_token)
+    except Exception as e:
+        logging.exception(f"Error during OpenAI call in _generate_lines_batch_async: {e}")
+        raise Exception(f"OpenAI API call failed: {e}") from e
+
+    return _parse_lines_batch_response(generated_json_str, pending_lines, updated_lines)
+
+async def _generate_line_batches_concurrently(db: Session, script_id: int, batches: list[list], target_model: str,
+                                              inflight_wait_polls: int = LINES_INFLIGHT_WAIT_POLLS) -> list:
+    """Dispatches all sub-batches at once with asyncio.gather.
+
+    Args:
+        db: Database session (only used synchronously while each batch's prompt is built).
+        script_id: Parent VO Script ID.
+        batches: Lists of line context dicts, one list per sub-batch.
+        target_model: OpenAI model name.
+        inflight_wait_polls: Passed to each sub-batch (see _generate_lines_batch).
+
+    Returns:
+        One entry per sub-batch, in order: its list of {'line_id', 'generated_text'}
+        results, or the exception it raised.
+    """
+    # The shared prefix is identical for every sub-batch, so build it once up front
+    prompt_prefix = _build_batch_prompt_prefix(db, batches[0][0]) if batches and batches[0] else None
+    # A fresh async client per event loop; its connection pool can't outlive asyncio.run()
+    async with openai.AsyncOpenAI() as async_client:
+        return await asyncio.gather(
+            *(_generate_lines_batch_async(db, script_id, batch, target_model, async_client, prompt_prefix, inflight_wait_polls)
+              for batch in batches),
+            return_exceptions=True
+        )
+
+def _prepare_lines_batch(db: Session, script_id: int, pending_lines: list, target_model: str, prompt_prefix: str | None = None) -> tuple[list, list, str | None, str]:
+    """Builds the batch prompt for _generate_lines_batch and its async variant.
+    prompt_prefix is built from the first pending line when not supplied.
+
+    Returns:
+        (updated_lines, pending_lines, full_prompt, target_model) where updated_lines holds
+        lines passed through unchanged, pending_lines only the lines that still need
+        generating, and full_prompt is None when there is nothing to request.
+    """
+    logging.info(f"Preparing line batch for script {script_id} with {len(pending_lines)} pending lines. Model: {target_model}")
     if not pending_lines:
-        return []
+        return [], [], None, target_model
 
     # Ensure we have a valid model - use default if none provided
     if not target_model:
@@ -1713,39 +1851,14 @@ def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, exis
     # If all lines already have text, return what we have
     if not lines_to_generate:
         logging.info(f"All lines in batch already have text, skipping batch generation")
-        return updated_lines
+        return updated_lines, pending_lines, None, target_model
         
     # Continue with generation for remaining lines
     pending_lines = lines_to_generate # Overwrite with only the lines needing generation
     
-    # 1. Get common context from first line (should be same for all lines in category)
     first_pending_line = pending_lines[0]
-    char_desc = first_pending_line.get('character_description', 'N/A')
-    template_hint = first_pending_line.get('template_hint', 'N/A')
-    category_name = first_pending_line.get('category_name', 'N/A')
-    first_line_id = first_pending_line.get('line_id') # Needed for category instruction lookup
-    
-    # --- Fetch category instructions --- 
-    category_instructions = "N/A" # Default
-    parent_script_template_id = None
-    # Get template ID from the script associated with the first line
-    if first_line_id:
-         first_line_obj = db.query(models.VoScriptLine).options(joinedload(models.VoScriptLine.vo_script)).get(first_line_id)
-         if first_line_obj and first_line_obj.vo_script:
-             parent_script_template_id = first_line_obj.vo_script.template_id
-    
-    if parent_script_template_id and category_name != "Uncategorized":
-         category = db.query(models.VoScriptTemplateCategory).filter(
-             models.VoScriptTemplateCategory.template_id == parent_script_template_id,
-             models.VoScriptTemplateCategory.name == category_name
-         ).first()
-         if category and category.prompt_instructions:
-             category_instructions = category.prompt_instructions
-             logging.info(f"Using category instructions for '{category_name}' from DB.")
-         else:
-             logging.warning(f"Could not find category instructions for '{category_name}' in DB, using default.")
-    else:
-         logging.warning(f"Could not determine template ID or category name ('{category_name}') to fetch instructions, using default.")
+    if prompt_prefix is None:
+        prompt_prefix = _build_batch_prompt_prefix(db, first_pending_line)
 
     # --- NEW: Fetch Limited Context (Nearby Lines) ---
     context_lines = []
@@ -1797,10 +1910,7 @@ def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, exis
                 context_lines_db = preceding_lines_q.all() + succeeding_lines_q.all()
                 
                 # Convert to dictionary format expected by prompt builder
-                context_lines = [
-                    {'line_key': l.line_key, 'current_text': l.generated_text} 
-                    for l in context_lines_db if l.generated_text # Ensure text exists
-                ]
+                context_lines = _select_context_lines(context_lines_db, min_order, max_order)
                 logging.info(f"Fetched {len(context_lines)} nearby lines for context.")
             else:
                  logging.warning(f"Could not determine category_id for context fetching.")
@@ -1810,14 +1920,8 @@ def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, exis
         logging.error(f"Error fetching context lines: {context_exc}")
     # --- END NEW CONTEXT FETCH ---
 
-    # 2. Build the batch prompt
-    prompt_parts = [
-        f"You are a creative writer for video game voiceovers.",
-        f"Character Description:\\n{char_desc}\\n",
-        f"Template Hint: {template_hint}",
-        f"Category: {category_name}",
-        f"Category Instructions: {category_instructions}\\n"
-    ]
+    # 2. Build the batch prompt on top of the shared prefix; the per-batch nearby lines and line keys go last.
+    prompt_parts = [prompt_prefix]
     
     # Add existing lines for context (use the limited context_lines now)
     if context_lines:
@@ -1828,18 +1932,9 @@ def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, exis
             text = line.get('current_text', '')
             if key and text: # Ensure both key and text exist
                 prompt_parts.append(f'- {key}: "{text}"') # Use single quotes for f-string
-    
-    # Add variety requirements
-    prompt_parts.append("\n--- IMPORTANT: VARIETY REQUIREMENTS ---")
-    prompt_parts.append("Your task is to write NEW, VARIED lines that are DISTINCTLY DIFFERENT from each other and from the nearby context lines.")
-    prompt_parts.append("Requirements:")
-    prompt_parts.append("- Ensure each generated line is unique.")
-    prompt_parts.append("- Avoid repetition in phrasing, sentence structure, and core ideas compared to context lines AND other lines in this batch.")
-    prompt_parts.append("- Maintain the character's voice and tone.")
-    prompt_parts.append("- Fulfill the specific request/hint for each line key.")
 
     prompt_parts.append("\n--- Lines to Generate (Provide JSON output) ---")
-    prompt_parts.append("Generate text for the following line keys. Provide ONLY a valid JSON object where keys are the line keys and values are the generated text strings:")
+    prompt_parts.append("Generate text for the following line keys. Return one entry in \"lines\" per line key, with the key in \"line_key\" and the generated text in \"text\":")
 
     # Add lines to be generated with their hints
     lines_to_request_json = {}
@@ -1856,28 +1951,244 @@ def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, exis
     full_prompt = "\n".join(prompt_parts)
     # logging.debug(f"Full Batch Prompt:\n{full_prompt}") # DEBUG: Careful logging large prompts
 
+    return updated_lines, pending_lines, full_prompt, target_model
+
+def _build_batch_prompt_prefix(db: Session, first_pending_line: dict) -> str:
+    """Builds the part of the batch prompt shared by every sub-batch of a category.
+
+    Callers splitting a category should build this once and pass it to each batch,
+    which saves the per-batch script/category lookups and string building.
+    """
+    # 1. Get common context from first line (should be same for all lines in category)
+    char_desc = first_pending_line.get('character_description', 'N/A')
+    template_hint = first_pending_line.get('template_hint', 'N/A')
+    category_name = first_pending_line.get('category_name', 'N/A')
+    first_line_id = first_pending_line.get('line_id') # Needed for category instruction lookup
+    
+    # --- Fetch category instructions --- 
+    category_instructions = "N/A" # Default
+    parent_script_template_id = None
+    # Get template ID from the script associated with the first line
+    if first_line_id:
+         first_line_obj = db.query(models.VoScriptLine).options(joinedload(models.VoScriptLine.vo_script)).get(first_line_id)
+         if first_line_obj and first_line_obj.vo_script:
+             parent_script_template_id = first_line_obj.vo_script.template_id
+    
+    if parent_script_template_id and category_name != "Uncategorized":
+         category = db.query(models.VoScriptTemplateCategory).filter(
+             models.VoScriptTemplateCategory.template_id == parent_script_template_id,
+             models.VoScriptTemplateCategory.name == category_name
+         ).first()
+         if category and category.prompt_instructions:
+             category_instructions = category.prompt_instructions
+             logging.info(f"Using category instructions for '{category_name}' from DB.")
+         else:
+             logging.warning(f"Could not find category instructions for '{category_name}' in DB, using default.")
+    else:
+         logging.warning(f"Could not determine template ID or category name ('{category_name}') to fetch instructions, using default.")
+
+    # 2. Everything shared by sibling sub-batches of a category (persona, instructions,
+    # variety rules) goes first, verbatim, so OpenAI's automatic prefix cache can reuse it.
+    prompt_parts = [
+        f"You are a creative writer for video game voiceovers.",
+        f"Character Description:\\n{char_desc}\\n",
+        f"Template Hint: {template_hint}",
+        f"Category: {category_name}",
+        f"Category Instructions: {category_instructions}\\n"
+    ]
+    
+    # Add variety requirements
+    prompt_parts.append("\n--- IMPORTANT: VARIETY REQUIREMENTS ---")
+    prompt_parts.append("Your task is to write NEW, VARIED lines that are DISTINCTLY DIFFERENT from each other and from the nearby context lines.")
+    prompt_parts.append("Requirements:")
+    prompt_parts.append("- Ensure each generated line is unique.")
+    prompt_parts.append("- Avoid repetition in phrasing, sentence structure, and core ideas compared to context lines AND other lines in this batch.")
+    prompt_parts.append("- Maintain the character's voice and tone.")
+    prompt_parts.append("- Fulfill the specific request/hint for each line key.")
+
+    return "\n".join(prompt_parts)
+
+def _select_context_lines(context_lines_db: list, min_order: int, max_order: int, max_chars: int = CONTEXT_MAX_CHARS) -> list:
+    """Keeps the nearby lines closest to the batch (by order_index) until max_chars of text
+    is used, so a handful of very long lines can't blow up every sub-batch prompt.
+
+    Returns:
+        {'line_key', 'current_text'} dicts in script order.
+    """
+    def distance(l):
+        if l.order_index is None:
+            return float('inf')
+        return min_order - l.order_index if l.order_index < min_order else l.order_index - max_order
+
+    selected = []
+    used_chars = 0
+    for l in sorted((l for l in context_lines_db if l.generated_text), key=distance):
+        if used_chars + len(l.generated_text) > max_chars:
+            continue
+        used_chars += len(l.generated_text)
+        selected.append(l)
+
+    selected.sort(key=lambda l: (l.order_index is None, l.order_index or 0))
+    return [{'line_key': l.line_key, 'current_text': l.generated_text} for l in selected]
+
+# Structured output for batch generation: every requested line comes back as one
+# {"line_key", "text"} entry of a single response, enforced by the API.
+LINES_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "generated_lines",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "lines": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "line_key": {"type": "string"},
+                            "text": {"type": "string"}
+                        },
+                        "required": ["line_key", "text"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["lines"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def _lines_batch_request(target_model: str, full_prompt: str) -> dict:
+    """Chat completion arguments shared by the sync and async batch calls."""
+    return dict(
+        model=target_model,
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant providing JSON output."},
+            {"role": "user", "content": full_prompt}
+        ],
+        response_format=LINES_BATCH_RESPONSE_FORMAT,
+        temperature=0.8, # Increase variety slightly?
+        # max_tokens=?? # Set appropriate limit if needed
+    )
+
+# Transient OpenAI failures (429/5xx/connection) are retried per batch with jittered
+# exponential backoff, so one rate-limited sub-batch doesn't fail the whole category.
+_lines_batch_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(min=1, max=30),
+    retry=retry_if_exception(utils_openai.is_retryable_error),
+    reraise=True
+)
+
+@_lines_batch_retry
+def _create_lines_batch_completion(request_kwargs: dict):
+    return utils_openai.client.chat.completions.create(**request_kwargs)
+
+@_lines_batch_retry
+async def _create_lines_batch_completion_async(async_client: openai.AsyncOpenAI, request_kwargs: dict):
+    return await async_client.chat.completions.create(**request_kwargs)
+
+def _log_prompt_cache_usage(response) -> None:
+    """Logs how much of the prompt OpenAI served from its prefix cache."""
+    usage = getattr(response, 'usage', None)
+    details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+    cached_tokens = getattr(details, 'cached_tokens', None) if details else None
+    if usage and cached_tokens is not None:
+        logging.info(f"Prompt tokens: {usage.prompt_tokens} ({cached_tokens} served from prompt cache)")
+
+def _lines_batch_cache_key(request_kwargs: dict) -> str:
+    """Redis key for a batch request. The prompt already embeds the model's context lines
+    and the pending line keys/hints, so hashing the full request covers all of them."""
+    digest = hashlib.sha256(json.dumps(request_kwargs, sort_keys=True).encode()).hexdigest()
+    return f"llm:lines_batch:{digest}"
+
+def _get_cached_lines_response(cache_key: str) -> str | None:
+    """Returns a cached response body, or None on a miss or if Redis is unavailable."""
+    redis_client = utils_redis.get_redis_client()
+    if redis_client is None:
+        return None
+    try:
+        cached = redis_client.get(cache_key)
+    except Exception as e:
+        logging.warning(f"Batch response cache lookup failed for {cache_key}: {e}")
+        return None
+    if cached is None:
+        return None
+    logging.info(f"Batch response cache hit for {cache_key}; skipping OpenAI call.")
+    return cached.decode('utf-8')
+
+def _cache_lines_response(cache_key: str, generated_json_str: str) -> None:
+    """Stores a response body for LINES_BATCH_CACHE_TTL_SECONDS when LINES_BATCH_CACHE_ENABLED.
+    Failures are logged and ignored."""
+    if not generated_json_str or not LINES_BATCH_CACHE_ENABLED:
+        return
+    redis_client = utils_redis.get_redis_client()
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(cache_key, LINES_BATCH_CACHE_TTL_SECONDS, generated_json_str)
+    except Exception as e:
+        logging.warning(f"Failed to cache batch response under {cache_key}: {e}")
+
+def _lookup_or_claim_lines_request(cache_key: str) -> tuple[str | None, str | None, bool]:
+    """Checks the response cache, then claims the request if nobody answered it yet.
+
+    Returns:
+        (cached response, claim token, in flight elsewhere). On a hit only the response is
+        set. Otherwise the caller either holds the claim (and must pass the token to
+        _release_lines_request) or another caller does, and its answer should be polled for.
+        With LINES_BATCH_CACHE_ENABLED off nothing is looked up or claimed.
+    """
+    if not LINES_BATCH_CACHE_ENABLED:
+        return None, None, False
+    generated_json_str = _get_cached_lines_response(cache_key)
+    if generated_json_str is not None:
+        return generated_json_str, None, False
+    claim_token = _claim_lines_request(cache_key)
+    return None, claim_token, claim_token is None
+
+def _record_lines_response(cache_key: str, response) -> str:
+    """Returns the completion's JSON body after logging its prompt cache usage and caching it."""
+    generated_json_str = response.choices[0].message.content
+    logging.info(f"Received response from OpenAI.")
+    _log_prompt_cache_usage(response)
+    _cache_lines_response(cache_key, generated_json_str)
+    return generated_json_str
+
+def _claim_lines_request(cache_key: str) -> str | None:
+    """Marks a batch request as in flight under a per-caller token and returns the token.
+    Returns None only if another worker already holds the claim; without Redis every
+    caller just makes its own request."""
+    token = uuid.uuid4().hex
+    redis_client = utils_redis.get_redis_client()
+    if redis_client is None:
+        return token
+    try:
+        claimed = redis_client.set(f"{cache_key}:inflight", token, nx=True, ex=LINES_INFLIGHT_CLAIM_TTL_SECONDS)
+        return token if claimed else None
+    except Exception as e:
+        logging.warning(f"Failed to claim in-flight batch request {cache_key}: {e}")
+        return token
+
+def _release_lines_request(cache_key: str, token: str | None) -> None:
+    """Drops the in-flight claim if it is still ours (it may have expired and been re-claimed).
+    Without a token (a cache hit, or a caller that gave up waiting) there is nothing to release."""
+    redis_client = utils_redis.get_redis_client()
+    if not token or redis_client is None:
+        return
+    try:
+        redis_client.eval(_RELEASE_CLAIM_SCRIPT, 1, f"{cache_key}:inflight", token)
+    except Exception as e:
+        logging.warning(f"Failed to release in-flight batch request {cache_key}: {e}")
+
+def _parse_lines_batch_response(generated_json_str: str, pending_lines: list, updated_lines: list) -> list:
+    """Maps the model's {"lines": [{line_key, text}]} JSON back to line IDs, appending to updated_lines."""
     try:
-        logging.info(f"Sending batch generation request to OpenAI model {target_model} for {len(pending_lines)} lines.")
-        
-        # Log the pending lines and their keys for debugging
-        logging.info(f"Pending lines data: {[{'id': l.get('id', l.get('line_id')), 'line_key': l.get('line_key')} for l in pending_lines]}")
-        
-        response = utils_openai.client.chat.completions.create(
-            model=target_model,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant providing JSON output."},
-                {"role": "user", "content": full_prompt}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.8, # Increase variety slightly?
-            # max_tokens=?? # Set appropriate limit if needed
-        )
-        
-        generated_json_str = response.choices[0].message.content
-        logging.info(f"Received response from OpenAI.")
-        # logging.debug(f"Generated JSON String: {generated_json_str}") # DEBUG
-        
         generated_data = json.loads(generated_json_str)
+        if isinstance(generated_data.get('lines'), list):
+            generated_data = {item.get('line_key'): item.get('text') for item in generated_data['lines'] if isinstance(item, dict)}
         
         # Log the JSON keys received from OpenAI
         logging.info(f"Keys received from OpenAI: {list(generated_data.keys())}")
@@ -1922,14 +2233,8 @@ def _generate_lines_batch(db: Session, script_id: int, pending_lines: list, exis
     except json.JSONDecodeError as json_err:
         logging.error(f"Failed to parse JSON response from OpenAI: {json_err}")
         logging.error(f"Received content: {generated_json_str[:500]}...") # Log beginning of invalid response
-        # How to handle? Return empty? Raise error?
-        # For now, return whatever was processed before error + any lines skipped initially
         # Task logic needs to handle potential partial success/failure.
         raise Exception(f"Failed to parse OpenAI JSON response: {json_err}") from json_err
-    except Exception as e:
-        logging.exception(f"Error during OpenAI call in _generate_lines_batch: {e}")
-        # Re-raise to be caught by the task
-        raise Exception(f"OpenAI API call failed: {e}") from e
 
     return updated_lines
 
@@ -2098,20 +2403,24 @@ def download_vo_script_excel(script_id: int):
         ws.row_dimensions[2].height = estimated_lines * 15 # 15 points per line height
 
         # --- Organize Lines by Category ---
+        # Names for directly assigned categories (custom lines) in one query instead of one per line
+        direct_category_ids = {line.category_id for line in script.lines if line.category_id}
+        direct_category_names = dict(
+            db.query(models.VoScriptTemplateCategory.id, models.VoScriptTemplateCategory.name)
+            .filter(models.VoScriptTemplateCategory.id.in_(direct_category_ids))
+            .all()
+        ) if direct_category_ids else {}
+
         lines_by_category = {}
         for line in script.lines:
             # Determine category (similar logic to get_vo_script)
             category_id = getattr(line, 'category_id', None)
             category_name = "Uncategorized"
-            category_obj = None
             if category_id: # Line has direct category_id (custom line)
-                category_obj = db.query(models.VoScriptTemplateCategory).get(category_id)
+                category_name = direct_category_names.get(category_id, category_name)
             elif line.template_line and line.template_line.category: # Line linked via template
-                 category_obj = line.template_line.category
-            
-            if category_obj:
-                category_name = category_obj.name
-                category_id = category_obj.id # Ensure we have the ID
+                 category_name = line.template_line.category.name
+                 category_id = line.template_line.category.id # Ensure we have the ID
             
             if category_id not in lines_by_category:
                  lines_by_category[category_id] = {'name': category_name, 'lines': []}
@@ -19,9 +19,12 @@ __all__ = [
     'run_generation',
     'regenerate_line_takes',
     'run_speech_to_speech_line',
+    'compact_batch_metadata',
     'crop_audio_take',
     'run_script_creation_agent',
     'generate_category_lines',
+    'generate_category_sub_batch',
+    'finalize_category_lines',
     'run_script_collaborator_chat_task'
 ]
 
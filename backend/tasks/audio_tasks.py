@@ -7,13 +7,64 @@ from celery.exceptions import Ignore
 import base64
 import io  # for in-memory file handling
 from pydub import AudioSegment  # for audio processing
-import tempfile  # for temporary file handling
+import os
+import subprocess  # for ffmpeg stream-copy trims
+import shutil
+import threading
 import logging
 
 print("Celery Worker: Loading audio_tasks.py...")
 
+# Content types for the containers a cropped take can be written back as
+CROP_CONTENT_TYPES = {'mp3': 'audio/mpeg', 'wav': 'audio/wav', 'ogg': 'audio/ogg', 'flac': 'audio/flac'}
+
+# Fallback MP3 re-encode: constant bitrate to match the 128k takes ElevenLabs returns
+CROP_MP3_BITRATE = os.getenv('CROP_MP3_BITRATE', '128k')
+CROP_ENCODE_THREADS = int(os.getenv('CROP_ENCODE_THREADS', os.cpu_count() or 1))
+
+# Chunk size when feeding an R2 body into ffmpeg's stdin
+CROP_PIPE_CHUNK_BYTES = 64 * 1024
+
+def _stream_copy_trim(body, file_format: str, start_seconds: float, end_seconds: float) -> bytes:
+    """Feeds an R2 StreamingBody through an ffmpeg stream copy and returns the trimmed bytes.
+
+    Raises CalledProcessError on a non-zero ffmpeg exit and RuntimeError on empty output.
+    Always closes ``body``.
+    """
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', file_format, '-i', 'pipe:0',
+           '-ss', str(start_seconds), '-to', str(end_seconds),
+           '-c', 'copy', '-f', file_format, 'pipe:1']
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def feed():
+            try:
+                shutil.copyfileobj(body, proc.stdin, CROP_PIPE_CHUNK_BYTES)
+            except OSError:
+                pass # ffmpeg stopped reading (e.g. past the -to point); its exit code reports failures
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        feeder = threading.Thread(target=feed, name='crop-feed', daemon=True)
+        feeder.start()
+        output = proc.stdout.read()
+        stderr = proc.stderr.read() # -loglevel error keeps this well under the pipe buffer
+        feeder.join()
+        returncode = proc.wait()
+    finally:
+        body.close()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output=None, stderr=stderr)
+    if not output:
+        raise RuntimeError("ffmpeg stream copy produced no output")
+    return output
+
 @celery.task(bind=True, name='tasks.crop_audio_take')
-def crop_audio_take(self, r2_object_key: str, start_seconds: float, end_seconds: float):
+def crop_audio_take(self, r2_object_key: str, start_seconds: float, end_seconds: float, bitrate: str = CROP_MP3_BITRATE):
     """Downloads an audio take from R2, crops it, and overwrites the original."""
     task_id = self.request.id
     print(f"[Task ID: {task_id}] Received cropping task for Key: {r2_object_key}, Start: {start_seconds}s, End: {end_seconds}s")
@@ -25,80 +76,77 @@ def crop_audio_take(self, r2_object_key: str, start_seconds: float, end_seconds:
         raise ValueError(error_msg) # Raise to mark task as failed
 
     try:
-        self.update_state(state='STARTED', meta={'status': 'Downloading original audio...'})
-        print(f"[Task ID: {task_id}] Downloading {r2_object_key} from R2...")
-        
-        # 1. Download original audio 
-        audio_bytes = utils_r2.download_blob_to_memory(r2_object_key)
-        if not audio_bytes:
+        # Opening the stream is a single round trip, so one status covers fetch + trim
+        self.update_state(state='STARTED', meta={'status': 'Cropping audio...'})
+        print(f"[Task ID: {task_id}] Streaming {r2_object_key} from R2...")
+
+        # 1. Open the original as a stream rather than downloading it into memory
+        body = utils_r2.open_blob_stream(r2_object_key)
+        if body is None:
             raise FileNotFoundError(f"Failed to download audio from R2: {r2_object_key}")
 
-        # <<< Wrap downloaded bytes in a BytesIO stream >>>
-        audio_stream = io.BytesIO(audio_bytes)
+        print(f"[Task ID: {task_id}] Cropping audio...")
 
-        self.update_state(state='PROGRESS', meta={'status': 'Loading audio data...'})
-        print(f"[Task ID: {task_id}] Loading audio data...")
-        
         file_format = r2_object_key.split('.')[-1].lower() if '.' in r2_object_key else "mp3"
-        
-        with tempfile.NamedTemporaryFile(suffix=f".{file_format}", delete=True) as tmp_file:
-            print(f"[Task ID: {task_id}] Writing audio to temporary file: {tmp_file.name}")
-            # <<< Read from the stream, not the original bytes object >>>
-            # audio_bytes_io.seek(0) 
-            audio_stream.seek(0) # Go to the start of the stream
-            tmp_file.write(audio_stream.read()) # Write bytes from stream to temp file
-            tmp_file.flush() 
-
-            # 2. Load audio using pydub FROM THE TEMP FILE PATH
+        original_duration = None
+        cropped_duration = end_seconds - start_seconds
+
+        # 2. Pipe R2 -> ffmpeg stream copy (no decode / re-encode). Only the cropped output is
+        #    buffered, and it is uploaded only after ffmpeg exits cleanly, so a failed trim
+        #    never overwrites the original.
+        try:
+            cropped_buffer = io.BytesIO(_stream_copy_trim(body, file_format, start_seconds, end_seconds))
+            print(f"[Task ID: {task_id}] Stream-copied {cropped_duration:.2f}s segment with ffmpeg.")
+        except (subprocess.CalledProcessError, FileNotFoundError, RuntimeError) as copy_err:
+            # 3. Fall back to a full pydub decode + re-encode on a fresh download
+            print(f"[Task ID: {task_id}] ffmpeg stream copy failed ({copy_err}); falling back to pydub re-encode.")
+            audio_bytes = utils_r2.download_blob_to_memory(r2_object_key)
+            if not audio_bytes:
+                raise FileNotFoundError(f"Failed to download audio from R2: {r2_object_key}")
             try:
-                audio_segment = AudioSegment.from_file(tmp_file.name, format=file_format)
+                audio_segment = AudioSegment.from_file(io.BytesIO(audio_bytes), format=file_format)
             except Exception as e:
-                # Add specific handling for potential file not found errors from ffmpeg/ffprobe
-                if "No such file or directory" in str(e):
-                     print(f"[Task ID: {task_id}] ERROR: pydub/ffmpeg could not find temp file '{tmp_file.name}' even though it should exist. Check permissions or ffmpeg installation.")
-                raise RuntimeError(f"Failed to load audio data with pydub from temp file: {e}") from e
-
-        # Temp file is automatically deleted when exiting the 'with' block
-
-        self.update_state(state='PROGRESS', meta={'status': 'Cropping audio...'})
-        print(f"[Task ID: {task_id}] Cropping audio...")
-
-        # 3. Convert times and crop
-        start_ms = int(start_seconds * 1000)
-        end_ms = int(end_seconds * 1000)
-
-        # Pydub slicing is [start:end]
-        cropped_audio = audio_segment[start_ms:end_ms]
-        original_duration = len(audio_segment) / 1000.0
-        cropped_duration = len(cropped_audio) / 1000.0
-
-        print(f"[Task ID: {task_id}] Cropped audio from {original_duration:.2f}s to {cropped_duration:.2f}s.")
-        
-        self.update_state(state='PROGRESS', meta={'status': 'Exporting cropped audio...'})
-        print(f"[Task ID: {task_id}] Exporting cropped audio...")
-
-        # 4. Export cropped audio to memory buffer
-        cropped_buffer = io.BytesIO()
-        cropped_audio.export(cropped_buffer, format="mp3")
-        cropped_buffer.seek(0)
+                raise RuntimeError(f"Failed to load audio data with pydub: {e}") from e
+            finally:
+                del audio_bytes
+
+            # Pydub slicing is [start:end] in milliseconds
+            cropped_audio = audio_segment[int(start_seconds * 1000):int(end_seconds * 1000)]
+            original_duration = len(audio_segment) / 1000.0
+            cropped_duration = len(cropped_audio) / 1000.0
+            print(f"[Task ID: {task_id}] Cropped audio from {original_duration:.2f}s to {cropped_duration:.2f}s.")
+
+            # Re-encode in the source container so the object at r2_object_key keeps its format
+            export_buffer = io.BytesIO()
+            if file_format == 'mp3':
+                cropped_audio.export(export_buffer, format='mp3', bitrate=bitrate,
+                                     parameters=['-threads', str(CROP_ENCODE_THREADS)])
+            else:
+                cropped_audio.export(export_buffer, format=file_format)
+            export_buffer.seek(0)
+            cropped_buffer = export_buffer
 
         self.update_state(state='PROGRESS', meta={'status': 'Uploading cropped audio...'})
         print(f"[Task ID: {task_id}] Uploading cropped audio back to {r2_object_key}...")
 
-        # 5. Upload cropped audio, overwriting original
-        upload_success = utils_r2.upload_blob(
+        # 4. Upload cropped audio, overwriting original
+        upload_success = utils_r2.upload_stream(
             blob_name=r2_object_key,
-            data=cropped_buffer,
-            content_type='audio/mpeg'
+            fileobj=cropped_buffer,
+            content_type=CROP_CONTENT_TYPES.get(file_format, 'audio/mpeg'),
+            transfer_config=utils_r2.PARALLEL_TRANSFER_CONFIG # Multipart in parallel 8 MB parts for long takes
         )
 
         if not upload_success:
             raise ConnectionError(f"Failed to upload cropped audio to R2: {r2_object_key}")
 
-        # 6. Success
-        final_status_msg = f"Successfully cropped {r2_object_key}. New duration: {cropped_duration:.2f}s (Original: {original_duration:.2f}s)."
+        # 5. Success
+        final_status_msg = f"Successfully cropped {r2_object_key}. New duration: {cropped_duration:.2f}s"
+        if original_duration is not None:
+            final_status_msg += f" (Original: {original_duration:.2f}s)"
+        final_status_msg += "."
         print(f"[Task ID: {task_id}] {final_status_msg}")
-        self.update_state(state='SUCCESS', meta={'status': final_status_msg})
+        # No update_state here: Celery stores the SUCCESS state and this return value itself
         return {'status': 'SUCCESS', 'message': final_status_msg}
 
     except Exception as e:
@@ -6,16 +6,28 @@ from backend import models
 from backend import utils_elevenlabs
 from backend import utils_r2
 from sqlalchemy.orm import Session
+import gc
+import os
 import time
-import json
+import orjson
 import random
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from celery.exceptions import Ignore, Retry
 import logging
-from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
 
 print("Celery Worker: Loading generation_tasks.py...")
 
+# Minimum gap between per-take PROGRESS updates pushed to the result backend
+PROGRESS_UPDATE_INTERVAL_SECONDS = 1.0
+
+# Concurrent ElevenLabs TTS + R2 upload workers per generation task
+TTS_MAX_WORKERS = int(os.getenv('TTS_MAX_WORKERS', '8'))
+
 @celery.task(bind=True, name='tasks.run_generation')
 def run_generation(self, 
                    generation_job_db_id: int, 
@@ -27,22 +39,23 @@ def run_generation(self,
     
     db: Session = next(models.get_db()) # Get DB session for this task execution
     db_job = None
+    tts_pool = None
     try:
         # Update DB status to STARTED
-        db_job = db.query(models.GenerationJob).filter(models.GenerationJob.id == generation_job_db_id).first()
+        db_job = db.get(models.GenerationJob, generation_job_db_id) # PK lookup via the identity map
         if not db_job:
             print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] ERROR: GenerationJob record not found.")
             raise Ignore() # Ignore if DB record is missing
         
         db_job.status = "STARTED"
-        db_job.started_at = datetime.utcnow()
+        db_job.started_at = datetime.now(timezone.utc).replace(tzinfo=None) # Naive UTC column
         db_job.celery_task_id = task_id # Ensure celery task ID is stored
         db.commit()
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Updated job status to STARTED.")
 
         self.update_state(state='STARTED', meta={'status': 'Parsing configuration...', 'db_id': generation_job_db_id})
 
-        config = json.loads(config_json)
+        config = orjson.loads(config_json)
         # --- Config Validation / Setup --- 
         skin_name = config['skin_name']
         voice_ids = config['voice_ids']
@@ -65,6 +78,10 @@ def run_generation(self,
         if not isinstance(style_range, (list, tuple)) or len(style_range) != 2: style_range = [0.0, 0.45]
         if not isinstance(speed_range, (list, tuple)) or len(speed_range) != 2: speed_range = [0.95, 1.05]
 
+        # Optional job-level seed; each voice derives its own so a re-run with the same seed
+        # reproduces the same per-take settings
+        settings_seed = config.get('settings_seed')
+
         # --- Prepare Script Data from VO Script --- #
         script_data = []
         vo_script_name = "Unknown"
@@ -74,84 +91,115 @@ def run_generation(self,
             # Define statuses valid for generation
             valid_statuses_for_generation = ['generated', 'manual', 'review']
             
-            # Query VoScriptLines, joining template line for ordering fallback
-            lines_from_db = (
-                db.query(models.VoScriptLine)
-                .options(selectinload(models.VoScriptLine.template_line)) # Eager load template_line
-                .filter(
+            # Only the columns script_data needs, as plain rows (no ORM objects or identity map);
+            # the template line key (for the key fallback) and script name come back on the same rows
+            line_rows = db.execute(
+                select(
+                    models.VoScriptLine.id,
+                    models.VoScriptLine.line_key,
+                    models.VoScriptLine.generated_text,
+                    models.VoScriptTemplateLine.line_key.label('template_line_key'),
+                    models.VoScript.name.label('vo_script_name')
+                )
+                .join(models.VoScript, models.VoScriptLine.vo_script_id == models.VoScript.id)
+                .outerjoin(models.VoScriptTemplateLine, models.VoScriptLine.template_line_id == models.VoScriptTemplateLine.id)
+                .where(
                     models.VoScriptLine.vo_script_id == vo_script_id,
                     models.VoScriptLine.status.in_(valid_statuses_for_generation),
                     models.VoScriptLine.generated_text.isnot(None), # Ensure text exists
                     models.VoScriptLine.generated_text != '' # Ensure text is not empty
                 )
                 .order_by(models.VoScriptLine.id) # Order by ID for now
-                .all()
-            )
+            ).all()
 
-            if not lines_from_db:
+            if not line_rows:
                 # If no lines found, raise error directly without querying name again
                 raise ValueError(f"No lines with valid status ({valid_statuses_for_generation}) and non-empty text found for VO Script ID {vo_script_id}") # Simplified error
-            else:
-                # Get script name from the first line's relationship (if needed for logging/metadata)
-                vo_script_name = lines_from_db[0].vo_script.name if lines_from_db[0].vo_script else f"ID {vo_script_id}"
-                
-            # Format into the expected list of dicts {'Function': key, 'Line': text}
-            # --- UPDATED: Implement line_key fallback logic --- 
-            script_data = []
-            for line in lines_from_db:
-                final_line_key = line.line_key # Prioritize direct key
-                if not final_line_key and line.template_line: # Fallback to template line key
-                    final_line_key = line.template_line.line_key
-                if not final_line_key: # Fallback to ID if still no key
-                    final_line_key = f'line_{line.id}'
-                
-                script_data.append({
-                    'Function': final_line_key,
-                    'Line': line.generated_text
-                })
-            # --- END UPDATED --- 
+            vo_script_name = line_rows[0].vo_script_name or f"ID {vo_script_id}"
+
+            # Format into the expected list of dicts {'Function': key, 'Line': text}.
+            # line_key falls back to the template line's key, then to the line ID.
+            script_data = [
+                {
+                    'Function': row.line_key or row.template_line_key or f'line_{row.id}',
+                    'Line': row.generated_text
+                }
+                for row in line_rows
+            ]
+            del line_rows
             print(f"[Task ID: {task_id}] Loaded {len(script_data)} lines from VO Script '{vo_script_name}' ({vo_script_id})")
+            # End the read transaction so its pooled connection isn't held idle for the whole
+            # TTS run; the final status write checks out a connection again.
+            db.commit()
 
         except (ValueError, IndexError, Exception) as e:
             status_msg = f'Error preparing script data from VO Script {vo_script_id}: {e}'
             print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] {status_msg}")
             db_job.status = "FAILURE"
-            db_job.completed_at = datetime.utcnow()
+            db_job.completed_at = datetime.now(timezone.utc).replace(tzinfo=None)
             db_job.result_message = status_msg
             db.commit()
             self.update_state(state='FAILURE', meta={'status': status_msg, 'db_id': generation_job_db_id})
             raise Ignore() # Use Ignore to stop processing without retrying
         # --- END SCRIPT DATA PREPARATION ---
 
-        total_takes_to_generate = len(voice_ids) * len(script_data) * variants_per_line
+        # Lines are the same for every voice, so filter them once (the query already excludes
+        # empty text; this is belt-and-suspenders) and keep the original index for ordering
+        generation_lines = [
+            (line_index, line_info['Function'], line_info['Line'])
+            for line_index, line_info in enumerate(script_data) if line_info['Line']
+        ]
+        for line_info in script_data:
+            if not line_info['Line']:
+                print(f"[Task ID: {task_id}] Skipping line '{line_info['Function']}' due to empty text.")
+
+        total_takes_to_generate = len(voice_ids) * len(generation_lines) * variants_per_line
+        progress_scale = 100 / (total_takes_to_generate or 1)
         generated_takes_count = 0
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Parsed config. Total takes to generate: {total_takes_to_generate}")
 
         # --- Generation Loop ---
         all_batches_metadata = []
         elevenlabs_failures = 0
+        last_progress_ts = 0.0
+        last_progress_percent = 0
+        # Takes are independent HTTPS round-trips (TTS + R2 upload), so run them concurrently
+        tts_pool = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix='tts-take')
 
-        for voice_id in voice_ids:
+        # Resolve voice folder names once for the whole job rather than listing voices per voice
+        try:
+            voice_map = utils_elevenlabs.get_voice_map()
+        except Exception as e:
+            print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Warning: Could not fetch voice list: {e}")
+            voice_map = {}
+        voice_folder_map = {
+            voice_id: f"{voice_map[voice_id].get('name', voice_id)}-{voice_id}"
+            for voice_id in voice_ids if voice_id in voice_map
+        }
+
+        for voice_index, voice_id in enumerate(voice_ids, 1):
+            last_progress_percent = int(generated_takes_count * progress_scale)
             self.update_state(state='PROGRESS', meta={
                 'status': f'Processing voice: {voice_id}...',
                 'current_voice': voice_id,
-                'progress': int(100 * generated_takes_count / total_takes_to_generate)
+                'progress': last_progress_percent
             })
+            last_progress_ts = time.monotonic() # Counts toward the take-update throttle below
 
-            # --- Get Voice Name & Create Directories ---
-            try:
-                # TODO: Consider caching voice details? API call per task might be slow.
-                voices = utils_elevenlabs.get_available_voices()
-                voice_info = next((v for v in voices if v.get('voice_id') == voice_id), None)
-                if not voice_info:
-                    raise ValueError(f"Voice ID {voice_id} not found.")
-                voice_name_human = voice_info.get('name', voice_id)
-                voice_folder_name = f"{voice_name_human}-{voice_id}"
-            except Exception as e:
-                # Log warning but continue if possible, or fail task?
-                print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Warning: Could not get voice name for {voice_id}: {e}")
+            # --- Get Voice Folder Name ---
+            voice_folder_name = voice_folder_map.get(voice_id)
+            if not voice_folder_name:
+                print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Warning: Voice ID {voice_id} not found in voice list, using the ID as folder name.")
                 voice_folder_name = voice_id # Fallback to ID
 
+            # Sample every take's settings for this voice from one seeded generator, in script
+            # order on this thread, so the draw order doesn't depend on pool scheduling
+            if settings_seed is not None:
+                voice_seed = zlib.crc32(f"{settings_seed}:{voice_id}".encode())
+            else:
+                voice_seed = random.getrandbits(32)
+            rng = random.Random(voice_seed)
+
             batch_timestamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
             batch_id = f"{batch_timestamp}-{voice_id[:4]}"
 
@@ -165,101 +213,93 @@ def run_generation(self,
                 "source_vo_script_name": vo_script_name, # Store VO Script Name
                 "generated_at_utc": None, # Will be set at the end
                 "generation_params": config, # Store original config
+                "settings_seed": voice_seed, # Seeds this voice's randomized take settings
                 "ranked_at_utc": None,
                 "takes": []
             }
 
             voice_has_success = False # Track if *any* take for this voice succeeded
-            for line_info in script_data:
-                line_func = line_info['Function']
-                line_text = line_info['Line']
-
-                # Skip if line_text is empty or None (should be handled by filter, but belt-and-suspenders)
-                if not line_text:
-                    print(f"[Task ID: {task_id}] Skipping line '{line_func}' due to empty text.")
-                    # Adjust total takes expected?
-                    total_takes_to_generate -= variants_per_line
-                    continue
-                
+            batch_takes_prefix = f"{skin_name}/{voice_folder_name}/{batch_id}/takes/"
+
+            def generate_take(line_func, line_text, take_num, take_settings, voice_id=voice_id):
+                """TTS + R2 upload for one take; runs on the pool. Returns the take's metadata."""
+                output_filename = f"{line_func}_take_{take_num}.mp3"
+                # --- Construct R2 Blob Key --- 
+                r2_blob_key = f"{batch_takes_prefix}{output_filename}"
+
+                # --- Generate audio and upload to R2 (served from the TTS cache when enabled) ---
+                take_settings, _ = utils_elevenlabs.generate_tts_to_r2(
+                    r2_blob_key=r2_blob_key,
+                    text=line_text,
+                    voice_id=voice_id,
+                    voice_settings=take_settings,
+                    model_id=model_id,
+                    output_format=output_format,
+                    variant=take_num
+                )
+
+                return {
+                    "file": output_filename, # Store relative filename for reference
+                    "r2_key": r2_blob_key,   # Store full R2 key
+                    "line": line_func,
+                    "script_text": line_text,
+                    "take_number": take_num,
+                    "generation_settings": take_settings,
+                    "rank": None,
+                    "ranked_at": None
+                }
+
+            # Fan the voice's takes out over the pool. The semaphore bounds queued + running
+            # takes, and with them the HTTP and R2 connections those takes hold open.
+            in_flight = threading.BoundedSemaphore(2 * TTS_MAX_WORKERS)
+            futures = {}
+            for line_index, line_func, line_text in generation_lines:
                 for take_num in range(1, variants_per_line + 1):
-                    generated_takes_count += 1
-                    # Adjust progress calculation to avoid division by zero if total becomes 0
-                    progress_percent = int(100 * generated_takes_count / (total_takes_to_generate or 1))
+                    # --- Randomize settings WITHIN the provided ranges ---
+                    take_settings = {
+                        'stability': rng.uniform(*stability_range),
+                        'similarity_boost': rng.uniform(*similarity_boost_range),
+                        'style': rng.uniform(*style_range),
+                        'use_speaker_boost': use_speaker_boost, # Fixed value
+                        'speed': rng.uniform(*speed_range)
+                    }
+                    in_flight.acquire()
+                    future = tts_pool.submit(generate_take, line_func, line_text, take_num, take_settings)
+                    future.add_done_callback(lambda _f: in_flight.release())
+                    futures[future] = (line_index, take_num, f"{batch_takes_prefix}{line_func}_take_{take_num}.mp3")
+
+            voice_takes = []
+            for voice_done, future in enumerate(as_completed(futures), 1):
+                line_index, take_num, r2_blob_key = futures[future]
+                generated_takes_count += 1
+                try:
+                    voice_takes.append((line_index, take_num, future.result()))
+                    voice_has_success = True # Mark success for this voice
+                except utils_elevenlabs.ElevenLabsError as e:
+                    # Log error for this take, but continue with others
+                    print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] ERROR generating take {r2_blob_key}: {e}")
+                    elevenlabs_failures += 1
+                except Exception as e:
+                    print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] UNEXPECTED ERROR during take {r2_blob_key} generation/upload: {e}")
+                    # Decide if unexpected errors should count as failure?
+                    elevenlabs_failures += 1 # Count unexpected as failure too
+
+                # Coarse tick only: report when the overall percentage moves, at most ~1/sec.
+                # Voice start/end updates carry the rest, so backend writes stay O(voices + 100).
+                progress_percent = int(generated_takes_count * progress_scale)
+                now = time.monotonic()
+                if progress_percent > last_progress_percent and now - last_progress_ts >= PROGRESS_UPDATE_INTERVAL_SECONDS:
                     self.update_state(state='PROGRESS', meta={
-                        'status': f'Generating: {line_func} Take {take_num}/{variants_per_line} (Voice {voice_id}) Progress: {progress_percent}%',
+                        'status': f'Generating voice {voice_id}: {voice_done}/{len(futures)} takes. Progress: {progress_percent}%',
                         'current_voice': voice_id,
-                        'current_line': line_func,
-                        'current_take': take_num,
                         'progress': progress_percent
                     })
+                    last_progress_ts = now
+                    last_progress_percent = progress_percent
 
-                    # --- Randomize settings WITHIN the provided ranges --- 
-                    stability_take = random.uniform(*stability_range)
-                    similarity_boost_take = random.uniform(*similarity_boost_range)
-                    style_take = random.uniform(*style_range)
-                    speed_take = random.uniform(*speed_range)
-                    
-                    take_settings = {
-                        'stability': stability_take,
-                        'similarity_boost': similarity_boost_take,
-                        'style': style_take,
-                        'use_speaker_boost': use_speaker_boost, # Fixed value
-                        'speed': speed_take
-                    }
-
-                    output_filename = f"{line_func}_take_{take_num}.mp3"
-                    # --- Construct R2 Blob Key --- 
-                    r2_blob_key = f"{skin_name}/{voice_folder_name}/{batch_id}/takes/{output_filename}"
-
-                    try:
-                        # --- Generate audio bytes --- 
-                        audio_bytes = utils_elevenlabs.generate_tts_audio_bytes(
-                            text=line_text,
-                            voice_id=voice_id,
-                            model_id=model_id,
-                            output_format=output_format,
-                            stability=stability_take,
-                            similarity_boost=similarity_boost_take,
-                            style=style_take,
-                            speed=speed_take,
-                            use_speaker_boost=use_speaker_boost
-                        )
-
-                        if not audio_bytes:
-                             raise utils_elevenlabs.ElevenLabsError("Generation returned empty audio data.")
-
-                        # --- Upload to R2 --- 
-                        upload_success = utils_r2.upload_blob(
-                            blob_name=r2_blob_key,
-                            data=audio_bytes,
-                            content_type='audio/mpeg' # Adjust if output_format changes
-                        )
-
-                        if not upload_success:
-                            # Log error but maybe continue?
-                            raise Exception(f"Failed to upload {r2_blob_key} to R2.")
-
-                        # Add take metadata
-                        batch_metadata["takes"].append({
-                            "file": output_filename, # Store relative filename for reference
-                            "r2_key": r2_blob_key,   # Store full R2 key
-                            "line": line_func,
-                            "script_text": line_text,
-                            "take_number": take_num,
-                            "generation_settings": take_settings,
-                            "rank": None,
-                            "ranked_at": None
-                        })
-                        voice_has_success = True # Mark success for this voice
-
-                    except utils_elevenlabs.ElevenLabsError as e:
-                        # Log error for this take, but continue with others
-                        print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] ERROR generating take {r2_blob_key}: {e}")
-                        elevenlabs_failures += 1
-                    except Exception as e:
-                        print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] UNEXPECTED ERROR during take {r2_blob_key} generation/upload: {e}")
-                        # Decide if unexpected errors should count as failure?
-                        elevenlabs_failures += 1 # Count unexpected as failure too
+            # Takes finish out of order; keep metadata in script order like the serial loop did
+            voice_takes.sort(key=lambda t: (t[0], t[1]))
+            batch_metadata["takes"].extend(take_meta for _, _, take_meta in voice_takes)
 
             # --- Post-Voice Processing ---
             if voice_has_success:
@@ -267,31 +307,45 @@ def run_generation(self,
                 try:
                     # --- Serialize and Upload Metadata to R2 --- 
                     metadata_blob_key = f"{skin_name}/{voice_folder_name}/{batch_id}/metadata.json"
-                    metadata_bytes = json.dumps(batch_metadata, indent=2).encode('utf-8')
-                    
-                    meta_upload_success = utils_r2.upload_blob(
-                        blob_name=metadata_blob_key,
-                        data=metadata_bytes,
-                        content_type='application/json'
-                    )
+                    # Compact (and zstd-compressed when available): machine-read only
+                    meta_upload_success = utils_r2.upload_json_blob(metadata_blob_key, batch_metadata)
                     
                     if not meta_upload_success:
                         raise Exception(f"Failed to upload metadata {metadata_blob_key} to R2.")
 
                     print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Saved metadata to R2 for batch: {batch_id}")
-                    all_batches_metadata.append(batch_metadata) # Add for final result
+                    # Keep only a summary for the final result; the full take list lives in R2 now
+                    all_batches_metadata.append({
+                        'batch_prefix': f"{skin_name}/{voice_folder_name}/{batch_id}",
+                        'take_count': len(batch_metadata["takes"])
+                    })
                 except Exception as e:
                     # If metadata upload fails, this is more serious, consider Retry
                     status_msg = f'ERROR saving metadata to R2 for batch {batch_id}: {e}'
                     print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] {status_msg}")
                     self.update_state(state='FAILURE', meta={'status': status_msg, 'db_id': generation_job_db_id})
                     raise Retry(exc=e, countdown=60)
+
+                # Index the voice's takes in the DB in one INSERT and commit right away so the
+                # connection goes back to the pool before the next voice's TTS loop. Best effort:
+                # the takes are already in R2, so a DB error must not retry the whole task.
+                models.record_takes(db, generation_job_db_id, all_batches_metadata[-1]['batch_prefix'], batch_metadata["takes"])
+                try:
+                    db.commit()
+                except SQLAlchemyError as e:
+                    db.rollback()
+                    print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Warning: Could not commit take index for batch {batch_id}: {e}")
             else:
                 print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] No successful takes for voice {voice_id}, skipping metadata upload.")
+            self.update_state(state='PROGRESS', meta={
+                'status': f'Finished voice {voice_id} ({voice_index}/{len(voice_ids)}).',
+                'current_voice': voice_id,
+                'progress': int(generated_takes_count * progress_scale)
+            })
+            # Release this voice's buffers before the next voice builds its own
+            del batch_metadata, voice_takes, futures
 
         # --- Task Completion ---
-        # Adjust total takes if some lines were skipped
-        actual_total_takes = len(all_batches_metadata) * variants_per_line * len(script_data) if script_data else 0 
         # Recalculate expected based on lines actually processed
         expected_takes_count = len(script_data) * len(voice_ids) * variants_per_line
         
@@ -312,11 +366,11 @@ def run_generation(self,
              final_db_status = "SUCCESS"
 
         db_job.status = final_db_status
-        db_job.completed_at = datetime.utcnow()
+        db_job.completed_at = datetime.now(timezone.utc).replace(tzinfo=None)
         db_job.result_message = final_status_msg
         # Store R2 batch prefixes instead of just IDs?
-        generated_batch_prefixes = [f"{b['skin_name']}/{b['voice_name']}/{b['batch_id']}" for b in all_batches_metadata]
-        db_job.result_batch_ids_json = json.dumps(generated_batch_prefixes)
+        generated_batch_prefixes = [b['batch_prefix'] for b in all_batches_metadata]
+        db_job.result_batch_ids_json = orjson.dumps(generated_batch_prefixes).decode()
         db.commit()
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Updated job status to {final_db_status}.")
 
@@ -324,10 +378,7 @@ def run_generation(self,
         result = {
             'status': final_db_status, # Return the more granular status
             'message': final_status_msg,
-            'generated_batches': [
-                {'batch_prefix': f"{b['skin_name']}/{b['voice_name']}/{b['batch_id']}", 'take_count': len(b['takes'])}
-                for b in all_batches_metadata
-            ]
+            'generated_batches': all_batches_metadata
         }
         # Update Celery task state before returning
         self.update_state(state=final_db_status, meta=result)
@@ -340,7 +391,7 @@ def run_generation(self,
         # --- Update DB Job Record on FAILURE ---
         if db_job: # Ensure db_job was loaded
             db_job.status = "FAILURE"
-            db_job.completed_at = datetime.utcnow()
+            db_job.completed_at = datetime.now(timezone.utc).replace(tzinfo=None)
             db_job.result_message = error_msg
             try:
                 db.commit()
@@ -352,4 +403,8 @@ def run_generation(self,
         # Re-raise exception so Celery marks task as failed
         raise e
     finally:
+        if tts_pool:
+            tts_pool.shutdown(wait=True, cancel_futures=True)
+        # Collect reference cycles left by this run so the long-lived worker's RSS doesn't creep
+        gc.collect()
         db.close() # Ensure session is closed for this task execution 
\ No newline at end of file
@@ -6,16 +6,118 @@ from backend.celery_app import celery
 from backend import models
 from backend import utils_elevenlabs
 from backend import utils_r2
+from backend import utils_redis
+from backend import utils_metadata_cache
 from sqlalchemy.orm import Session
+from sqlalchemy import select, update
 import json
+import os
+import orjson
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from datetime import datetime, timezone
 from celery.exceptions import Ignore, Retry
-import base64
+import redis
 import logging
 
 print("Celery Worker: Loading regeneration_tasks.py...")
 
+# Minimum gap between PROGRESS updates pushed to the result backend from take loops
+PROGRESS_UPDATE_INTERVAL_SECONDS = 1.0
+
+# Concurrent STS + R2 upload workers per speech-to-speech task
+STS_MAX_WORKERS = int(os.getenv('STS_MAX_WORKERS', '8'))
+
+# STS metadata re-upload retries: exponential backoff from the attempt count
+STS_RETRY_BASE_COUNTDOWN = 15
+STS_RETRY_MAX_COUNTDOWN = 300
+# How long generated-take checkpoints survive in Redis for a retried STS task
+STS_CHECKPOINT_TTL_SECONDS = 3600
+
+def _sts_checkpoint_key(task_id: str) -> str:
+    return f"sts:{task_id}:done"
+
+def _load_sts_checkpoint(task_id: str) -> dict | None:
+    """Returns {'takes': [...], 'deleted_keys': [...]} saved by an earlier attempt of this task, if any."""
+    client = utils_redis.get_redis_client()
+    if not client:
+        return None
+    try:
+        raw = client.get(_sts_checkpoint_key(task_id))
+        return orjson.loads(raw) if raw else None
+    except (redis.RedisError, orjson.JSONDecodeError) as e:
+        print(f"[Task ID: {task_id}] Warning: Could not read STS checkpoint: {e}")
+        return None
+
+def _save_sts_checkpoint(task_id: str, takes: list, deleted_keys: list) -> None:
+    """Records uploaded takes so a retry after a failed metadata write doesn't redo the STS calls."""
+    client = utils_redis.get_redis_client()
+    if not client:
+        return
+    try:
+        client.set(_sts_checkpoint_key(task_id),
+                   orjson.dumps({'takes': takes, 'deleted_keys': deleted_keys}),
+                   ex=STS_CHECKPOINT_TTL_SECONDS)
+    except redis.RedisError as e:
+        print(f"[Task ID: {task_id}] Warning: Could not save STS checkpoint: {e}")
+
+def _clear_sts_checkpoint(task_id: str) -> None:
+    client = utils_redis.get_redis_client()
+    if not client:
+        return
+    try:
+        client.delete(_sts_checkpoint_key(task_id))
+    except redis.RedisError as e:
+        print(f"[Task ID: {task_id}] Warning: Could not clear STS checkpoint: {e}")
+
+def _partition_line_takes(original_takes: list, line_key: str, replace_existing: bool) -> tuple[list, list, int]:
+    """Splits batch takes for a line regen in a single pass.
+
+    Returns the takes to carry over (all of them, or all but this line's when
+    replacing), this line's existing takes, and the take number the new takes
+    should start from.
+    """
+    max_take = 0
+    kept_takes = []
+    line_takes = []
+    for t in original_takes:
+        if t.get('line') == line_key:
+            line_takes.append(t)
+            n = t.get('take_number', 0)
+            if n > max_take: max_take = n
+            if replace_existing: continue
+        kept_takes.append(t)
+    return kept_takes, line_takes, 1 if replace_existing else max_take + 1
+
+def _delete_line_takes(line_takes: list, takes_prefix: str, line_key: str) -> list:
+    """Deletes a line's take blobs and returns the deleted keys.
+
+    Metadata records each take's exact r2_key, so those are bulk-deleted without
+    listing R2 first. Only legacy entries without an r2_key fall back to a prefix
+    LIST + delete.
+    """
+    if all(t.get('r2_key') for t in line_takes):
+        return utils_r2.delete_blobs_bulk([t['r2_key'] for t in line_takes])
+    return utils_r2.delete_prefix(f"{takes_prefix}{line_key}_take_")
+
+def _utcnow_naive() -> datetime:
+    """Current UTC time without tzinfo, matching the naive GenerationJob DateTime columns."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _update_job(db: Session, generation_job_db_id: int, **values) -> bool:
+    """Writes GenerationJob columns with a single Core UPDATE (no row load).
+
+    Returns False if no job row matched. The caller owns the commit.
+    """
+    result = db.execute(
+        update(models.GenerationJob)
+        .where(models.GenerationJob.id == generation_job_db_id)
+        .values(**values)
+    )
+    return result.rowcount > 0
+
 @celery.task(bind=True, name='tasks.regenerate_line_takes')
 def regenerate_line_takes(self,
                           generation_job_db_id: int,
@@ -31,23 +133,26 @@ def regenerate_line_takes(self,
     print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Received line regen task for Prefix '{batch_id}', Line '{line_key}'")
 
     db: Session = next(models.get_db())
-    db_job = None
+    job_found = False
     metadata_blob_key = f"{batch_id}/metadata.json"
+    # Start the metadata and line-shard GETs now so they overlap the STARTED status write below
+    prefetch_pool = ThreadPoolExecutor(max_workers=2)
+    metadata_future = prefetch_pool.submit(utils_metadata_cache.load_batch_metadata, batch_id)
+    line_meta_future = prefetch_pool.submit(utils_r2.load_line_meta, batch_id, line_key)
 
     try:
         # Update DB job status
-        db_job = db.query(models.GenerationJob).filter(models.GenerationJob.id == generation_job_db_id).first()
-        if not db_job: raise Ignore("GenerationJob record not found.")
-        db_job.status = "STARTED"; db_job.started_at = datetime.utcnow(); db_job.celery_task_id = task_id
-        # Store target batch prefix and line key
-        db_job.target_batch_id = batch_id
-        db_job.target_line_key = line_key
+        # Also stores target batch prefix and line key
+        job_found = _update_job(db, generation_job_db_id,
+                                status="STARTED", started_at=_utcnow_naive(), celery_task_id=task_id,
+                                target_batch_id=batch_id, target_line_key=line_key)
+        if not job_found: raise Ignore("GenerationJob record not found.")
         db.commit()
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Updated job status to STARTED.")
         self.update_state(state='STARTED', meta={'status': f'Preparing regen for line: {line_key}', 'db_id': generation_job_db_id})
 
         # Parse settings (same as before)
-        settings = json.loads(settings_json)
+        settings = orjson.loads(settings_json)
         stability_range = settings.get('stability_range', [0.5, 0.75])
         similarity_boost_range = settings.get('similarity_boost_range', [0.75, 0.9])
         style_range = settings.get('style_range', [0.0, 0.45])
@@ -55,16 +160,21 @@ def regenerate_line_takes(self,
         use_speaker_boost = settings.get('use_speaker_boost', True)
         model_id = settings.get('model_id', utils_elevenlabs.DEFAULT_MODEL)
         output_format = settings.get('output_format', 'mp3_44100_128')
+        # Bind each range to one draw callable up front instead of unpacking it for every take
+        rng = random.Random()
+        draw_stability = partial(rng.uniform, *stability_range)
+        draw_similarity_boost = partial(rng.uniform, *similarity_boost_range)
+        draw_style = partial(rng.uniform, *style_range)
+        draw_speed = partial(rng.uniform, *speed_range)
 
         # --- Load Metadata from R2 --- 
-        print(f"[Task ID: {task_id}] Downloading metadata: {metadata_blob_key}")
-        metadata_bytes = utils_r2.download_blob_to_memory(metadata_blob_key)
-        if not metadata_bytes:
-            raise ValueError(f"Metadata blob not found or failed to download: {metadata_blob_key}")
+        print(f"[Task ID: {task_id}] Waiting for metadata: {metadata_blob_key}")
         try:
-            metadata = json.loads(metadata_bytes.decode('utf-8'))
-        except json.JSONDecodeError as e:
+            metadata = metadata_future.result()
+        except ValueError as e:
             raise ValueError(f"Failed to parse metadata JSON from {metadata_blob_key}: {e}")
+        if not metadata:
+            raise ValueError(f"Metadata blob not found or failed to download: {metadata_blob_key}")
 
         # Extract needed info from metadata
         source_script_id = metadata.get('source_script_id') # Get the source script ID
@@ -78,85 +188,59 @@ def regenerate_line_takes(self,
         # Construct base prefix for takes in R2
         takes_prefix = f"{batch_id}/takes/"
 
-        original_takes = metadata.get('takes', [])
-        new_metadata_takes = []
+        # Like STS, a line regen reads and writes only that line's shard rather
+        # than the whole batch file. Without a shard yet, seed it from metadata.json.
+        line_meta = line_meta_future.result()
+        if line_meta is not None:
+            original_takes = line_meta.get('takes', [])
+        else:
+            original_takes = [t for t in metadata.get('takes', []) if t.get('line') == line_key]
         deleted_r2_keys = []
-        start_take_num = 1
-        current_line_takes = [t for t in original_takes if t.get('line') == line_key]
+        new_metadata_takes, line_takes, start_take_num = _partition_line_takes(original_takes, line_key, replace_existing)
 
         if replace_existing:
             print(f"[Task ID: {task_id}] Replacing existing takes for line '{line_key}'")
             self.update_state(state='PROGRESS', meta={'status': f'Deleting old takes for line: {line_key}', 'db_id': generation_job_db_id})
 
             # --- Delete existing blobs for this line in R2 --- 
-            # No need to list first if we know the file naming convention
-            # However, listing is safer if take numbers could be sparse.
-            # Let's list for safety.
-            prefix_to_delete = f"{takes_prefix}{line_key}_take_"
-            blobs_to_delete = utils_r2.list_blobs_in_prefix(prefix=prefix_to_delete)
-            deleted_count = 0
-            for blob_info in blobs_to_delete:
-                r2_key_to_delete = blob_info.get('Key')
-                if r2_key_to_delete:
-                    print(f"[Task ID: {task_id}] Deleting existing take blob: {r2_key_to_delete}")
-                    if utils_r2.delete_blob(r2_key_to_delete):
-                        deleted_r2_keys.append(r2_key_to_delete)
-                        deleted_count += 1
-                    else:
-                        print(f"[Task ID: {task_id}] Warning: Failed to delete blob {r2_key_to_delete}")
-            print(f"[Task ID: {task_id}] Deleted {deleted_count} existing take blobs for line '{line_key}'")
-
-            # Filter out the old takes from the metadata list
-            new_metadata_takes = [t for t in original_takes if t.get('line') != line_key]
-            # start_take_num remains 1
+            deleted_r2_keys.extend(_delete_line_takes(line_takes, takes_prefix, line_key))
+            print(f"[Task ID: {task_id}] Deleted {len(deleted_r2_keys)} existing take blobs for line '{line_key}'")
         else:
             print(f"[Task ID: {task_id}] Adding new takes for line '{line_key}'")
-            new_metadata_takes = original_takes # Start with all original takes
-            if current_line_takes:
-                start_take_num = max(t.get('take_number', 0) for t in current_line_takes) + 1
 
         # Generate new takes
         newly_generated_takes_meta = []
         failures = 0
+        last_progress_ts = 0.0
         for i in range(num_new_takes):
             take_num = start_take_num + i
-            self.update_state(state='PROGRESS', meta={
-                'status': f'Generating take {take_num}/{start_take_num + num_new_takes - 1} for line: {line_key}',
-                'db_id': generation_job_db_id,
-                'progress': int(100 * (i + 1) / num_new_takes)
-            })
-
-            stability_take = random.uniform(*stability_range)
-            similarity_boost_take = random.uniform(*similarity_boost_range)
-            style_take = random.uniform(*style_range)
-            speed_take = random.uniform(*speed_range)
-            take_settings = { 'stability': stability_take, 'similarity_boost': similarity_boost_take, 'style': style_take, 'use_speaker_boost': use_speaker_boost, 'speed': speed_take }
+            # Throttle result-backend writes to ~1/sec (always report the last take)
+            now = time.monotonic()
+            if now - last_progress_ts >= PROGRESS_UPDATE_INTERVAL_SECONDS or i == num_new_takes - 1:
+                self.update_state(state='PROGRESS', meta={
+                    'status': f'Generating take {take_num}/{start_take_num + num_new_takes - 1} for line: {line_key}',
+                    'db_id': generation_job_db_id,
+                    'progress': int(100 * (i + 1) / num_new_takes)
+                })
+                last_progress_ts = now
+
+            take_settings = { 'stability': draw_stability(), 'similarity_boost': draw_similarity_boost(), 'style': draw_style(), 'use_speaker_boost': use_speaker_boost, 'speed': draw_speed() }
 
             output_filename = f"{line_key}_take_{take_num}.mp3"
             r2_blob_key = f"{takes_prefix}{output_filename}"
 
             try:
-                # Generate audio bytes
-                audio_bytes = utils_elevenlabs.generate_tts_audio_bytes(
+                # Generate and upload to R2. Replacing takes asks for fresh audio, so skip the cache then.
+                take_settings, _ = utils_elevenlabs.generate_tts_to_r2(
+                    r2_blob_key=r2_blob_key,
                     text=line_text,
                     voice_id=original_voice_id, # Use the voice ID from the original batch
+                    voice_settings=take_settings,
                     model_id=model_id,
                     output_format=output_format,
-                    stability=stability_take,
-                    similarity_boost=similarity_boost_take,
-                    style=style_take,
-                    speed=speed_take,
-                    use_speaker_boost=use_speaker_boost
-                )
-                if not audio_bytes: raise utils_elevenlabs.ElevenLabsError("Generation returned empty audio data.")
-
-                # Upload to R2
-                upload_success = utils_r2.upload_blob(
-                    blob_name=r2_blob_key,
-                    data=audio_bytes,
-                    content_type='audio/mpeg'
+                    variant=take_num,
+                    use_cache=not replace_existing
                 )
-                if not upload_success: raise Exception(f"Failed to upload {r2_blob_key} to R2.")
 
                 # Add metadata for the new take
                 new_take_meta = {
@@ -174,49 +258,60 @@ def regenerate_line_takes(self,
                 print(f"[Task ID: {task_id}] ERROR generating/uploading take {r2_blob_key}: {e}")
                 failures += 1
 
-        # --- Upload Updated Metadata to R2 (Overwrite) --- 
-        metadata['takes'] = new_metadata_takes
-        metadata['last_regenerated_line'] = {
-            'line': line_key,
-            'at': datetime.now(timezone.utc).isoformat(),
-            'num_added': len(newly_generated_takes_meta),
-            'replaced': replace_existing,
-            'deleted_keys': deleted_r2_keys # Record keys that were deleted
-        }
+        # --- Upload Updated Line Metadata Shard to R2 (Overwrite) --- 
+        # Nothing added, deleted or filtered out means the shard would be rewritten
+        # unchanged apart from the annotation, so skip the PUT entirely.
+        # One clock read for both the metadata annotation and the job's completed_at
+        now_utc = datetime.now(timezone.utc)
+        metadata_changed = bool(newly_generated_takes_meta) or bool(deleted_r2_keys) or len(new_metadata_takes) != len(original_takes)
+        if metadata_changed:
+            line_meta = {
+                'line': line_key,
+                'takes': new_metadata_takes,
+                'last_regenerated_line': {
+                    'line': line_key,
+                    'at': now_utc.isoformat(),
+                    'num_added': len(newly_generated_takes_meta),
+                    'replaced': replace_existing,
+                    'deleted_keys': deleted_r2_keys # Record keys that were deleted
+                }
+            }
         
-        try:
-            metadata_bytes = json.dumps(metadata, indent=2).encode('utf-8')
-            meta_upload_success = utils_r2.upload_blob(
-                blob_name=metadata_blob_key,
-                data=metadata_bytes,
-                content_type='application/json'
-            )
-            if not meta_upload_success:
-                raise Exception(f"Failed to re-upload metadata {metadata_blob_key} to R2.")
-            print(f"[Task ID: {task_id}] Uploaded updated metadata for batch {batch_id} after regenerating line {line_key}.")
-        except Exception as e:
-             # If metadata upload fails, this is serious
-             status_msg = f'ERROR re-uploading metadata to R2 for batch {batch_id}: {e}'
-             print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] {status_msg}")
-             self.update_state(state='FAILURE', meta={'status': status_msg, 'db_id': generation_job_db_id})
-             raise Retry(exc=e, countdown=60)
+            try:
+                if not utils_r2.save_line_meta(batch_id, line_key, line_meta):
+                    raise Exception(f"Failed to upload line metadata shard for '{line_key}' in {batch_id} to R2.")
+                print(f"[Task ID: {task_id}] Uploaded line metadata shard for batch {batch_id} after regenerating line {line_key}.")
+            except Exception as e:
+                 # If metadata upload fails, this is serious
+                 status_msg = f'ERROR re-uploading metadata to R2 for batch {batch_id}: {e}'
+                 print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] {status_msg}")
+                 self.update_state(state='FAILURE', meta={'status': status_msg, 'db_id': generation_job_db_id})
+                 raise Retry(exc=e, countdown=60)
+            # Fold the shard back into metadata.json off the critical path
+            compact_batch_metadata.delay(batch_id)
+        else:
+            print(f"[Task ID: {task_id}] No metadata changes, skipping re-upload.")
 
         # Update script in DB if requested (Keep existing logic)
         script_update_message = ""
         if update_script and len(newly_generated_takes_meta) > 0:
             if source_script_id is not None: # Check if source script ID exists
                 try:
-                    # Target ONLY the specific line in the source script
-                    script_line = db.query(models.ScriptLine).filter(
-                        models.ScriptLine.script_id == source_script_id,
-                        models.ScriptLine.line_key == line_key
+                    # Target ONLY the specific line in the source script; a single
+                    # UPDATE ... RETURNING, committed with the terminal job status below
+                    updated_line = db.execute(
+                        update(models.ScriptLine)
+                        .where(models.ScriptLine.script_id == source_script_id,
+                               models.ScriptLine.line_key == line_key)
+                        .values(text=line_text)
+                        .returning(models.ScriptLine.id)
                     ).first()
 
-                    if script_line:
-                        script_line.text = line_text
-                        db.commit()
-                        script = db.query(models.Script).get(source_script_id) # Get script name for message
-                        script_name = script.name if script else f"ID {source_script_id}"
+                    if updated_line is not None:
+                        # Prefer the name cached in batch metadata; only hit the DB if it's absent
+                        script_name = metadata.get('source_script_name') or db.scalar(
+                            select(models.Script.name).where(models.Script.id == source_script_id)
+                        ) or f"ID {source_script_id}"
                         script_update_message = f" Script '{script_name}' updated."
                         print(f"[Task ID: {task_id}] Updated script line '{line_key}' in source script: {script_name}")
                     else:
@@ -231,13 +326,13 @@ def regenerate_line_takes(self,
                 script_update_message = " Script not updated (original source was not a tracked script)."
                 print(f"[Task ID: {task_id}] Skipped script update for '{line_key}' because source_script_id was not found in metadata.")
 
+        models.record_takes(db, generation_job_db_id, batch_id, newly_generated_takes_meta, deleted_r2_keys)
+
         # --- Update DB Job --- 
         final_status = "SUCCESS" if failures == 0 else "COMPLETED_WITH_ERRORS" if failures < num_new_takes else "FAILURE"
         result_msg = f"Regenerated line '{line_key}'. Added {len(newly_generated_takes_meta)} takes ({failures} failures). Replaced: {replace_existing}. Deleted: {len(deleted_r2_keys)} keys.{script_update_message}"
         if final_status == "FAILURE": result_msg = f"Failed to regen any takes for '{line_key}' ({failures} failures).{script_update_message}"
-        db_job.status = final_status
-        db_job.completed_at = datetime.utcnow()
-        db_job.result_message = result_msg
+        _update_job(db, generation_job_db_id, status=final_status, completed_at=now_utc.replace(tzinfo=None), result_message=result_msg)
         db.commit()
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Updated job status to {final_status}.")
 
@@ -246,13 +341,15 @@ def regenerate_line_takes(self,
     except Exception as e:
         error_msg = f"Line regeneration task failed: {type(e).__name__}: {e}"
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] {error_msg}")
-        if db_job:
-            db_job.status = "FAILURE"; db_job.completed_at = datetime.utcnow(); db_job.result_message = error_msg
-            try: db.commit()
+        if job_found:
+            try:
+                _update_job(db, generation_job_db_id, status="FAILURE", completed_at=_utcnow_naive(), result_message=error_msg)
+                db.commit()
             except: db.rollback()
         self.update_state(state='FAILURE', meta={'status': error_msg, 'db_id': generation_job_db_id})
         raise e
     finally:
+        prefetch_pool.shutdown(wait=False, cancel_futures=True)
         db.close()
 
 @celery.task(bind=True, name='tasks.run_speech_to_speech_line')
@@ -260,48 +357,58 @@ def run_speech_to_speech_line(self,
                               generation_job_db_id: int,
                               batch_id: str, # This is now the BATCH PREFIX
                               line_key: str,
-                              source_audio_b64: str,
+                              source_audio_r2_key: str, # Scratch upload made by the enqueuing route
                               num_new_takes: int,
                               target_voice_id: str, # Target voice for STS
                               model_id: str, # STS model
                               settings_json: str,
-                              replace_existing: bool):
-    """Generates new takes for a line using STS, interacting with R2."""
+                              replace_existing: bool,
+                              source_audio_info: str | None = None): # Data-URI header, e.g. 'data:audio/wav'
+    """Generates new takes for a line using STS, interacting with R2.
+
+    The source audio is read once from source_audio_r2_key (not carried in the
+    broker message) and the scratch blob is deleted when the task finishes.
+    """
     task_id = self.request.id
     print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Received STS task for Prefix '{batch_id}', Line '{line_key}'")
 
     db: Session = next(models.get_db())
-    db_job = None
+    job_found = False
     metadata_blob_key = f"{batch_id}/metadata.json"
+    # Start the metadata, line-shard and source audio GETs now so they overlap the STARTED status write below
+    prefetch_pool = ThreadPoolExecutor(max_workers=3)
+    metadata_future = prefetch_pool.submit(utils_metadata_cache.load_batch_metadata, batch_id)
+    line_meta_future = prefetch_pool.submit(utils_r2.load_line_meta, batch_id, line_key)
+    source_audio_future = prefetch_pool.submit(utils_r2.download_blob_to_memory, source_audio_r2_key)
+    retrying = False
 
     try:
         # --- Update Job Status --- 
-        db_job = db.query(models.GenerationJob).filter(models.GenerationJob.id == generation_job_db_id).first()
-        if not db_job: raise Ignore("GenerationJob record not found.")
-        db_job.status = "STARTED"; db_job.started_at = datetime.utcnow(); db_job.celery_task_id = task_id
-        # Store target batch prefix and line key
-        db_job.target_batch_id = batch_id
-        db_job.target_line_key = line_key
+        # Also stores target batch prefix and line key
+        job_found = _update_job(db, generation_job_db_id,
+                                status="STARTED", started_at=_utcnow_naive(), celery_task_id=task_id,
+                                target_batch_id=batch_id, target_line_key=line_key)
+        if not job_found: raise Ignore("GenerationJob record not found.")
         db.commit()
         self.update_state(state='STARTED', meta={'status': f'Preparing STS for line: {line_key}', 'db_id': generation_job_db_id})
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Updated job status to STARTED.")
 
-        # --- Decode Audio & Settings --- 
-        try:
-            header, encoded = source_audio_b64.split(';base64,', 1)
-            audio_data_bytes = base64.b64decode(encoded)
-        except Exception as e:
-            raise ValueError(f"Failed to decode source audio base64 data: {e}") from e
+        # --- Load Source Audio & Settings --- 
+        # Read once and reused for every take
+        audio_data_bytes = source_audio_future.result()
+        if not audio_data_bytes:
+            raise ValueError(f"Source audio not found or failed to download: {source_audio_r2_key}")
+        header = source_audio_info
         
-        settings = json.loads(settings_json)
+        settings = orjson.loads(settings_json)
         sts_voice_settings = { key: settings.get(key) for key in ['stability', 'similarity_boost'] if settings.get(key) is not None }
 
         # --- Load Metadata from R2 --- 
-        print(f"[Task ID: {task_id}] Downloading metadata: {metadata_blob_key}")
-        metadata_bytes = utils_r2.download_blob_to_memory(metadata_blob_key)
-        if not metadata_bytes: raise ValueError(f"Metadata blob not found: {metadata_blob_key}")
-        try: metadata = json.loads(metadata_bytes.decode('utf-8'))
-        except json.JSONDecodeError as e: raise ValueError(f"Failed to parse metadata JSON: {e}")
+        print(f"[Task ID: {task_id}] Waiting for metadata: {metadata_blob_key}")
+        # Served from the ETag-keyed Redis cache when an earlier task already read this version
+        try: metadata = metadata_future.result()
+        except ValueError as e: raise ValueError(f"Failed to parse metadata JSON: {e}")
+        if not metadata: raise ValueError(f"Metadata blob not found: {metadata_blob_key}")
 
         # Extract needed info
         source_script_id = metadata.get('source_script_id') # Get the source script ID
@@ -310,127 +417,208 @@ def run_speech_to_speech_line(self,
         if not skin_name or not voice_folder_name: raise ValueError("Metadata missing skin/voice name.")
         takes_prefix = f"{batch_id}/takes/" # Base R2 prefix for takes
 
-        original_takes = metadata.get('takes', [])
-        new_metadata_takes = []
+        # STS only touches one line, so it reads and writes that line's shard
+        # rather than the whole batch file. Without a shard yet, seed it from metadata.json.
+        line_meta = line_meta_future.result()
+        if line_meta is not None:
+            original_takes = line_meta.get('takes', [])
+        else:
+            original_takes = [t for t in metadata.get('takes', []) if t.get('line') == line_key]
         deleted_r2_keys = []
-        start_take_num = 1
-        current_line_takes = [t for t in original_takes if t.get('line') == line_key]
+        new_metadata_takes, line_takes, start_take_num = _partition_line_takes(original_takes, line_key, replace_existing)
+
+        # A previous attempt of this task may already have uploaded takes (and
+        # deleted the old ones) before its metadata write failed.
+        checkpoint = _load_sts_checkpoint(task_id)
+        if checkpoint:
+            deleted_r2_keys = checkpoint.get('deleted_keys', [])
+            print(f"[...] Resuming from checkpoint: {len(checkpoint.get('takes', []))} STS takes already uploaded.")
         
-        if replace_existing:
+        if replace_existing and not checkpoint:
             print(f"[...] Replacing existing takes for line '{line_key}' before STS.")
             self.update_state(state='PROGRESS', meta={'status': f'Deleting old takes...', 'db_id': generation_job_db_id})
             
             # --- Delete existing blobs for this line in R2 --- 
-            prefix_to_delete = f"{takes_prefix}{line_key}_take_"
-            blobs_to_delete = utils_r2.list_blobs_in_prefix(prefix=prefix_to_delete)
-            deleted_count = 0
-            for blob_info in blobs_to_delete:
-                r2_key_to_delete = blob_info.get('Key')
-                if r2_key_to_delete:
-                    if utils_r2.delete_blob(r2_key_to_delete):
-                        deleted_r2_keys.append(r2_key_to_delete)
-                        deleted_count += 1
-                    else: print(f"[...] Warning: Failed to delete blob {r2_key_to_delete}")
-            print(f"[...] Deleted {deleted_count} existing take blobs for line '{line_key}'.")
-            new_metadata_takes = [t for t in original_takes if t.get('line') != line_key]
-        else:
-            new_metadata_takes = original_takes
-            if current_line_takes: start_take_num = max(t.get('take_number', 0) for t in current_line_takes) + 1
+            deleted_r2_keys.extend(_delete_line_takes(line_takes, takes_prefix, line_key))
+            print(f"[...] Deleted {len(deleted_r2_keys)} existing take blobs for line '{line_key}'.")
 
         # --- Generate New Takes via STS --- 
-        newly_generated_takes_meta = []
-        failures = 0
-        for i in range(num_new_takes):
-            take_num = start_take_num + i
-            self.update_state(state='PROGRESS', meta={
-                'status': f'Running STS take {take_num} for line: {line_key}',
-                'db_id': generation_job_db_id,
-                'progress': int(100 * (i + 1) / num_new_takes)
-            })
-            
+        newly_generated_takes_meta = list(checkpoint.get('takes', [])) if checkpoint else []
+        new_metadata_takes.extend(newly_generated_takes_meta)
+        done_take_numbers = {t.get('take_number') for t in newly_generated_takes_meta}
+        # Hoisted out of the loop: every STS take shares one settings dict (serialized once at the end)
+        base_gen_settings = {**settings, 'source_audio_info': header, 'sts_target_voice': target_voice_id}
+
+        def sts_take(take_num):
+            """STS round trip for one take; runs on the STS pool. Returns the audio bytes."""
+            result_audio_bytes = utils_elevenlabs.run_speech_to_speech_conversion(
+                audio_data=audio_data_bytes, # The decoded source audio
+                target_voice_id=target_voice_id,
+                model_id=model_id,
+                voice_settings=sts_voice_settings
+            )
+            if not result_audio_bytes: raise utils_elevenlabs.ElevenLabsError("STS returned empty audio data.")
+            return result_audio_bytes
+
+        def upload_take(take_num, result_audio_bytes):
+            """R2 upload for one take; runs on the upload pool. Returns the take's metadata."""
             output_filename = f"{line_key}_take_{take_num}.mp3" # Assuming mp3 output from STS
             r2_blob_key = f"{takes_prefix}{output_filename}"
-
-            try:
-                # Generate audio bytes via STS
-                result_audio_bytes = utils_elevenlabs.run_speech_to_speech_conversion(
-                    audio_data=audio_data_bytes, # The decoded source audio
-                    target_voice_id=target_voice_id,
-                    model_id=model_id,
-                    voice_settings=sts_voice_settings
-                )
-                if not result_audio_bytes: raise utils_elevenlabs.ElevenLabsError("STS returned empty audio data.")
-
-                # --- Upload result to R2 --- 
-                upload_success = utils_r2.upload_blob(
-                    blob_name=r2_blob_key,
-                    data=result_audio_bytes,
-                    content_type='audio/mpeg' # Assuming MP3 output from STS
-                )
-                if not upload_success: raise Exception(f"Failed to upload STS result {r2_blob_key} to R2.")
-                print(f"[...] Successfully uploaded STS audio to {r2_blob_key}")
-
-                # Add metadata for the new take
-                new_take_meta = {
-                    "file": output_filename,
-                    "r2_key": r2_blob_key,
-                    "line": line_key,
-                    "script_text": "[STS]", # Indicate generated via STS
-                    "take_number": take_num,
-                    "generation_settings": {**settings, 'source_audio_info': header, 'sts_target_voice': target_voice_id}, # Store STS settings
-                    "rank": None, "ranked_at": None
+            upload_success = utils_r2.upload_blob(
+                blob_name=r2_blob_key,
+                data=result_audio_bytes,
+                content_type='audio/mpeg' # Assuming MP3 output from STS
+            )
+            if not upload_success: raise Exception(f"Failed to upload STS result {r2_blob_key} to R2.")
+            print(f"[...] Successfully uploaded STS audio to {r2_blob_key}")
+
+            return {
+                "file": output_filename,
+                "r2_key": r2_blob_key,
+                "line": line_key,
+                "script_text": "[STS]", # Indicate generated via STS
+                "take_number": take_num,
+                "generation_settings": base_gen_settings, # Store STS settings
+                "rank": None, "ranked_at": None
+            }
+
+        # Each take is an independent STS round trip, so run them concurrently. Uploads go to
+        # their own pool so an STS worker starts its next take while the previous one uploads.
+        pending_take_numbers = [start_take_num + i for i in range(num_new_takes) if start_take_num + i not in done_take_numbers]
+        new_sts_takes = []
+        failures = 0
+        last_progress_ts = 0.0
+        if pending_take_numbers:
+            sts_workers = min(len(pending_take_numbers), STS_MAX_WORKERS)
+            with ThreadPoolExecutor(max_workers=sts_workers, thread_name_prefix='sts-take') as sts_pool, \
+                 ThreadPoolExecutor(max_workers=sts_workers, thread_name_prefix='sts-upload') as upload_pool:
+                futures = {sts_pool.submit(sts_take, take_num): take_num for take_num in pending_take_numbers}
+                upload_futures = {}
+                for done, future in enumerate(as_completed(futures), 1):
+                    take_num = futures[future]
+                    try:
+                        upload_futures[upload_pool.submit(upload_take, take_num, future.result())] = take_num
+                    except Exception as e:
+                        print(f"[...] ERROR generating STS take {take_num} for line '{line_key}': {e}")
+                        failures += 1
+                    # Throttle result-backend writes to ~1/sec (always report the last take)
+                    now = time.monotonic()
+                    if now - last_progress_ts >= PROGRESS_UPDATE_INTERVAL_SECONDS or done == len(futures):
+                        self.update_state(state='PROGRESS', meta={
+                            'status': f'Running STS take {take_num} for line: {line_key}',
+                            'db_id': generation_job_db_id,
+                            'progress': int(100 * done / len(futures))
+                        })
+                        last_progress_ts = now
+
+                for future in as_completed(upload_futures):
+                    try:
+                        new_sts_takes.append(future.result())
+                    except Exception as e:
+                        print(f"[...] ERROR uploading STS take {upload_futures[future]} for line '{line_key}': {e}")
+                        failures += 1
+
+        # Takes finish out of order; keep them in take-number order like the serial loop did
+        new_sts_takes.sort(key=lambda t: t['take_number'])
+        new_metadata_takes.extend(new_sts_takes)
+        newly_generated_takes_meta.extend(new_sts_takes)
+
+        # --- Upload Updated Line Metadata Shard to R2 (Overwrite) --- 
+        # Nothing added, deleted or filtered out means the shard would be rewritten
+        # unchanged apart from the annotation, so skip the PUT entirely.
+        # One clock read for both the metadata annotation and the job's completed_at
+        now_utc = datetime.now(timezone.utc)
+        metadata_changed = bool(newly_generated_takes_meta) or bool(deleted_r2_keys) or len(new_metadata_takes) != len(original_takes)
+        if metadata_changed:
+            line_meta = {
+                'line': line_key,
+                'takes': new_metadata_takes,
+                'last_regenerated_line': {
+                    'line': line_key,
+                    'at': now_utc.isoformat(),
+                    'num_added': len(newly_generated_takes_meta),
+                    'replaced': replace_existing,
+                    'type': 'sts',
+                    'deleted_keys': deleted_r2_keys
                 }
-                new_metadata_takes.append(new_take_meta)
-                newly_generated_takes_meta.append(new_take_meta)
+            }
+            if newly_generated_takes_meta:
+                _save_sts_checkpoint(task_id, newly_generated_takes_meta, deleted_r2_keys)
+            try:
+                if not utils_r2.save_line_meta(batch_id, line_key, line_meta):
+                    raise Exception(f"Failed to upload line metadata shard for '{line_key}' in {batch_id} to R2.")
+                print(f"[...] Uploaded line metadata shard for batch {batch_id} after STS for line {line_key}.")
             except Exception as e:
-                print(f"[...] ERROR generating/uploading STS take {r2_blob_key}: {e}")
-                failures += 1
+                retry_countdown = min(STS_RETRY_BASE_COUNTDOWN * 2 ** self.request.retries, STS_RETRY_MAX_COUNTDOWN)
+                print(f"[...] ERROR re-uploading metadata to R2 for batch {batch_id}: {e}. Retrying in {retry_countdown}s.")
+                # Re-enqueues this task (same task ID, so the checkpoint above is picked up);
+                # raises the original error once max_retries is exhausted.
+                raise self.retry(exc=e, countdown=retry_countdown)
+            _clear_sts_checkpoint(task_id)
+            # Fold the shard back into metadata.json off the critical path
+            compact_batch_metadata.delay(batch_id)
+        else:
+            print(f"[...] No metadata changes, skipping re-upload.")
 
-        # --- Upload Updated Metadata to R2 (Overwrite) --- 
-        metadata['takes'] = new_metadata_takes
-        metadata['last_regenerated_line'] = {
-            'line': line_key,
-            'at': datetime.now(timezone.utc).isoformat(),
-            'num_added': len(newly_generated_takes_meta),
-            'replaced': replace_existing,
-            'type': 'sts',
-            'deleted_keys': deleted_r2_keys
-        }
-        try:
-            metadata_bytes = json.dumps(metadata, indent=2).encode('utf-8')
-            meta_upload_success = utils_r2.upload_blob(
-                blob_name=metadata_blob_key,
-                data=metadata_bytes,
-                content_type='application/json'
-            )
-            if not meta_upload_success: raise Exception(f"Failed to re-upload metadata {metadata_blob_key} to R2.")
-            print(f"[...] Uploaded updated metadata for batch {batch_id} after STS for line {line_key}.")
-        except Exception as e:
-            status_msg = f'ERROR re-uploading metadata to R2 for batch {batch_id}: {e}'
-            print(f"[...] {status_msg}")
-            self.update_state(state='FAILURE', meta={'status': status_msg, 'db_id': generation_job_db_id})
-            raise Retry(exc=e, countdown=60)
+        models.record_takes(db, generation_job_db_id, batch_id, newly_generated_takes_meta, deleted_r2_keys)
 
         # --- Update DB Job --- 
         final_status = "SUCCESS" if failures == 0 else "COMPLETED_WITH_ERRORS" if failures < num_new_takes else "FAILURE"
         result_msg = f"STS for line '{line_key}' complete. Added {len(newly_generated_takes_meta)} takes ({failures} failures). Replaced: {replace_existing}. Deleted: {len(deleted_r2_keys)} keys."
         if final_status == "FAILURE": result_msg = f"STS failed for line '{line_key}'. ({failures} failures)."
-        db_job.status = final_status
-        db_job.completed_at = datetime.utcnow()
-        db_job.result_message = result_msg
+        _update_job(db, generation_job_db_id, status=final_status, completed_at=now_utc.replace(tzinfo=None), result_message=result_msg)
         db.commit()
         print(f"[...] Updated job status to {final_status}.")
 
         return {'status': final_status, 'message': result_msg}
 
+    except Retry:
+        retrying = True # The next attempt still needs the source audio
+        raise # Retry scheduled; leave the job STARTED for the next attempt
     except Exception as e:
         error_msg = f"STS line task failed: {type(e).__name__}: {e}"
         print(f"[...] {error_msg}")
-        if db_job: # Update DB if possible
-            db_job.status = "FAILURE"; db_job.completed_at = datetime.utcnow(); db_job.result_message = error_msg
-            try: db.commit()
+        if job_found: # Update DB if possible
+            try:
+                _update_job(db, generation_job_db_id, status="FAILURE", completed_at=_utcnow_naive(), result_message=error_msg)
+                db.commit()
             except: db.rollback()
         self.update_state(state='FAILURE', meta={'status': error_msg, 'db_id': generation_job_db_id})
         raise e # Re-raise
     finally:
-        db.close() 
\ No newline at end of file
+        prefetch_pool.shutdown(wait=False, cancel_futures=True)
+        if not retrying:
+            utils_r2.delete_blob(source_audio_r2_key)
+        db.close() 
+
+@celery.task(bind=True, name='tasks.compact_batch_metadata')
+def compact_batch_metadata(self, batch_id: str):
+    """Folds any per-line metadata shards back into the batch's metadata.json."""
+    task_id = self.request.id
+    metadata_blob_key = f"{batch_id}/metadata.json"
+
+    metadata_found = False
+    merged_shard_keys = {}
+
+    def fold_shards(metadata):
+        # Re-run on every conditional-PUT retry, against the freshly read metadata
+        nonlocal metadata_found, merged_shard_keys
+        metadata_found = True
+        merged_shard_keys = utils_r2.merge_line_meta_shards(batch_id, metadata)
+        return merged_shard_keys
+
+    # Conditional PUT, so a concurrent rank update or compaction isn't overwritten
+    written = utils_r2.update_json_blob(metadata_blob_key, fold_shards)
+    if not metadata_found:
+        print(f"[Task ID: {task_id}] Compaction skipped, metadata not found or unreadable: {metadata_blob_key}")
+        return {'status': 'SKIPPED', 'merged': 0}
+    if not merged_shard_keys:
+        return {'status': 'SUCCESS', 'merged': 0}
+    if written is None:
+        # Shards are left in place, so readers still see the latest takes
+        raise self.retry(exc=Exception(f"Failed to upload compacted metadata {metadata_blob_key} to R2."), countdown=30)
+    # Only delete the shard versions that were folded in: a line regenerated after the
+    # merge read its shard keeps the new shard for the next compaction
+    utils_r2.delete_blobs_if_unchanged(merged_shard_keys)
+    print(f"[Task ID: {task_id}] Compacted {len(merged_shard_keys)} line shards into {metadata_blob_key}")
+    return {'status': 'SUCCESS', 'merged': len(merged_shard_keys)}
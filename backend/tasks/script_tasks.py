@@ -7,11 +7,12 @@ from celery.utils.log import get_task_logger # Import Celery task logger
 from backend import models
 from backend import utils_voscript
 from backend.script_agents.script_writer import ScriptWriterAgent
-from celery import Task
+from celery import Task, chord
 from celery.exceptions import Ignore
 from sqlalchemy.orm import Session
 import json
-from datetime import datetime
+import orjson
+from datetime import datetime, timezone
 import os
 import logging
 import traceback
@@ -29,7 +30,8 @@ from backend.agents.script_collaborator_agent import (
 )
 from agents import Runner, ToolCallItem, ToolCallOutputItem, MessageOutputItem # Adjust imports as needed
 from typing import List, Dict, Any, Optional
-from sqlalchemy import desc # For ordering history
+from sqlalchemy import desc, func, select, update # For ordering history / Core job status updates
+from sqlalchemy.exc import SQLAlchemyError
 from backend.utils_openai import get_image_description # NEW: Import image description util
 
 # Get a logger for this module/task
@@ -64,18 +66,20 @@ def run_script_creation_agent(self,
     db_job = None
     try:
         # --- 1. Update Job Status to STARTED --- 
-        db_job = db.query(models.GenerationJob).filter(models.GenerationJob.id == generation_job_db_id).first()
+        db_job = db.get(models.GenerationJob, generation_job_db_id) # PK lookup via the identity map
         if not db_job:
             raise Ignore("GenerationJob record not found.")
         
         db_job.status = "STARTED"
-        db_job.started_at = datetime.utcnow()
+        db_job.started_at = datetime.now(timezone.utc).replace(tzinfo=None) # Naive UTC column
         db_job.celery_task_id = task_id
         # Store category name in job parameters if provided
         job_params = {}
+        original_params = None
         try: 
-            job_params = json.loads(db_job.parameters_json) if db_job.parameters_json else {}
-        except json.JSONDecodeError:
+            job_params = orjson.loads(db_job.parameters_json) if db_job.parameters_json else {}
+            original_params = dict(job_params)
+        except orjson.JSONDecodeError:
              logging.warning(f"[Task ID: {task_id}] Could not parse existing job parameters JSON.")
 
         job_params['task_type'] = task_type # Ensure task_type is always there
@@ -84,7 +88,9 @@ def run_script_creation_agent(self,
         if feedback_data: # Include feedback if provided
              job_params['feedback'] = feedback_data
              
-        db_job.parameters_json = json.dumps(job_params)
+        # The route usually stores these already; only rewrite the column if something changed
+        if job_params != original_params:
+            db_job.parameters_json = orjson.dumps(job_params).decode('utf-8')
         db.commit()
         self.update_state(state='STARTED', meta={'status': f'Agent task started ({task_type}, Category: {category_name or "All"})', 'db_id': generation_job_db_id})
         
@@ -127,9 +133,11 @@ def run_script_creation_agent(self,
              result_msg = f"Agent task '{task_type}' failed or produced no output for script {vo_script_id}. Last Output: {output_for_error}"
 
         # --- 6. Update Job Status --- 
-        db_job.status = final_status
-        db_job.completed_at = datetime.utcnow()
-        db_job.result_message = result_msg
+        db.execute(
+            update(models.GenerationJob)
+            .where(models.GenerationJob.id == generation_job_db_id)
+            .values(status=final_status, completed_at=datetime.now(timezone.utc).replace(tzinfo=None), result_message=result_msg)
+        )
         db.commit()
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Agent task finished. Updated job status to {final_status}.")
         
@@ -139,8 +147,13 @@ def run_script_creation_agent(self,
         error_msg = f"Script agent task failed unexpectedly: {type(e).__name__}: {e}"
         print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] {error_msg}")
         if db_job:
-            db_job.status = "FAILURE"; db_job.completed_at = datetime.utcnow(); db_job.result_message = error_msg
-            try: db.commit()
+            try:
+                db.execute(
+                    update(models.GenerationJob)
+                    .where(models.GenerationJob.id == generation_job_db_id)
+                    .values(status="FAILURE", completed_at=datetime.now(timezone.utc).replace(tzinfo=None), result_message=error_msg)
+                )
+                db.commit()
             except: db.rollback()
         self.update_state(state='FAILURE', meta={'status': error_msg, 'db_id': generation_job_db_id})
         raise e
@@ -155,51 +168,43 @@ def generate_category_lines(self,
                             target_model: str = None):
     """Celery task to generate all pending lines in a category together, ensuring variety."""
     task_id = self.request.id
-    print(f"[Task ID: {task_id}, DB ID: {generation_job_db_id}] Received category batch generation task.")
-    print(f"  VO Script ID: {vo_script_id}")
-    print(f"  Category Name: {category_name}")
-    print(f"  Target Model: {target_model or 'Default Model'}")
+    logger.info("[Task ID: %s, DB ID: %s] Received category batch generation task.", task_id, generation_job_db_id)
+    logger.info("VO Script ID: %s", vo_script_id)
+    logger.info("Category Name: %s", category_name)
+    logger.info("Target Model: %s", target_model or 'Default Model')
     
     db = None
-    db_job = None
+    job_found = False
     result = {
         "status": "FAILED",
         "message": "Task not processed",
-        "updated_lines": [],
+        "updated_count": 0,
         "errors": []
     }
     
     try:
-        db = next(models.get_db())
-        db_job = db.query(models.GenerationJob).get(generation_job_db_id)
+        db = models.TaskSession()
+        # Update job status to PROCESSING (a zero row count means the job record is missing)
+        job_found = _set_category_job_status(db, generation_job_db_id, "PROCESSING", started=True)
         
-        if not db_job:
-            print(f"[Task ID: {task_id}] ERROR: Could not find GenerationJob with ID {generation_job_db_id}")
+        if not job_found:
+            logger.error("[Task ID: %s] Could not find GenerationJob with ID %s", task_id, generation_job_db_id)
             result["message"] = f"Job record not found: {generation_job_db_id}"
             return result
         
-        # Update job status to PROCESSING
-        db_job.status = "PROCESSING"
-        db_job.started_at = datetime.now()
-        db.commit()
-        db.refresh(db_job)
-        
         # Get the VO Script to verify it exists
         vo_script = db.query(models.VoScript).get(vo_script_id)
         if not vo_script:
-            print(f"[Task ID: {task_id}] ERROR: VO Script with ID {vo_script_id} not found")
-            db_job.status = "FAILED"
-            db_job.completed_at = datetime.now()
-            db_job.result_message = f"VO Script with ID {vo_script_id} not found"
-            db.commit()
+            logger.error("[Task ID: %s] VO Script with ID %s not found", task_id, vo_script_id)
+            _set_category_job_status(db, generation_job_db_id, "FAILED", f"VO Script with ID {vo_script_id} not found")
             result["message"] = f"VO Script not found: {vo_script_id}"
             return result
             
-        print(f"[Task ID: {task_id}] Working with VO Script: {vo_script.name} (ID: {vo_script_id})")
+        logger.info("[Task ID: %s] Working with VO Script: %s (ID: %s)", task_id, vo_script.name, vo_script_id)
         
         # Find pending lines for this script that belong to the specified category
         # First, find the category ID based on the name
-        print(f"[Task ID: {task_id}] Finding pending lines for category '{category_name}' in script {vo_script_id}")
+        logger.info("[Task ID: %s] Finding pending lines for category '%s' in script %s", task_id, category_name, vo_script_id)
         
         # Get template category ID from VoScriptTemplateCategory
         template_category = db.query(models.VoScriptTemplateCategory).filter(
@@ -208,56 +213,51 @@ def generate_category_lines(self,
         
         if not template_category:
             # Try another approach - get directly from a line that has this category (using template_line relationship)
-            print(f"[Task ID: {task_id}] WARNING: Could not find template category '{category_name}' directly")
-            
-            # Query all lines and check their category through relationships
-            all_category_lines = []
-            all_lines = db.query(models.VoScriptLine).filter(
-                models.VoScriptLine.vo_script_id == vo_script_id
-            ).all()
+            logger.warning("[Task ID: %s] Could not find template category '%s' directly", task_id, category_name)
             
-            category_id = None
-            for line in all_lines:
-                if hasattr(line, 'template_line') and line.template_line:
-                    if hasattr(line.template_line, 'category') and line.template_line.category:
-                        if line.template_line.category.name == category_name:
-                            category_id = line.template_line.category.id
-                            break
+            # Find the category through the script's lines -> template lines, in one joined query
+            category_id = db.scalar(
+                select(models.VoScriptTemplateCategory.id)
+                .select_from(models.VoScriptLine)
+                .join(models.VoScriptLine.template_line)
+                .join(models.VoScriptTemplateLine.category)
+                .where(
+                    models.VoScriptLine.vo_script_id == vo_script_id,
+                    models.VoScriptTemplateCategory.name == category_name
+                )
+                .limit(1)
+            )
             
             if category_id is None:
-                print(f"[Task ID: {task_id}] ERROR: Could not find any lines with category '{category_name}'")
-                db_job.status = "FAILED"
-                db_job.completed_at = datetime.now()
-                db_job.result_message = f"Could not find any lines with category '{category_name}'"
-                db.commit()
+                logger.error("[Task ID: %s] Could not find any lines with category '%s'", task_id, category_name)
+                _set_category_job_status(db, generation_job_db_id, "FAILED", f"Could not find any lines with category '{category_name}'")
                 result["message"] = f"Category not found: {category_name}"
                 return result
                 
-            # Now filter by the found category_id
-            print(f"[Task ID: {task_id}] Found category ID {category_id} for '{category_name}' from existing lines")
-            pending_lines = db.query(models.VoScriptLine).filter(
-                models.VoScriptLine.vo_script_id == vo_script_id,
-                models.VoScriptLine.category_id == category_id,
-                models.VoScriptLine.status == "pending"
-            ).order_by(models.VoScriptLine.order_index).all()
+            logger.info("[Task ID: %s] Found category ID %s for '%s' from existing lines", task_id, category_id, category_name)
         else:
             # We found the category directly
             category_id = template_category.id
-            print(f"[Task ID: {task_id}] Found category ID {category_id} for '{category_name}'")
-            
-            # Get all pending lines with this category ID
-            pending_lines = db.query(models.VoScriptLine).filter(
+            logger.info("[Task ID: %s] Found category ID %s for '%s'", task_id, category_id, category_name)
+        
+        # Only the columns the prompt needs, as plain rows (no ORM objects or identity map)
+        pending_lines = db.execute(
+            select(
+                models.VoScriptLine.id,
+                models.VoScriptLine.line_key,
+                models.VoScriptLine.order_index,
+                models.VoScriptLine.prompt_hint
+            ).where(
                 models.VoScriptLine.vo_script_id == vo_script_id,
                 models.VoScriptLine.category_id == category_id,
                 models.VoScriptLine.status == "pending"
-            ).order_by(models.VoScriptLine.order_index).all()
+            ).order_by(models.VoScriptLine.order_index)
+            .execution_options(yield_per=1000)
+        ).all()
         
         if not pending_lines:
-            print(f"[Task ID: {task_id}] No pending lines found for category '{category_name}' in script {vo_script_id}")
-            db_job.status = "SUCCESS"
-            db_job.completed_at = datetime.now()
-            db_job.result_message = "No pending lines found for generation"
-            db.commit()
+            logger.info("[Task ID: %s] No pending lines found for category '%s' in script %s", task_id, category_name, vo_script_id)
+            _set_category_job_status(db, generation_job_db_id, "SUCCESS", "No pending lines found for generation")
             result["status"] = "SUCCESS"
             result["message"] = "No pending lines to process"
             return result
@@ -271,131 +271,65 @@ def generate_category_lines(self,
                 "order_index": line.order_index,
                 "context": line.prompt_hint or "No additional context provided"
             })
-            logging.info(f"Added line to contexts: id={line.id}, key={line.line_key}, status={line.status}")
+            logger.debug("Added line to contexts: id=%s, key=%s", line.id, line.line_key)
+        
+        # Everything downstream works from the plain dicts above (and the chord ships them to
+        # other workers), so drop the rows and ORM objects instead of pinning them for the whole task.
+        db.expunge_all()
+        del pending_lines, vo_script
         
         # Get model-related settings
         # Use target_model if provided, else use default from env
         model_to_use = target_model or os.getenv("OPENAI_MODEL", "gpt-4o")
-        print(f"[Task ID: {task_id}] Using model: {model_to_use}")
+        logger.info("[Task ID: %s] Using model: %s", task_id, model_to_use)
         
         # Call the batch generation function from vo_script_routes
-        from backend.routes.vo_script_routes import _generate_lines_batch
-        
-        # Existing lines not needed with context-based implementation
-        existing_lines = None
+        from backend.routes.vo_script_routes import (
+            _generate_lines_batch, _build_batch_prompt_prefix, _split_line_batches
+        )
         
         try:
-            print(f"[Task ID: {task_id}] Calling batch generation for {len(line_contexts)} lines")
+            batches = _split_line_batches(line_contexts)
+            if len(batches) > 1:
+                # Large category: fan the sub-batches out as separate tasks so the whole worker
+                # pool can work on them. This task is replaced by the chord, so its task ID
+                # (which the frontend polls) resolves to finalize_category_lines' result.
+                logger.info("[Task ID: %s] Dispatching chord of %s sub-batch tasks for %s lines", task_id, len(batches), len(line_contexts))
+                # Built once here and shipped with each sub-batch instead of being rebuilt per task
+                prompt_prefix = _build_batch_prompt_prefix(db, line_contexts[0])
+                header = [
+                    generate_category_sub_batch.s(generation_job_db_id, vo_script_id, batch, model_to_use, prompt_prefix)
+                    for batch in batches
+                ]
+                raise self.replace(chord(header, finalize_category_lines.s(generation_job_db_id)))
+            
+            logger.info("[Task ID: %s] Calling batch generation for %s lines", task_id, len(line_contexts))
             generated_batch = _generate_lines_batch(
                 db=db,
                 script_id=vo_script_id, 
                 pending_lines=line_contexts,
-                existing_lines=existing_lines,
                 target_model=model_to_use
             )
             
             if not generated_batch:
-                print(f"[Task ID: {task_id}] Batch generation returned no results")
-                db_job.status = "FAILED"
-                db_job.completed_at = datetime.now()
-                db_job.result_message = "Batch generation returned no results"
-                db.commit()
+                logger.warning("[Task ID: %s] Batch generation returned no results", task_id)
+                _set_category_job_status(db, generation_job_db_id, "FAILED", "Batch generation returned no results")
                 result["message"] = "Batch generation failed to return results"
                 return result
             
-            # Log complete result of batch generation
-            print(f"[Task ID: {task_id}] Generated batch result: {generated_batch}")
-            
-            # Update the database with the generated lines
-            print(f"[Task ID: {task_id}] Processing {len(generated_batch)} generated lines")
+            updated_count, error_lines = _persist_generated_lines(db, generation_job_db_id, generated_batch, line_contexts, task_id)
+            job_status, job_message = _apply_category_outcome(result, updated_count, error_lines)
+            _set_category_job_status(db, generation_job_db_id, job_status, job_message)
             
-            # Track updated line IDs
-            updated_lines = []
-            error_lines = []
-            
-            for gen_item in generated_batch:
-                try:
-                    line_id = gen_item.get("line_id")
-                    generated_text = gen_item.get("generated_text")
-                    
-                    print(f"[Task ID: {task_id}] Processing generated item: {gen_item}")
-                    
-                    if not line_id or not generated_text:
-                        print(f"[Task ID: {task_id}] Skipping invalid generated item: {gen_item}")
-                        error_lines.append({
-                            "line_id": line_id,
-                            "error": "Missing line_id or generated_text in result"
-                        })
-                        continue
-                    
-                    # Update the line in the database
-                    line = db.query(models.VoScriptLine).get(line_id)
-                    if not line:
-                        print(f"[Task ID: {task_id}] Could not find line with ID {line_id}")
-                        error_lines.append({
-                            "line_id": line_id,
-                            "error": "Line not found in database"
-                        })
-                        continue
-                    
-                    line.generated_text = generated_text
-                    line.status = "generated"
-                    line.generated_at = datetime.now()
-                    db.commit()
-                    db.refresh(line)
-                    
-                    updated_lines.append({
-                        "id": line.id,
-                        "line_key": line.line_key,
-                        "text": line.generated_text
-                    })
-                    print(f"[Task ID: {task_id}] Updated line {line.id} ({line.line_key})")
-                    
-                except Exception as line_err:
-                    print(f"[Task ID: {task_id}] Error updating line: {line_err}")
-                    if 'line_id' in locals():
-                        error_lines.append({
-                            "line_id": line_id,
-                            "error": str(line_err)
-                        })
-                    else:
-                        error_lines.append({
-                            "error": f"Error processing generated item: {str(line_err)}"
-                        })
-            
-            # Update the job record
-            if error_lines and not updated_lines:
-                db_job.status = "FAILED"
-                db_job.result_message = f"Failed to update any lines. Errors: {len(error_lines)}"
-                result["status"] = "FAILED"
-                result["message"] = f"No lines were successfully updated"
-            elif error_lines:
-                db_job.status = "COMPLETED_WITH_ERRORS"
-                db_job.result_message = f"Updated {len(updated_lines)} lines with {len(error_lines)} errors"
-                result["status"] = "PARTIAL_SUCCESS"
-                result["message"] = f"Updated {len(updated_lines)} lines with {len(error_lines)} errors"
-            else:
-                db_job.status = "SUCCESS"
-                db_job.result_message = f"Successfully updated {len(updated_lines)} lines"
-                result["status"] = "SUCCESS"
-                result["message"] = f"Successfully updated all {len(updated_lines)} lines"
-            
-            db_job.completed_at = datetime.now()
-            db.commit()
-            
-            # Prepare the result data
-            result["updated_lines"] = updated_lines
-            result["errors"] = error_lines
-            
-            print(f"[Task ID: {task_id}] Task completed with status: {result['status']}")
+            logger.info("[Task ID: %s] Task completed with status: %s", task_id, result['status'])
             return result
             
+        except Ignore:
+            raise
         except Exception as gen_err:
-            print(f"[Task ID: {task_id}] Error during batch generation: {gen_err}")
-            db_job.status = "FAILED"
-            db_job.completed_at = datetime.now()
-            db_job.result_message = f"Batch generation error: {str(gen_err)}"
-            db.commit()
+            logger.error("[Task ID: %s] Error during batch generation: %s", task_id, gen_err)
+            db.rollback()
+            _set_category_job_status(db, generation_job_db_id, "FAILED", f"Batch generation error: {str(gen_err)}")
             
             result["message"] = f"Error during batch generation: {str(gen_err)}"
             # Include traceback for debugging
@@ -405,17 +339,17 @@ def generate_category_lines(self,
             })
             return result
     
+    except Ignore:
+        raise
     except Exception as e:
-        print(f"[Task ID: {task_id}] Task exception: {e}")
+        logger.error("[Task ID: %s] Task exception: %s", task_id, e)
         # If we have a db session and job, try to update it
         try:
-            if db and db_job:
-                db_job.status = "FAILED"
-                db_job.completed_at = datetime.now()
-                db_job.result_message = f"Task error: {str(e)}"
-                db.commit()
-        except Exception as db_err:
-            print(f"[Task ID: {task_id}] Failed to update job status after error: {db_err}")
+            if db and job_found:
+                db.rollback()
+                _set_category_job_status(db, generation_job_db_id, "FAILED", f"Task error: {str(e)}")
+        except SQLAlchemyError as db_err:
+            logger.error("[Task ID: %s] Failed to update job status after error: %s", task_id, db_err)
         
         # Include traceback for debugging
         result["message"] = f"Task error: {str(e)}"
@@ -426,13 +360,159 @@ def generate_category_lines(self,
         return result
     
     finally:
-        # Ensure database session is closed
+        # Return the connection to the pool and drop this thread's session
         if db:
             try:
-                db.close()
-                print(f"[Task ID: {task_id}] Database session closed")
-            except:
-                pass 
+                models.TaskSession.remove()
+                logger.info("[Task ID: %s] Database session released", task_id)
+            except SQLAlchemyError:
+                pass
+
+def _persist_generated_lines(db: Session, generation_job_db_id: int, generated_batch: list, line_contexts: list, task_id: str) -> tuple[int, list]:
+    """Writes a batch of generated lines with one executemany UPDATE and bumps the job's
+    processed_count in the same commit, so finished sub-batches survive a crash.
+
+    Returns:
+        (number of lines updated, list of per-line error dicts)
+    """
+    # Generated IDs always come from line_contexts, so anything else is unexpected
+    pending_ids = {ctx["id"] for ctx in line_contexts}
+    line_mappings = []
+    error_lines = []
+    for gen_item in generated_batch:
+        line_id = gen_item.get("line_id")
+        generated_text = gen_item.get("generated_text")
+        
+        if not line_id or not generated_text:
+            logger.warning("[Task ID: %s] Skipping invalid generated item: %s", task_id, gen_item)
+            error_lines.append({
+                "line_id": line_id,
+                "error": "Missing line_id or generated_text in result"
+            })
+            continue
+        
+        if line_id not in pending_ids:
+            logger.warning("[Task ID: %s] Generated line ID %s was not part of this category's pending lines", task_id, line_id)
+            error_lines.append({
+                "line_id": line_id,
+                "error": "Line is not a pending line in this category"
+            })
+            continue
+        
+        line_mappings.append({
+            "id": line_id,
+            "generated_text": generated_text,
+            "status": "generated"
+        })
+    
+    if line_mappings:
+        db.bulk_update_mappings(models.VoScriptLine, line_mappings)
+        db.execute(
+            update(models.GenerationJob)
+            .where(models.GenerationJob.id == generation_job_db_id)
+            .values(processed_count=func.coalesce(models.GenerationJob.processed_count, 0) + len(line_mappings))
+        )
+        db.commit()
+        logger.info("[Task ID: %s] Saved %s generated lines", task_id, len(line_mappings))
+    return len(line_mappings), error_lines
+
+def _apply_category_outcome(result: dict, updated_count: int, error_lines: list) -> tuple[str, str]:
+    """Fills in the task result's status/message from the category's totals.
+
+    Returns:
+        (job status, job result message) for the GenerationJob row
+    """
+    if error_lines and not updated_count:
+        job_status, job_message = "FAILED", f"Failed to update any lines. Errors: {len(error_lines)}"
+        result["status"] = "FAILED"
+        result["message"] = f"No lines were successfully updated"
+    elif error_lines:
+        job_status, job_message = "COMPLETED_WITH_ERRORS", f"Updated {updated_count} lines with {len(error_lines)} errors"
+        result["status"] = "PARTIAL_SUCCESS"
+        result["message"] = f"Updated {updated_count} lines with {len(error_lines)} errors"
+    else:
+        job_status, job_message = "SUCCESS", f"Successfully updated {updated_count} lines"
+        result["status"] = "SUCCESS"
+        result["message"] = f"Successfully updated all {updated_count} lines"
+    result["updated_count"] = updated_count
+    result["errors"] = error_lines
+    return job_status, job_message
+
+def _set_category_job_status(db: Session, generation_job_db_id: int, status: str, message: str = None, started: bool = False) -> bool:
+    """Writes a category job's status in one UPDATE and commits it.
+
+    Stamps started_at when started is set, otherwise completed_at, using the database clock.
+    Returns False if no job row matched.
+    """
+    values = {"status": status}
+    if started:
+        values["started_at"] = func.now()
+    else:
+        values["completed_at"] = func.now()
+        values["result_message"] = message
+    rowcount = db.execute(
+        update(models.GenerationJob)
+        .where(models.GenerationJob.id == generation_job_db_id)
+        .values(**values)
+    ).rowcount
+    db.commit()
+    return rowcount > 0
+
+@celery.task(bind=True, name='tasks.generate_category_sub_batch')
+def generate_category_sub_batch(self, generation_job_db_id: int, vo_script_id: int, line_contexts: list, target_model: str, prompt_prefix: str = None) -> dict:
+    """Chord member of generate_category_lines: generates and saves one sub-batch of lines.
+
+    Never raises, so one failed sub-batch can't stop finalize_category_lines from running.
+    """
+    task_id = self.request.id
+    logger.info("[Task ID: %s, DB ID: %s] Generating sub-batch of %s lines", task_id, generation_job_db_id, len(line_contexts))
+    from backend.routes.vo_script_routes import _generate_lines_batch
+    
+    db = models.TaskSession()
+    try:
+        # A redelivered sub-batch (worker lost mid-run) only regenerates lines that weren't saved yet
+        still_pending = set(db.scalars(
+            select(models.VoScriptLine.id).where(
+                models.VoScriptLine.id.in_([ctx["id"] for ctx in line_contexts]),
+                models.VoScriptLine.status == "pending"
+            )
+        ))
+        if len(still_pending) < len(line_contexts):
+            logger.info("[Task ID: %s] Skipping %s lines already generated", task_id, len(line_contexts) - len(still_pending))
+            line_contexts = [ctx for ctx in line_contexts if ctx["id"] in still_pending]
+            if not line_contexts:
+                return {"updated_count": 0, "errors": []}
+        generated_batch = _generate_lines_batch(db, vo_script_id, line_contexts, target_model, prompt_prefix)
+        updated_count, error_lines = _persist_generated_lines(db, generation_job_db_id, generated_batch, line_contexts, task_id)
+        return {"updated_count": updated_count, "errors": error_lines}
+    except Exception as e:
+        logger.error("[Task ID: %s] Sub-batch failed: %s", task_id, e)
+        db.rollback()
+        return {"updated_count": 0, "errors": [{"line_id": ctx["id"], "error": str(e)} for ctx in line_contexts]}
+    finally:
+        models.TaskSession.remove()
+
+@celery.task(bind=True, name='tasks.finalize_category_lines')
+def finalize_category_lines(self, sub_batch_results: list, generation_job_db_id: int) -> dict:
+    """Chord callback of generate_category_lines: totals the sub-batches and records the job's final status."""
+    task_id = self.request.id
+    updated_count = sum(r.get("updated_count", 0) for r in sub_batch_results)
+    error_lines = [err for r in sub_batch_results for err in r.get("errors", [])]
+    logger.info("[Task ID: %s, DB ID: %s] Finalizing category: %s updated, %s errors", task_id, generation_job_db_id, updated_count, len(error_lines))
+    
+    result = {"status": "FAILED", "message": "", "updated_count": 0, "errors": []}
+    db = models.TaskSession()
+    try:
+        job_status, job_message = _apply_category_outcome(result, updated_count, error_lines)
+        if not _set_category_job_status(db, generation_job_db_id, job_status, job_message):
+            logger.error("[Task ID: %s] Could not find GenerationJob with ID %s", task_id, generation_job_db_id)
+            result["status"] = "FAILED"
+            result["message"] = f"Job record not found: {generation_job_db_id}"
+            return result
+        logger.info("[Task ID: %s] Task completed with status: %s", task_id, result['status'])
+        return result
+    finally:
+        models.TaskSession.remove()
 
 @celery.task(bind=True, name='run_script_collaborator_chat')
 def run_script_collaborator_chat_task(self, script_id: int, user_message: str, 
@@ -483,6 +563,8 @@ def run_script_collaborator_chat_task(self, script_id: int, user_message: str,
             for record in history_records
         ]
         logger.info(f"Loaded {len(db_history_messages)} messages from DB history for script {script_id}.")
+        # Release the connection while the agent runs; saving history below checks one out again
+        db.commit()
         
         full_input_history = []
         full_input_history.append({"role": "system", "content": f"Current context is for Script ID: {script_id}"})
@@ -1033,4 +1033,44 @@ def test_add_line_category_not_found(mock_get_db, test_client):
     assert response.status_code == 404
     assert "Category 'BadCat' not found" in response.get_json()['error']
 
-# ... rest of tests ... 
\ No newline at end of file
+# ... rest of tests ... 
+@mock.patch('backend.routes.vo_script_routes.LINES_BATCH_CACHE_ENABLED', True)
+@mock.patch('backend.routes.vo_script_routes._create_lines_batch_completion')
+@mock.patch('backend.routes.vo_script_routes._prepare_lines_batch')
+@mock.patch('backend.utils_redis.get_redis_client')
+def test_generate_lines_batch_waiter_does_not_release_owners_claim(mock_get_redis, mock_prepare, mock_create):
+    """A caller that lost the in-flight claim and gave up waiting must not delete the owner's claim."""
+    redis_client = MagicMock()
+    redis_client.get.return_value = None # No cached answer ever appears
+    redis_client.set.return_value = None # SET NX fails: another worker owns the request
+    mock_get_redis.return_value = redis_client
+    mock_prepare.return_value = ([], [{'id': 1, 'line_key': 'L1'}], 'prompt', 'gpt-test')
+    mock_create.return_value.choices = [MagicMock(message=MagicMock(content='{"L1": "Hi"}'))]
+
+    with mock.patch('time.sleep') as mock_sleep:
+        vo_script_routes._generate_lines_batch(MagicMock(), 1, [], 'gpt-test',
+                                               inflight_wait_polls=vo_script_routes.LINES_INFLIGHT_WEB_WAIT_POLLS)
+
+    assert mock_sleep.call_count == vo_script_routes.LINES_INFLIGHT_WEB_WAIT_POLLS
+    mock_create.assert_called_once()
+    redis_client.eval.assert_not_called()
+    redis_client.delete.assert_not_called()
+
+
+@mock.patch('backend.routes.vo_script_routes._create_lines_batch_completion')
+@mock.patch('backend.routes.vo_script_routes._prepare_lines_batch')
+@mock.patch('backend.utils_redis.get_redis_client')
+def test_generate_lines_batch_skips_redis_when_cache_disabled(mock_get_redis, mock_prepare, mock_create):
+    """With LINES_BATCH_CACHE_ENABLED off (the default) every run calls OpenAI and nothing is cached or claimed."""
+    redis_client = MagicMock()
+    mock_get_redis.return_value = redis_client
+    mock_prepare.return_value = ([], [{'id': 1, 'line_key': 'L1'}], 'prompt', 'gpt-test')
+    mock_create.return_value.choices = [MagicMock(message=MagicMock(content='{"L1": "Hi"}'))]
+
+    with mock.patch.object(vo_script_routes, 'LINES_BATCH_CACHE_ENABLED', False):
+        vo_script_routes._generate_lines_batch(MagicMock(), 1, [], 'gpt-test')
+
+    mock_create.assert_called_once()
+    redis_client.get.assert_not_called()
+    redis_client.set.assert_not_called()
+    redis_client.setex.assert_not_called()
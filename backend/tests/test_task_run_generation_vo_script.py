@@ -29,6 +29,11 @@ def create_mock_voscriptline(id, key, text, status, order_idx=None, template_lin
     line.vo_script.name = "Test VO Script"
     return line
 
+def as_line_row(line):
+    """The plain row run_generation selects for a line (id, keys, text, script name)."""
+    return mock.Mock(id=line.id, line_key=line.line_key, generated_text=line.generated_text,
+                     template_line_key=line.template_line.line_key, vo_script_name=line.vo_script.name)
+
 # Example lines for mocking DB response
 mock_db_lines = [
     create_mock_voscriptline(10, "KEY_GEN_DIRECT", "Generated Text", "generated", order_idx=1), # Has direct key
@@ -131,6 +136,10 @@ def mock_db_session(mocker):
             return mocker.MagicMock()
             
     mock_session.query.side_effect = query_side_effect
+    # The line fetch is a Core select: db.execute(...).all() returns plain rows
+    mock_session.execute.return_value = mock_line_orderby
+    # The task loads its job by primary key
+    mock_session.get.side_effect = lambda model_cls, pk: get_job_mock() if model_cls == models.GenerationJob else None
 
     # Make SessionLocal return the mock session
     mocker.patch('backend.models.SessionLocal', return_value=mock_session)
@@ -160,11 +169,12 @@ def mock_task_base(mocker):
 
 # --- Tests for run_generation (Updated) --- #
 
+@mock.patch('backend.utils_r2.upload_stream')
 @mock.patch('backend.utils_r2.upload_blob')
-@mock.patch('backend.utils_elevenlabs.generate_tts_audio_bytes')
+@mock.patch('backend.utils_elevenlabs.generate_tts_audio_stream')
 @mock.patch('backend.utils_elevenlabs.get_available_voices')
 def test_run_generation_success_vo_script(
-    mock_get_voices, mock_generate_tts, mock_upload_blob,
+    mock_get_voices, mock_generate_tts, mock_upload_blob, mock_upload_stream,
     mock_db_session, mock_task_base
 ):
     """Test successful run using VO Script ID."""
@@ -175,12 +185,14 @@ def test_run_generation_success_vo_script(
 
     # --- Configure mocks returned BY THE FIXTURE --- 
     valid_lines = [l for l in mock_db_lines if l.status in ['generated', 'manual', 'review'] and l.generated_text]
-    line_query_mock.all.return_value = valid_lines
+    line_query_mock.all.return_value = [as_line_row(l) for l in valid_lines]
     
     # Configure other mocks
     mock_get_voices.return_value = [{'voice_id': 'voice1', 'name': 'Voice One'}]
-    mock_generate_tts.return_value = b"audio_data"
-    mock_upload_blob.return_value = True # Simulate successful upload
+    mock_generate_tts.return_value = mock.Mock(raw=mock.Mock()) # Open streamed response
+    mock_upload_stream.return_value = True # Simulate successful take upload
+    mock_upload_blob.return_value = True # Simulate successful metadata upload
+    utils_elevenlabs.clear_voice_cache()
 
     config_str = json.dumps(base_generation_config)
     vo_script_id_to_run = 1
@@ -197,6 +209,11 @@ def test_run_generation_success_vo_script(
     assert mock_db_job_obj.status == "SUCCESS" # Status should be updated on the mock instance now
     assert mock_db_job_obj.result_message.startswith("Generation complete.")
     assert json.loads(mock_db_job_obj.result_batch_ids_json)[0].startswith("TestSkin/Voice One-voice1/")
+    # The voice's takes are indexed with one multi-row INSERT into the takes table
+    take_rows = [c.args[1] for c in mock_session.execute.call_args_list if len(c.args) == 2]
+    assert len(take_rows) == 1
+    assert len(take_rows[0]) == len(valid_lines) * base_generation_config['variants_per_line']
+    assert take_rows[0][0]['batch_prefix'].startswith("TestSkin/Voice One-voice1/")
 
     # Check Celery State Update
     mock_update_state.assert_any_call(state='STARTED', meta=mock.ANY)
@@ -211,18 +228,21 @@ def test_run_generation_success_vo_script(
 
     # Check TTS calls (Should match number of valid lines)
     assert mock_generate_tts.call_count == len(expected_script_data)
-    # Verify text passed corresponds to the filtered/ordered lines (ORDER IS BY ID)
-    for i, expected_line in enumerate(expected_script_data):
-        assert mock_generate_tts.call_args_list[i][1]['text'] == expected_line['Line']
+    # Takes run on a thread pool, so only the set of texts is deterministic, not call order
+    assert sorted(c.kwargs['text'] for c in mock_generate_tts.call_args_list) == \
+        sorted(line['Line'] for line in expected_script_data)
 
-    # Check R2 Uploads (Num valid lines + 1 metadata)
-    assert mock_upload_blob.call_count == len(expected_script_data) + 1
+    # Check R2 Uploads (takes are streamed, metadata is a single upload)
+    assert mock_upload_stream.call_count == len(expected_script_data)
+    assert mock_upload_blob.call_count == 1
     # Check metadata includes source_vo_script_id
     meta_upload_call = [c for c in mock_upload_blob.call_args_list if 'metadata.json' in c[1]['blob_name']][0]
-    saved_metadata = json.loads(meta_upload_call[1]['data'].decode('utf-8'))
+    saved_metadata = utils_r2.loads_json_blob(meta_upload_call[1]['data']) # zstd or plain JSON
     assert saved_metadata['source_vo_script_id'] == vo_script_id_to_run
     assert saved_metadata['source_vo_script_name'] == "Test VO Script"
     assert len(saved_metadata['takes']) == len(expected_script_data)
+    # The task sorts takes back into script order (by line ID) before saving
+    assert [t['script_text'] for t in saved_metadata['takes']] == [line['Line'] for line in expected_script_data]
 
 
 @mock.patch('backend.utils_r2.upload_blob')
@@ -398,5 +398,23 @@ def test_regenerate_line_takes_success_replace(
 
 # ... other tests for regenerate_line_takes ...
 
+def test_compact_batch_metadata_keeps_shard_rewritten_by_concurrent_regen(mocker, mock_task_base):
+    """A shard regenerated after compaction read it is folded in later, not deleted."""
+    batch = "Skin/Voice-v1/batch1"
+    metadata = {'takes': [{'line': 'L1', 'file': 'L1_take_1.mp3'}]}
+    shard = {'line': 'L1', 'takes': [{'line': 'L1', 'file': 'L1_take_2.mp3'}]}
+    mocker.patch('backend.utils_r2.update_json_blob', side_effect=lambda key, mutate: mutate(metadata) and '"m2"')
+    mocker.patch('backend.utils_r2.list_blobs_in_prefix', return_value=[{'Key': f"{batch}/lines/L1.json"}])
+    mocker.patch('backend.utils_r2.download_blob_with_etag', return_value=(json.dumps(shard).encode(), '"s1"'))
+    # regenerate_line_takes rewrote the shard after the merge read it
+    mocker.patch('backend.utils_r2.get_blob_etag', return_value='"s2"')
+    mock_bulk = mocker.patch('backend.utils_r2.delete_blobs_bulk', return_value=[])
+
+    result = tasks.compact_batch_metadata.run(batch)
+
+    assert result == {'status': 'SUCCESS', 'merged': 1}
+    assert metadata['takes'] == shard['takes']
+    mock_bulk.assert_called_once_with([])
+
 # --- Tests for crop_audio_take --- #
 # ... tests for crop_audio_take ... 
\ No newline at end of file
@@ -120,7 +120,7 @@ class TaskSignatureTest(unittest.TestCase):
         self.assertIn('generation_job_db_id', params)
         self.assertIn('batch_id', params)
         self.assertIn('line_key', params)
-        self.assertIn('source_audio_b64', params)
+        self.assertIn('source_audio_r2_key', params)
         self.assertIn('num_new_takes', params)
         self.assertIn('target_voice_id', params)
         self.assertIn('model_id', params)
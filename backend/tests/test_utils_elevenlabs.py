@@ -8,7 +8,7 @@ from .. import utils_elevenlabs
 # --- Mocks ---
 
 # Mock successful requests.get for voices
-@mock.patch('requests.get')
+@mock.patch('backend.utils_elevenlabs._http.get')
 def test_get_available_voices_success(mock_get):
     """Test successful fetching of voices."""
     mock_response = mock.Mock()
@@ -33,7 +33,7 @@ def test_get_available_voices_success(mock_get):
     )
 
 # Mock requests.get raising an exception
-@mock.patch('requests.get')
+@mock.patch('backend.utils_elevenlabs._http.get')
 def test_get_available_voices_request_error(mock_get):
     """Test error during voice fetching."""
     mock_get.side_effect = requests.exceptions.RequestException("Connection error")
@@ -42,6 +42,22 @@ def test_get_available_voices_request_error(mock_get):
         with pytest.raises(utils_elevenlabs.ElevenLabsError, match="Error fetching voices"):
             utils_elevenlabs.get_available_voices()
 
+
+@mock.patch('backend.utils_elevenlabs.get_available_voices')
+def test_get_voice_map_is_cached(mock_get_voices):
+    """Voice map is fetched once and served from cache within the TTL."""
+    utils_elevenlabs.clear_voice_cache()
+    mock_get_voices.return_value = [{'voice_id': 'id1', 'name': 'Voice One'}]
+
+    with mock.patch.dict(os.environ, {'ELEVENLABS_API_KEY': 'fake_key'}):
+        first = utils_elevenlabs.get_voice_map()
+        second = utils_elevenlabs.get_voice_map()
+
+    assert first == {'id1': {'voice_id': 'id1', 'name': 'Voice One'}}
+    assert second is first
+    mock_get_voices.assert_called_once()
+    utils_elevenlabs.clear_voice_cache()
+
 # Test case where API key is missing
 def test_get_available_voices_no_api_key():
     """Test missing API key raises error."""
@@ -51,7 +67,7 @@ def test_get_available_voices_no_api_key():
             utils_elevenlabs.get_available_voices()
 
 # Mock successful requests.post for TTS generation
-@mock.patch('requests.post')
+@mock.patch('backend.utils_elevenlabs._http.post')
 @mock.patch('builtins.open', new_callable=mock.mock_open)
 @mock.patch('os.makedirs')
 def test_generate_tts_audio_success(mock_makedirs, mock_open_file, mock_post):
@@ -96,7 +112,7 @@ def test_generate_tts_audio_success(mock_makedirs, mock_open_file, mock_post):
 
 
 # Mock requests.post raising an exception
-@mock.patch('requests.post')
+@mock.patch('backend.utils_elevenlabs._http.post')
 def test_generate_tts_audio_failure(mock_post):
     """Test failure during TTS generation after retries."""
     mock_post.side_effect = requests.exceptions.RequestException("API Error")
@@ -112,7 +128,7 @@ def test_generate_tts_audio_failure(mock_post):
     assert mock_post.call_count == 3 # Check retries happened
 
 # Test rate limiting retry
-@mock.patch('requests.post')
+@mock.patch('backend.utils_elevenlabs._http.post')
 @mock.patch('time.sleep') # Mock time.sleep to avoid actual delay
 @mock.patch('builtins.open', new_callable=mock.mock_open)
 @mock.patch('os.makedirs')
@@ -141,4 +157,77 @@ def test_generate_tts_audio_rate_limit_retry(mock_makedirs, mock_open_file, mock
     assert mock_post.call_count == 2 # Called twice (initial fail, successful retry)
     mock_sleep.assert_called_once_with(5) # Check sleep was called with correct delay
     mock_open_file.assert_called_once_with(output_file, 'wb')
-    mock_open_file().write.assert_called_once_with(b'audio_after_retry') 
\ No newline at end of file
+    mock_open_file().write.assert_called_once_with(b'audio_after_retry') 
+
+
+@mock.patch('backend.utils_r2.upload_stream')
+@mock.patch('backend.utils_r2.copy_blob')
+@mock.patch('backend.utils_elevenlabs.generate_tts_audio_stream')
+def test_generate_tts_to_r2_cache_hit_skips_generation(mock_tts, mock_copy, mock_upload):
+    """With the TTS cache enabled, a cached render is copied instead of regenerated."""
+    mock_copy.return_value = True
+    settings = {'stability': 0.501234, 'use_speaker_boost': True}
+
+    with mock.patch.object(utils_elevenlabs, 'TTS_CACHE_ENABLED', True):
+        used, hit = utils_elevenlabs.generate_tts_to_r2('batch/takes/a_take_1.mp3', 'Hello!', 'voice1', settings, variant=1)
+
+    assert hit is True
+    assert used == {'stability': 0.5, 'use_speaker_boost': True}
+    mock_tts.assert_not_called()
+    mock_upload.assert_not_called()
+    cache_key = utils_elevenlabs.tts_cache_key('Hello!', 'voice1', utils_elevenlabs.DEFAULT_MODEL, 'mp3_44100_128', used, 1)
+    mock_copy.assert_called_once_with(cache_key, 'batch/takes/a_take_1.mp3')
+
+
+@mock.patch('backend.utils_elevenlabs._http.post')
+@mock.patch('time.sleep')
+def test_sts_retries_server_errors_with_backoff_but_not_client_errors(mock_sleep, mock_post):
+    """STS retries a 503 with exponential backoff and fails fast on a 400."""
+    throttled = mock.Mock(status_code=503)
+    ok = mock.Mock(status_code=200, content=b'audio')
+    mock_post.side_effect = [throttled, throttled, ok]
+    with mock.patch.dict(os.environ, {'ELEVENLABS_API_KEY': 'fake_key'}):
+        assert utils_elevenlabs.run_speech_to_speech_conversion(b'src', 'voice1', None, None) == b'audio'
+        assert [c.args[0] for c in mock_sleep.call_args_list] == [1.0, 2.0]
+
+        mock_post.reset_mock(side_effect=True)
+        mock_post.return_value = mock.Mock(status_code=400, text='bad audio')
+        with pytest.raises(utils_elevenlabs.ElevenLabsError):
+            utils_elevenlabs.run_speech_to_speech_conversion(b'src', 'voice1', None, None)
+    assert mock_post.call_count == 1
+
+
+@mock.patch('backend.utils_elevenlabs._http.post')
+@mock.patch('time.sleep')
+def test_tts_stream_honours_retry_after_and_fails_fast_on_client_errors(mock_sleep, mock_post):
+    """Streamed TTS waits out Retry-After on a 429, backs off on a 5xx and raises on a 400."""
+    throttled = mock.Mock(status_code=429, headers={'Retry-After': '7'})
+    unavailable = mock.Mock(status_code=502, headers={})
+    ok = mock.Mock(status_code=200)
+    mock_post.side_effect = [throttled, unavailable, ok]
+    with mock.patch.dict(os.environ, {'ELEVENLABS_API_KEY': 'fake_key'}):
+        assert utils_elevenlabs.generate_tts_audio_stream('Hi', 'voice1') is ok
+        assert [c.args[0] for c in mock_sleep.call_args_list] == [7.0, 4.0]
+
+        mock_post.reset_mock(side_effect=True)
+        mock_post.return_value = mock.Mock(status_code=400, text='bad voice')
+        with pytest.raises(utils_elevenlabs.ElevenLabsError):
+            utils_elevenlabs.generate_tts_audio_stream('Hi', 'voice1')
+    assert mock_post.call_count == 1
+
+
+def test_adaptive_concurrency_limiter_aimd():
+    """Limit halves on throttling and climbs back one step per run of successes."""
+    limiter = utils_elevenlabs.AdaptiveConcurrencyLimiter(max_limit=8, recovery_successes=2)
+
+    limiter.on_throttled()
+    limiter.on_throttled()
+    assert limiter.limit == 2
+
+    for _ in range(4):
+        limiter.on_success()
+    assert limiter.limit == 4
+
+    with limiter:
+        assert limiter._in_use == 1
+    assert limiter._in_use == 0
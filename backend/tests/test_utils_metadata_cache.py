@@ -0,0 +1,23 @@
+import orjson
+from unittest.mock import MagicMock
+
+from backend import utils_metadata_cache
+
+
+def test_load_batch_metadata_miss_then_hit(mocker):
+    """A miss downloads and caches under the read ETag; a hit skips the R2 download."""
+    store = {}
+    mock_redis = MagicMock()
+    mock_redis.get.side_effect = store.get
+    mock_redis.set.side_effect = lambda key, value, ex=None: store.__setitem__(key, value)
+    mocker.patch('backend.utils_redis.get_redis_client', return_value=mock_redis)
+    mocker.patch('backend.utils_r2.get_blob_etag', return_value='"abc"')
+    metadata = {'skin_name': 'Skin', 'voice_name': 'Voice', 'takes': []}
+    mock_download = mocker.patch('backend.utils_r2.download_blob_with_etag',
+                                 return_value=(orjson.dumps(metadata), '"abc"'))
+
+    assert utils_metadata_cache.load_batch_metadata('batch1') == metadata
+    assert utils_metadata_cache.load_batch_metadata('batch1') == metadata
+
+    mock_download.assert_called_once_with('batch1/metadata.json')
+    assert list(store) == ['batch-meta:batch1:abc']
@@ -105,6 +105,20 @@ def test_upload_blob_client_error(mock_env_and_boto):
     assert result is False
     mock_s3_client.put_object.assert_called_once()
 
+def test_upload_blob_large_payload_uses_parallel_multipart(mocker):
+    """Payloads past the multipart threshold go through upload_fileobj with the parallel config."""
+    mock_client = mocker.MagicMock()
+    mocker.patch('backend.utils_r2.get_r2_client', return_value=mock_client)
+    mocker.patch('backend.utils_r2.R2_BUCKET_NAME', BUCKET_NAME)
+    data = b"\0" * utils_r2.PARALLEL_TRANSFER_CONFIG.multipart_threshold
+
+    assert utils_r2.upload_blob("big.wav", data, "audio/wav") is True
+
+    mock_client.put_object.assert_not_called()
+    args, kwargs = mock_client.upload_fileobj.call_args
+    assert args[0].getvalue() == data and args[1:] == (BUCKET_NAME, "big.wav")
+    assert kwargs == {'ExtraArgs': {'ContentType': 'audio/wav'}, 'Config': utils_r2.PARALLEL_TRANSFER_CONFIG}
+
 def test_upload_blob_no_client(mocker):
     """Test upload failure if client cannot be created."""
     # Mock get_r2_client to return None
@@ -113,4 +127,67 @@ def test_upload_blob_no_client(mocker):
     assert result is False
 
 
-# --- Add tests for other functions (download_blob_to_memory, etc.) below --- 
\ No newline at end of file
+def test_delete_blobs_bulk_chunks_and_skips_errors(mocker):
+    """Bulk delete issues one DeleteObjects call per 1000 keys and drops failed keys."""
+    mock_s3_client = MagicMock()
+    mocker.patch('backend.utils_r2.get_r2_client', return_value=mock_s3_client)
+    mocker.patch('backend.utils_r2.R2_BUCKET_NAME', BUCKET_NAME)
+    keys = [f"batch/takes/line_take_{i}.mp3" for i in range(1001)]
+    mock_s3_client.delete_objects.side_effect = [
+        {'Errors': [{'Key': keys[0], 'Code': 'AccessDenied', 'Message': 'Denied'}]},
+        {},
+    ]
+
+    deleted = utils_r2.delete_blobs_bulk(keys)
+
+    assert mock_s3_client.delete_objects.call_count == 2
+    assert len(mock_s3_client.delete_objects.call_args_list[0].kwargs['Delete']['Objects']) == 1000
+    assert deleted == keys[1:]
+
+def test_delete_blobs_if_unchanged_keeps_rewritten_blobs(mocker):
+    """Only blobs whose current ETag still matches the merged version are deleted."""
+    current = {'b/lines/a.json': '"1"', 'b/lines/b.json': '"2-rewritten"'}
+    mocker.patch('backend.utils_r2.get_blob_etag', side_effect=current.get)
+    mock_bulk = mocker.patch('backend.utils_r2.delete_blobs_bulk', side_effect=lambda keys: keys)
+
+    deleted = utils_r2.delete_blobs_if_unchanged({'b/lines/a.json': '"1"', 'b/lines/b.json': '"2"'})
+
+    assert deleted == ['b/lines/a.json']
+    mock_bulk.assert_called_once_with(['b/lines/a.json'])
+
+def test_update_json_blob_retries_on_precondition_failed(mocker):
+    """A 412 from the conditional PUT re-reads the blob and reapplies the change."""
+    mock_s3_client = MagicMock()
+    mocker.patch('backend.utils_r2.get_r2_client', return_value=mock_s3_client)
+    mocker.patch('backend.utils_r2.R2_BUCKET_NAME', BUCKET_NAME)
+    mocker.patch('backend.utils_r2.time.sleep')
+    mocker.patch('backend.utils_r2.download_blob_with_etag', side_effect=[
+        (b'{"takes": [1]}', '"v1"'),
+        (b'{"takes": [1, 2]}', '"v2"'),
+    ])
+    precondition_failed = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'PreconditionFailed'}, 'ResponseMetadata': {'HTTPStatusCode': 412}}, 'PutObject')
+    mock_s3_client.put_object.side_effect = [precondition_failed, {}]
+
+    def add_take(doc):
+        doc['takes'].append(3)
+        return True
+
+    written = utils_r2.update_json_blob("batch/metadata.json", add_take)
+
+    assert written == {'takes': [1, 2, 3]}
+    assert mock_s3_client.put_object.call_args_list[0].kwargs['IfMatch'] == '"v1"'
+    assert mock_s3_client.put_object.call_args_list[1].kwargs['IfMatch'] == '"v2"'
+
+def test_json_blob_roundtrip_reads_plain_and_zstd(mocker):
+    """Compressed blobs round-trip and legacy plain JSON blobs still load."""
+    zstandard = pytest.importorskip("zstandard")
+    mocker.patch('backend.utils_r2.zstandard', zstandard)
+    doc = {'takes': [{'file': 'a_take_1.mp3', 'rank': None}]}
+
+    data, content_type = utils_r2.dumps_json_blob(doc)
+
+    assert content_type == 'application/zstd'
+    assert data.startswith(utils_r2.ZSTD_FRAME_MAGIC)
+    assert utils_r2.loads_json_blob(data) == doc
+    assert utils_r2.loads_json_blob(b'{"takes": []}') == {'takes': []}
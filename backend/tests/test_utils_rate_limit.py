@@ -0,0 +1,26 @@
+from unittest.mock import MagicMock
+
+from backend import utils_rate_limit
+
+
+def test_token_bucket_sleeps_for_reported_wait_then_retries(mocker):
+    """acquire() sleeps for the wait the script reports and clamps costs to capacity."""
+    script = MagicMock(side_effect=['1.5', '0'])
+    mock_redis = MagicMock()
+    mock_redis.register_script.return_value = script
+    mocker.patch('backend.utils_redis.get_redis_client', return_value=mock_redis)
+    mock_sleep = mocker.patch('time.sleep')
+
+    bucket = utils_rate_limit.RedisTokenBucket('ratelimit:test', rate=600, per=60)
+    bucket.acquire(1000)
+
+    mock_sleep.assert_called_once_with(1.5)
+    assert script.call_count == 2
+    script.assert_called_with(keys=['ratelimit:test'], args=[600.0, 10.0, 600.0])
+
+
+def test_token_bucket_fails_open_without_redis(mocker):
+    mocker.patch('backend.utils_redis.get_redis_client', return_value=None)
+    mock_sleep = mocker.patch('time.sleep')
+    utils_rate_limit.RedisTokenBucket('ratelimit:test', rate=10).acquire()
+    mock_sleep.assert_not_called()
@@ -1,15 +1,109 @@
 # backend/utils_elevenlabs.py
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import threading
 import json
+import hashlib
 from typing import List, Dict, Any, Optional, Tuple
+from backend import utils_r2, utils_rate_limit
 
 # Use V2 endpoint base FOR /voices, but keep V1 for TTS
 ELEVENLABS_API_V2_URL = "https://api.elevenlabs.io/v2"
 ELEVENLABS_API_V1_URL = "https://api.elevenlabs.io/v1" # Define V1 URL
 DEFAULT_MODEL = "eleven_multilingual_v2" # Or use a specific model if needed
 
+# Max pooled keep-alive connections to api.elevenlabs.io; defaults to cover the TTS worker pool
+ELEVENLABS_POOL_MAXSIZE = int(os.getenv('ELEVENLABS_POOL_MAXSIZE', max(32, int(os.getenv('TTS_MAX_WORKERS', '8')))))
+
+# One Session per process so TCP/TLS connections are reused across calls instead of
+# being re-established per request. Call-level retry loops below stay as they were.
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(pool_connections=ELEVENLABS_POOL_MAXSIZE, pool_maxsize=ELEVENLABS_POOL_MAXSIZE))
+
+# The voice list rarely changes during a job, so name lookups share one fetch per worker
+VOICE_CACHE_TTL_SECONDS = int(os.getenv('ELEVENLABS_VOICE_CACHE_TTL_SECONDS', '300'))
+_voice_cache: Dict[str, Tuple[float, Dict[str, Dict[str, Any]]]] = {}
+_voice_cache_lock = threading.Lock()
+
+# Opt-in R2 cache of generated takes. Off by default: with fixed voice settings every
+# regeneration of a line would otherwise come back as the same audio.
+TTS_CACHE_ENABLED = os.getenv('TTS_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+TTS_CACHE_PREFIX = 'tts-cache/'
+# Continuous settings are rounded to this many decimals so retries land on the same key
+TTS_CACHE_SETTINGS_PRECISION = 2
+
+# Adaptive cap on concurrent TTS requests per worker process (see AdaptiveConcurrencyLimiter)
+ELEVENLABS_MAX_CONCURRENCY = int(os.getenv('ELEVENLABS_MAX_CONCURRENCY', os.getenv('TTS_MAX_WORKERS', '8')))
+# Consecutive successful requests before the limit is raised by one again
+ELEVENLABS_LIMIT_RECOVERY_SUCCESSES = int(os.getenv('ELEVENLABS_LIMIT_RECOVERY_SUCCESSES', '10'))
+# Responses that mean "slow down" rather than "this request is bad"
+THROTTLE_STATUS_CODES = (429, 503)
+# Upper bound on a server-supplied Retry-After wait
+RETRY_AFTER_MAX_SECONDS = 30.0
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit: halves on throttling responses, adds one back after a run of successes.
+
+    Used as a context manager around a request. Permits already held are never revoked;
+    a lowered limit just makes new acquirers wait until enough holders release.
+    """
+
+    def __init__(self, max_limit: int, recovery_successes: int = 10):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.recovery_successes = max(1, recovery_successes)
+        self._in_use = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self._in_use >= self.limit:
+                self._cond.wait()
+            self._in_use += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+        return False
+
+    def on_throttled(self) -> None:
+        with self._cond:
+            new_limit = max(1, self.limit // 2)
+            if new_limit < self.limit:
+                print(f"ElevenLabs throttling: lowering TTS concurrency limit {self.limit} -> {new_limit}")
+            self.limit = new_limit
+            self._successes = 0
+
+    def on_success(self) -> None:
+        with self._cond:
+            if self.limit >= self.max_limit:
+                return
+            self._successes += 1
+            if self._successes >= self.recovery_successes:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify()
+
+tts_limiter = AdaptiveConcurrencyLimiter(ELEVENLABS_MAX_CONCURRENCY, ELEVENLABS_LIMIT_RECOVERY_SUCCESSES)
+
+# Account-wide quotas shared by all workers through Redis; 0 (the default) disables a bucket
+ELEVENLABS_RPM = float(os.getenv('ELEVENLABS_RPM', '0'))
+ELEVENLABS_CPM = float(os.getenv('ELEVENLABS_CPM', '0'))
+_request_bucket = utils_rate_limit.RedisTokenBucket('ratelimit:elevenlabs:requests', ELEVENLABS_RPM) if ELEVENLABS_RPM > 0 else None
+_character_bucket = utils_rate_limit.RedisTokenBucket('ratelimit:elevenlabs:characters', ELEVENLABS_CPM) if ELEVENLABS_CPM > 0 else None
+
+def _acquire_quota(characters: int = 0) -> None:
+    """Waits for one request (and `characters` characters) of the shared per-minute quota."""
+    if _request_bucket:
+        _request_bucket.acquire()
+    if _character_bucket and characters:
+        _character_bucket.acquire(characters)
+
 class ElevenLabsError(Exception):
     """Custom exception for ElevenLabs API errors."""
     pass
@@ -63,7 +157,7 @@ def get_available_voices(
             request_args["params"] = params
             
         print(f"Fetching voices with request_args: {request_args}") # Debugging
-        response = requests.get(url, **request_args)
+        response = _http.get(url, **request_args)
         response.raise_for_status()
         voices_data = response.json()
         # V2 response structure might be different, check API docs if needed
@@ -74,12 +168,31 @@ def get_available_voices(
     except Exception as e:
         raise ElevenLabsError(f"An unexpected error occurred while fetching V2 voices: {e}") from e
 
+def get_voice_map() -> Dict[str, Dict[str, Any]]:
+    """Returns {voice_id: voice} for the unfiltered voice list, cached per API key for VOICE_CACHE_TTL_SECONDS."""
+    # Only the cache key; a missing key is reported by the fetch itself
+    api_key = os.getenv('ELEVENLABS_API_KEY', '')
+    now = time.monotonic()
+    with _voice_cache_lock:
+        cached = _voice_cache.get(api_key)
+        if cached and now - cached[0] < VOICE_CACHE_TTL_SECONDS:
+            return cached[1]
+    voice_map = {v['voice_id']: v for v in get_available_voices() if v.get('voice_id')}
+    with _voice_cache_lock:
+        _voice_cache[api_key] = (now, voice_map)
+    return voice_map
+
+def clear_voice_cache() -> None:
+    """Drops cached voice lists (e.g. after voices are created or deleted)."""
+    with _voice_cache_lock:
+        _voice_cache.clear()
+
 def get_available_models(require_sts: bool = False) -> List[Dict[str, Any]]:
     """Fetches available models, optionally filtering for STS capability."""
     url = f"{ELEVENLABS_API_V1_URL}/models"
     print(f"Fetching models from {url}. Require STS: {require_sts}")
     try:
-        response = requests.get(url, headers=get_headers())
+        response = _http.get(url, headers=get_headers())
         response.raise_for_status()
         all_models = response.json()
         print(f"Received {len(all_models)} models from API.")
@@ -123,10 +236,15 @@ def run_speech_to_speech_conversion(
     target_voice_id: str, 
     model_id: Optional[str], 
     voice_settings: Optional[dict],
-    retries: int = 2, # Fewer retries for STS?
-    delay: int = 5
+    retries: int = 3,
+    delay: float = 1.0
 ) -> bytes:
-    """Performs Speech-to-Speech using the V1 API."""
+    """Performs Speech-to-Speech using the V1 API.
+
+    Throttling, 5xx responses and connection errors are retried with exponential
+    backoff (delay, 2*delay, ...). Other 4xx responses (bad audio, unknown voice,
+    auth) can't succeed on retry and fail immediately.
+    """
     # Default STS model if not provided
     sts_model_id = model_id or "eleven_multilingual_sts_v2" 
     
@@ -139,29 +257,30 @@ def run_speech_to_speech_conversion(
         # STS settings need to be JSON string according to docs
         data['voice_settings'] = json.dumps(voice_settings)
 
-    attempt = 0
-    while attempt < retries:
+    for attempt in range(retries):
+        backoff = delay * 2 ** attempt
         try:
             print(f"Attempt {attempt + 1}/{retries}: Running STS for target voice {target_voice_id}...")
-            response = requests.post(url, headers=headers, data=data, files=files)
+            _acquire_quota()
+            response = _http.post(url, headers=headers, data=data, files=files)
 
             if response.status_code == 200:
                 print(f"Successfully ran STS for target voice {target_voice_id}")
                 return response.content # Return audio bytes
-            elif response.status_code == 429:
-                print(f"Rate limit hit during STS. Retrying in {delay} seconds...")
-                time.sleep(delay)
+            elif response.status_code in THROTTLE_STATUS_CODES or response.status_code >= 500:
+                print(f"STS returned {response.status_code}. Retrying in {backoff} seconds...")
             else:
-                response.raise_for_status() # Raise for other errors
+                raise ElevenLabsError(f"STS failed for target voice {target_voice_id}: {response.status_code} {response.text[:200]}")
 
         except requests.exceptions.RequestException as e:
             print(f"Error during STS (attempt {attempt + 1}): {e}")
-            if attempt == retries - 1:
-                 raise ElevenLabsError(f"Failed STS after {retries} attempts: {e}") from e
+        except ElevenLabsError:
+            raise
         except Exception as e:
              raise ElevenLabsError(f"An unexpected error occurred during STS: {e}") from e
 
-        attempt += 1
+        if attempt < retries - 1:
+            time.sleep(backoff)
 
     raise ElevenLabsError(f"Failed STS for target voice {target_voice_id} after {retries} attempts.")
 
@@ -214,20 +333,10 @@ def generate_tts_audio(
         # Catch any other unexpected errors during the process
         raise ElevenLabsError(f"An unexpected error occurred in generate_tts_audio: {e}") from e
 
-def generate_tts_audio_bytes(
-    text: str,
-    voice_id: str,
-    stability: Optional[float] = None,
-    similarity_boost: Optional[float] = None,
-    style: Optional[float] = None,
-    speed: Optional[float] = None,
-    use_speaker_boost: Optional[bool] = None,
-    model_id: str = "eleven_multilingual_v2",
-    output_format: str = 'mp3_44100_128',
-    retries: int = 3,
-    delay: int = 5
-) -> bytes | None:
-    """Generates TTS audio using V1 API and returns the audio content as bytes."""
+def _tts_request(text: str, voice_id: str, stability: Optional[float], similarity_boost: Optional[float],
+                 style: Optional[float], speed: Optional[float], use_speaker_boost: Optional[bool],
+                 model_id: str, output_format: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+    """Builds the (url, params, payload) for a V1 text-to-speech request."""
     url = f"{ELEVENLABS_API_V1_URL}/text-to-speech/{voice_id}"
     params = {'output_format': output_format}
     payload = {
@@ -242,12 +351,30 @@ def generate_tts_audio_bytes(
     if speed is not None: payload['voice_settings']['speed'] = speed
     if use_speaker_boost is not None: payload['voice_settings']['use_speaker_boost'] = use_speaker_boost
     if not payload['voice_settings']: del payload['voice_settings']
+    return url, params, payload
+
+def generate_tts_audio_bytes(
+    text: str,
+    voice_id: str,
+    stability: Optional[float] = None,
+    similarity_boost: Optional[float] = None,
+    style: Optional[float] = None,
+    speed: Optional[float] = None,
+    use_speaker_boost: Optional[bool] = None,
+    model_id: str = "eleven_multilingual_v2",
+    output_format: str = 'mp3_44100_128',
+    retries: int = 3,
+    delay: int = 5
+) -> bytes | None:
+    """Generates TTS audio using V1 API and returns the audio content as bytes."""
+    url, params, payload = _tts_request(text, voice_id, stability, similarity_boost, style, speed,
+                                        use_speaker_boost, model_id, output_format)
 
     attempt = 0
     while attempt < retries:
         try:
             print(f"Attempt {attempt + 1}/{retries}: Generating TTS bytes for voice {voice_id}...")
-            response = requests.post(url, headers=get_headers(), params=params, json=payload)
+            response = _http.post(url, headers=get_headers(), params=params, json=payload)
 
             if response.status_code == 200:
                 print(f"Successfully generated TTS audio bytes for voice {voice_id}.")
@@ -279,6 +406,133 @@ def generate_tts_audio_bytes(
     print(f"Failed to generate TTS bytes for voice {voice_id} after {retries} attempts.")
     return None
 
+def _retry_after_seconds(response: requests.Response, default: float) -> float:
+    """Wait requested by a Retry-After header (seconds form, capped), else default."""
+    try:
+        return min(float(response.headers.get('Retry-After')), RETRY_AFTER_MAX_SECONDS)
+    except (TypeError, ValueError):
+        return default
+
+def generate_tts_audio_stream(
+    text: str,
+    voice_id: str,
+    stability: Optional[float] = None,
+    similarity_boost: Optional[float] = None,
+    style: Optional[float] = None,
+    speed: Optional[float] = None,
+    use_speaker_boost: Optional[bool] = None,
+    model_id: str = "eleven_multilingual_v2",
+    output_format: str = 'mp3_44100_128',
+    retries: int = 3,
+    delay: float = 2.0
+) -> requests.Response | None:
+    """Starts a streamed TTS request and returns the open response once it reports 200.
+
+    The body is not read here: pass response.raw to a consumer (e.g. utils_r2.upload_stream)
+    and close the response afterwards. Retries cover the request/status only: throttling,
+    5xx responses and connection errors back off exponentially (delay, 2*delay, ...; a
+    Retry-After header wins), other 4xx raise ElevenLabsError at once. Returns None if every
+    attempt failed.
+    """
+    url, params, payload = _tts_request(text, voice_id, stability, similarity_boost, style, speed,
+                                        use_speaker_boost, model_id, output_format)
+
+    for attempt in range(retries):
+        backoff = delay * 2 ** attempt
+        try:
+            print(f"Attempt {attempt + 1}/{retries}: Streaming TTS for voice {voice_id}...")
+            _acquire_quota(len(text))
+            response = _http.post(url, headers=get_headers(), params=params, json=payload, stream=True)
+
+            if response.status_code == 200:
+                tts_limiter.on_success()
+                # Hand back decoded bytes if the transport applied any content-encoding
+                response.raw.decode_content = True
+                return response
+            if response.status_code not in THROTTLE_STATUS_CODES and response.status_code < 500:
+                detail = response.text[:200]
+                response.close()
+                raise ElevenLabsError(f"TTS failed for voice {voice_id}: {response.status_code} {detail}")
+            response.close()
+            if response.status_code in THROTTLE_STATUS_CODES:
+                tts_limiter.on_throttled()
+                backoff = _retry_after_seconds(response, backoff)
+                print(f"Rate limit hit ({response.status_code}). Retrying in {backoff} seconds...")
+            else:
+                print(f"TTS returned {response.status_code}. Retrying in {backoff} seconds...")
+        except requests.exceptions.RequestException as e:
+            print(f"Error streaming TTS (attempt {attempt + 1}): {e}")
+
+        if attempt < retries - 1:
+            time.sleep(backoff)
+
+    print(f"Failed to stream TTS for voice {voice_id} after {retries} attempts.")
+    return None
+
+def tts_cache_key(text: str, voice_id: str, model_id: str, output_format: str,
+                  voice_settings: Dict[str, Any], variant: Optional[Any] = None) -> str:
+    """Returns the content-addressed R2 key for a TTS request (variant separates takes of one line)."""
+    params = {
+        'text': text,
+        'voice_id': voice_id,
+        'model_id': model_id,
+        'output_format': output_format,
+        'voice_settings': voice_settings,
+        'variant': variant,
+    }
+    digest = hashlib.blake2b(json.dumps(params, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+    return f"{TTS_CACHE_PREFIX}{digest}.mp3"
+
+def generate_tts_to_r2(
+    r2_blob_key: str,
+    text: str,
+    voice_id: str,
+    voice_settings: Dict[str, Any],
+    model_id: str = DEFAULT_MODEL,
+    output_format: str = 'mp3_44100_128',
+    variant: Optional[Any] = None,
+    use_cache: bool = True
+) -> Tuple[Dict[str, Any], bool]:
+    """Generates a take and stores it at r2_blob_key, reusing a cached render when TTS_CACHE_ENABLED.
+
+    On a cache hit the audio is copied server-side in R2; on a miss it is streamed from
+    ElevenLabs into R2, then copied into the cache. Returns (voice_settings_used, cache_hit) and
+    raises on generation or upload failure.
+    """
+    cache_key = None
+    if TTS_CACHE_ENABLED and use_cache:
+        voice_settings = {
+            k: round(v, TTS_CACHE_SETTINGS_PRECISION) if isinstance(v, float) else v
+            for k, v in voice_settings.items()
+        }
+        cache_key = tts_cache_key(text, voice_id, model_id, output_format, voice_settings, variant)
+        if utils_r2.copy_blob(cache_key, r2_blob_key):
+            print(f"TTS cache hit for {r2_blob_key} ({cache_key}).")
+            return voice_settings, True
+
+    # Pipe the response body straight into R2 so the take is never held in memory whole.
+    # The limiter covers the whole stream: ElevenLabs counts the request until the body is read.
+    with tts_limiter:
+        response = generate_tts_audio_stream(
+            text=text,
+            voice_id=voice_id,
+            model_id=model_id,
+            output_format=output_format,
+            **voice_settings
+        )
+        if response is None:
+            raise ElevenLabsError("Generation returned no audio stream.")
+        try:
+            uploaded = utils_r2.upload_stream(blob_name=r2_blob_key, fileobj=response.raw, content_type='audio/mpeg')
+        finally:
+            response.close()
+    if not uploaded:
+        raise Exception(f"Failed to upload {r2_blob_key} to R2.")
+
+    if cache_key and not utils_r2.copy_blob(r2_blob_key, cache_key):
+        print(f"Warning: Could not populate TTS cache entry {cache_key} from {r2_blob_key}.")
+    return voice_settings, False
+
 # --- NEW: Voice Design Functions (V1 API) --- #
 
 def create_voice_previews(
@@ -341,7 +595,7 @@ def create_voice_previews(
     while attempt < retries:
         try:
             print(f"Attempt {attempt + 1}/{retries}: Creating voice previews...")
-            response = requests.post(url, headers=get_headers(), params=params, json=payload)
+            response = _http.post(url, headers=get_headers(), params=params, json=payload)
 
             if response.status_code == 200:
                 print("Successfully created voice previews.")
@@ -420,10 +674,11 @@ def save_generated_voice(
         # --- Add Logging --- 
         print(f"[DEBUG] Sending payload to ElevenLabs /create-voice-from-preview: {json.dumps(payload)}")
         # --- End Logging --- 
-        response = requests.post(url, headers=get_headers(), json=payload)
+        response = _http.post(url, headers=get_headers(), json=payload)
 
         if response.status_code == 200:
             print(f"Successfully saved voice '{voice_name}'.")
+            clear_voice_cache()
             return response.json()
         elif response.status_code == 422:
             print(f"Validation Error (422) saving voice: {response.text}")
@@ -492,7 +747,7 @@ def generate_preview_audio_stream(
 
     try:
         print(f"Requesting preview audio stream for voice {voice_id}...")
-        response = requests.post(url, headers=headers, params=params, json=payload, stream=True)
+        response = _http.post(url, headers=headers, params=params, json=payload, stream=True)
         response.raise_for_status() # Raise for non-2xx status codes
         print(f"Successfully initiated preview stream for voice {voice_id}.")
         return response # Return the raw response object
@@ -0,0 +1,51 @@
+"""
+Redis cache of parsed batch metadata.json blobs, keyed by R2 ETag.
+
+Regeneration tasks for the same batch tend to run back to back, and each one
+used to pull the full metadata.json from R2. Entries are keyed by the object's
+ETag, so a rewritten metadata.json is simply a cache miss; old versions age out
+via the TTL rather than needing explicit invalidation.
+"""
+import logging
+import os
+import redis
+from backend import utils_r2, utils_redis
+
+logger = logging.getLogger(__name__)
+
+METADATA_CACHE_TTL_SECONDS = int(os.getenv('METADATA_CACHE_TTL_SECONDS', '3600'))
+
+def _cache_key(batch_id: str, etag: str) -> str:
+    etag = etag.strip('"') # S3 returns ETags wrapped in quotes
+    return f"batch-meta:{batch_id}:{etag}"
+
+def load_batch_metadata(batch_id: str) -> dict | None:
+    """Returns the parsed metadata.json for a batch, or None if it doesn't exist.
+
+    Costs a HEAD plus a Redis GET on a warm cache instead of a full R2 download.
+    Raises ValueError if the blob in R2 can't be decoded.
+    """
+    metadata_blob_key = f"{batch_id}/metadata.json"
+    client = utils_redis.get_redis_client()
+
+    etag = utils_r2.get_blob_etag(metadata_blob_key) if client else None
+    if etag:
+        try:
+            cached = client.get(_cache_key(batch_id, etag))
+            if cached:
+                return utils_r2.loads_json_blob(cached)
+        except (redis.RedisError, ValueError) as e:
+            logger.warning(f"Metadata cache read failed for {batch_id}: {e}")
+
+    metadata_bytes, etag = utils_r2.download_blob_with_etag(metadata_blob_key)
+    if not metadata_bytes:
+        return None
+    metadata = utils_r2.loads_json_blob(metadata_bytes)
+
+    # Cache under the ETag of the version actually read, not the one from the HEAD
+    if client and etag:
+        try:
+            client.set(_cache_key(batch_id, etag), metadata_bytes, ex=METADATA_CACHE_TTL_SECONDS)
+        except redis.RedisError as e:
+            logger.warning(f"Metadata cache write failed for {batch_id}: {e}")
+    return metadata
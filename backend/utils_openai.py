@@ -28,6 +28,12 @@ RETRYABLE_EXCEPTIONS = (
     lambda e: isinstance(e, openai.APIStatusError) and e.status_code >= 500 
 )
 
+def is_retryable_error(exc: BaseException) -> bool:
+    """True for transient OpenAI failures: timeouts, connection errors, 429s and 5xx responses."""
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10), # Wait 2s, 4s, ... up to 10s between retries
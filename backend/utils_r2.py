@@ -1,8 +1,18 @@
+import io
 import os
 import boto3
 import botocore # Import botocore for Config
 from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
 import logging
+import random
+import threading
+import time
+import orjson
+try:
+    import zstandard
+except ImportError: # Optional: without it JSON blobs are written uncompressed
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
@@ -12,38 +22,88 @@ R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
 R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
 R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME") # Assuming one bucket for now, adjust if needed
 
+# Shared client: boto3 clients are thread-safe, and reusing one keeps its
+# urllib3 connection pool (and TLS sessions) alive across calls.
+# Defaults to at least one connection per TTS worker thread so concurrent take uploads never queue.
+R2_MAX_POOL_CONNECTIONS = int(os.getenv("R2_MAX_POOL_CONNECTIONS", max(32, int(os.getenv("TTS_MAX_WORKERS", 8)))))
+# Streamed uploads already run on a caller's worker thread (e.g. the TTS take pool); don't let
+# boto3 spin up its own transfer thread pool for every object on top of that.
+STREAM_TRANSFER_CONFIG = TransferConfig(use_threads=False)
+# Single large objects uploaded on their own (e.g. cropped audio) can send 8 MB parts in parallel
+PARALLEL_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                          use_threads=True, max_concurrency=4)
+# S3 DeleteObjects accepts at most 1000 keys per request
+R2_DELETE_BATCH_SIZE = 1000
+# Read-modify-write of shared JSON blobs (batch metadata.json): conditional PUT attempts
+# before giving up, and the base for the jittered backoff between them
+CONDITIONAL_PUT_MAX_ATTEMPTS = 5
+CONDITIONAL_PUT_BACKOFF_SECONDS = 0.05
+# JSON blobs (batch metadata, line shards) are zstd-compressed at rest when zstandard is
+# installed. Readers detect the frame magic, so uncompressed (legacy) blobs still load.
+JSON_BLOB_ZSTD_LEVEL = int(os.getenv("JSON_BLOB_ZSTD_LEVEL", "3")) # 0 disables compression on write
+ZSTD_FRAME_MAGIC = b'\x28\xb5\x2f\xfd'
+_r2_client = None
+_r2_client_lock = threading.Lock()
+
 def get_r2_client():
-    """Creates and returns a boto3 S3 client configured for Cloudflare R2."""
+    """Returns the shared boto3 S3 client configured for Cloudflare R2, creating it on first use."""
+    global _r2_client
+    if _r2_client is not None:
+        return _r2_client
+
     if not all([R2_ENDPOINT_URL, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY]):
         logger.error("R2 client config missing.")
         return None
 
-    try:
-        session = boto3.session.Session()
-        s3_client = session.client(
-            service_name='s3',
-            endpoint_url=R2_ENDPOINT_URL,
-            aws_access_key_id=R2_ACCESS_KEY_ID,
-            aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-            region_name='auto',  # Explicitly set region for R2
-            config=botocore.client.Config(signature_version='s3v4') # Explicitly set signature version
-        )
-        # Optional: Test connection by listing buckets (requires ListBuckets permission)
-        # s3_client.list_buckets()
-        logger.info("Successfully created R2 S3 client with region='auto' and signature_version='s3v4'.")
-        return s3_client
-    except ClientError as e:
-        logger.error(f"Failed to create R2 S3 client: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"An unexpected error occurred creating R2 S3 client: {e}")
-        return None
+    with _r2_client_lock:
+        if _r2_client is not None:
+            return _r2_client
+        try:
+            session = boto3.session.Session()
+            s3_client = session.client(
+                service_name='s3',
+                endpoint_url=R2_ENDPOINT_URL,
+                aws_access_key_id=R2_ACCESS_KEY_ID,
+                aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+                region_name='auto',  # Explicitly set region for R2
+                config=botocore.client.Config(
+                    signature_version='s3v4', # Explicitly set signature version
+                    max_pool_connections=R2_MAX_POOL_CONNECTIONS,
+                    retries={'mode': 'adaptive', 'max_attempts': 5},
+                    tcp_keepalive=True
+                )
+            )
+            # Optional: Test connection by listing buckets (requires ListBuckets permission)
+            # s3_client.list_buckets()
+            logger.info("Successfully created R2 S3 client with region='auto' and signature_version='s3v4'.")
+            _r2_client = s3_client
+            return s3_client
+        except ClientError as e:
+            logger.error(f"Failed to create R2 S3 client: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"An unexpected error occurred creating R2 S3 client: {e}")
+            return None
+
+def _reset_client_after_fork():
+    """Drops a client inherited across fork (e.g. Celery prefork, gunicorn --preload).
+
+    Its pooled sockets belong to the parent process; the child lazily builds its own.
+    """
+    global _r2_client, _r2_client_lock
+    _r2_client = None
+    _r2_client_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_client_after_fork)
 
 # --- Placeholder functions to be implemented ---
 
 def upload_blob(blob_name: str, data: bytes, content_type: str = 'application/octet-stream') -> bool:
     """Uploads data (bytes) to a blob in the configured R2 bucket.
 
+    Payloads at or above PARALLEL_TRANSFER_CONFIG's multipart threshold go through
+    upload_stream so their parts upload concurrently; smaller ones are a single PUT.
+
     Args:
         blob_name: The full path (key) for the object in the bucket.
         data: The data to upload as bytes.
@@ -57,6 +117,10 @@ def upload_blob(blob_name: str, data: bytes, content_type: str = 'application/oc
         logger.error("Cannot upload blob: R2 client or bucket name not configured.")
         return False
 
+    if len(data) >= PARALLEL_TRANSFER_CONFIG.multipart_threshold:
+        return upload_stream(blob_name, io.BytesIO(data), content_type=content_type,
+                             transfer_config=PARALLEL_TRANSFER_CONFIG)
+
     try:
         s3_client.put_object(
             Bucket=R2_BUCKET_NAME,
@@ -75,6 +139,41 @@ def upload_blob(blob_name: str, data: bytes, content_type: str = 'application/oc
         logger.error(f"An unexpected error occurred during upload of {blob_name}: {e}")
         return False
 
+def upload_stream(blob_name: str, fileobj, content_type: str = 'application/octet-stream',
+                  transfer_config: TransferConfig = STREAM_TRANSFER_CONFIG) -> bool:
+    """Uploads a readable file-like object to R2 without buffering it whole.
+
+    Uses boto3's managed transfer (upload_fileobj), which reads the stream in parts
+    and switches to multipart upload for large objects. By default parts are sent
+    from the calling thread and callers parallelize across objects instead; pass
+    PARALLEL_TRANSFER_CONFIG to upload one large object's parts concurrently.
+
+    Args:
+        blob_name: The full path (key) for the object in the bucket.
+        fileobj: A binary file-like object with a read() method (e.g. an HTTP response's raw stream).
+        content_type: The MIME type of the content.
+        transfer_config: boto3 TransferConfig for the managed upload.
+
+    Returns:
+        True if upload was successful, False otherwise.
+    """
+    s3_client = get_r2_client()
+    if not s3_client or not R2_BUCKET_NAME:
+        logger.error("Cannot upload stream: R2 client or bucket name not configured.")
+        return False
+
+    try:
+        s3_client.upload_fileobj(fileobj, R2_BUCKET_NAME, blob_name, ExtraArgs={'ContentType': content_type},
+                                 Config=transfer_config)
+        logger.info(f"Successfully streamed {blob_name} to R2 bucket {R2_BUCKET_NAME}.")
+        return True
+    except ClientError as e:
+        logger.error(f"Failed to stream {blob_name} to R2 bucket {R2_BUCKET_NAME}: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"An unexpected error occurred during streamed upload of {blob_name}: {e}")
+        return False
+
 def download_blob_to_memory(blob_name: str) -> bytes | None:
     """Downloads a blob's content from the R2 bucket into memory.
 
@@ -106,6 +205,142 @@ def download_blob_to_memory(blob_name: str) -> bytes | None:
         logger.error(f"An unexpected error occurred during download of {blob_name}: {e}")
         return None
 
+def download_blob_with_etag(blob_name: str) -> tuple[bytes | None, str | None]:
+    """Downloads a blob into memory along with the ETag of the version that was read.
+
+    Returns:
+        (content, etag) if successful, (None, None) otherwise.
+    """
+    s3_client = get_r2_client()
+    if not s3_client or not R2_BUCKET_NAME:
+        logger.error("Cannot download blob: R2 client or bucket name not configured.")
+        return None, None
+
+    try:
+        response = s3_client.get_object(Bucket=R2_BUCKET_NAME, Key=blob_name)
+        return response['Body'].read(), response.get('ETag')
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            logger.warning(f"Blob not found in R2 bucket {R2_BUCKET_NAME}: {blob_name}")
+        else:
+            logger.error(f"Failed to download {blob_name} from R2 bucket {R2_BUCKET_NAME}: {e}")
+        return None, None
+    except Exception as e:
+        logger.error(f"An unexpected error occurred during download of {blob_name}: {e}")
+        return None, None
+
+def dumps_json_blob(doc) -> tuple[bytes, str]:
+    """Serializes a JSON document for storage in R2.
+
+    Returns:
+        (data, content_type): zstd-compressed JSON when enabled, plain compact JSON otherwise.
+    """
+    data = orjson.dumps(doc)
+    if zstandard is None or JSON_BLOB_ZSTD_LEVEL <= 0:
+        return data, 'application/json'
+    return zstandard.ZstdCompressor(level=JSON_BLOB_ZSTD_LEVEL).compress(data), 'application/zstd'
+
+def loads_json_blob(data: bytes):
+    """Parses a JSON blob read from R2, decompressing it first if it is a zstd frame.
+
+    Raises ValueError (including orjson.JSONDecodeError) if the blob can't be decoded.
+    """
+    if data[:4] == ZSTD_FRAME_MAGIC:
+        if zstandard is None:
+            raise ValueError("Blob is zstd-compressed but the zstandard package is not installed.")
+        try:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Failed to decompress zstd blob: {e}") from e
+    return orjson.loads(data)
+
+def upload_json_blob(blob_name: str, doc) -> bool:
+    """Serializes a JSON document with dumps_json_blob and uploads it. Returns True on success."""
+    data, content_type = dumps_json_blob(doc)
+    return upload_blob(blob_name=blob_name, data=data, content_type=content_type)
+
+def update_json_blob(blob_name: str, mutate, max_attempts: int = CONDITIONAL_PUT_MAX_ATTEMPTS) -> dict | None:
+    """Read-modify-write of a JSON blob without losing concurrent updates.
+
+    Each attempt downloads the blob with its ETag, calls ``mutate(doc)`` to edit the parsed
+    document in place, and writes it back with a conditional PUT (If-Match on that ETag).
+    If another writer replaced the blob in between, R2 rejects the PUT and the cycle repeats
+    on the fresh copy, so ``mutate`` must be safe to call more than once.
+
+    Args:
+        blob_name: The full path (key) for the object in the bucket.
+        mutate: Callable taking the parsed document; return a falsy value to skip the write.
+        max_attempts: Conditional PUT attempts before giving up.
+
+    Returns:
+        The document as written, or None if the blob is missing or unparseable, mutate
+        declined, or every attempt failed.
+    """
+    s3_client = get_r2_client()
+    if not s3_client or not R2_BUCKET_NAME:
+        logger.error("Cannot update blob: R2 client or bucket name not configured.")
+        return None
+
+    for attempt in range(max_attempts):
+        data, etag = download_blob_with_etag(blob_name)
+        if not data or not etag:
+            return None
+        try:
+            doc = loads_json_blob(data)
+        except ValueError as e:
+            logger.error(f"Failed to parse {blob_name} for update: {e}")
+            return None
+        if not mutate(doc):
+            return None
+
+        body, content_type = dumps_json_blob(doc)
+        try:
+            s3_client.put_object(Bucket=R2_BUCKET_NAME, Key=blob_name, Body=body,
+                                 ContentType=content_type, IfMatch=etag)
+            logger.info(f"Successfully updated {blob_name} in R2 bucket {R2_BUCKET_NAME}.")
+            return doc
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code')
+            response_status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if error_code not in ('PreconditionFailed', 'ConditionalRequestConflict') and response_status not in (409, 412):
+                logger.error(f"Failed to upload {blob_name} to R2 bucket {R2_BUCKET_NAME}: {e}")
+                return None
+            logger.info(f"{blob_name} changed since it was read (attempt {attempt + 1}/{max_attempts}); retrying.")
+            time.sleep(random.uniform(0, CONDITIONAL_PUT_BACKOFF_SECONDS * 2 ** attempt))
+        except Exception as e:
+            logger.error(f"An unexpected error occurred during update of {blob_name}: {e}")
+            return None
+
+    logger.error(f"Gave up updating {blob_name} after {max_attempts} conflicting writes.")
+    return None
+
+def open_blob_stream(blob_name: str):
+    """Opens a blob for streaming reads without buffering it in memory.
+
+    Args:
+        blob_name: The full path (key) for the object in the bucket.
+
+    Returns:
+        The botocore StreamingBody (caller must close it) if successful, None otherwise.
+    """
+    s3_client = get_r2_client()
+    if not s3_client or not R2_BUCKET_NAME:
+        logger.error("Cannot open blob stream: R2 client or bucket name not configured.")
+        return None
+
+    try:
+        response = s3_client.get_object(Bucket=R2_BUCKET_NAME, Key=blob_name)
+        return response['Body']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            logger.warning(f"Blob not found in R2 bucket {R2_BUCKET_NAME}: {blob_name}")
+        else:
+            logger.error(f"Failed to open {blob_name} from R2 bucket {R2_BUCKET_NAME}: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"An unexpected error occurred opening stream for {blob_name}: {e}")
+        return None
+
 def list_blobs_in_prefix(prefix: str) -> list[dict]:
     """Lists blobs in the R2 bucket matching the given prefix.
 
@@ -191,6 +426,62 @@ def blob_exists(blob_name: str) -> bool:
         logger.error(f"An unexpected error occurred checking existence for {blob_name}: {e}")
         return False
 
+def get_blob_etag(blob_name: str) -> str | None:
+    """Returns the blob's current ETag via head_object, or None if it doesn't exist or the HEAD fails."""
+    s3_client = get_r2_client()
+    if not s3_client or not R2_BUCKET_NAME:
+        logger.error("Cannot read blob ETag: R2 client or bucket name not configured.")
+        return None
+
+    try:
+        return s3_client.head_object(Bucket=R2_BUCKET_NAME, Key=blob_name).get('ETag')
+    except ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        response_status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if error_code == 'NoSuchKey' or response_status == 404:
+            logger.debug(f"Blob does not exist: {blob_name} in R2 bucket {R2_BUCKET_NAME}.")
+        else:
+            logger.error(f"Error reading ETag for {blob_name} in R2 bucket {R2_BUCKET_NAME}: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"An unexpected error occurred reading ETag for {blob_name}: {e}")
+        return None
+
+def copy_blob(source_blob_name: str, dest_blob_name: str) -> bool:
+    """Copies a blob server-side within the R2 bucket (no data passes through the caller).
+
+    Args:
+        source_blob_name: The key of the existing object.
+        dest_blob_name: The key to copy it to.
+
+    Returns:
+        True if the copy succeeded, False if the source is missing or on error.
+    """
+    s3_client = get_r2_client()
+    if not s3_client or not R2_BUCKET_NAME:
+        logger.error("Cannot copy blob: R2 client or bucket name not configured.")
+        return False
+
+    try:
+        s3_client.copy_object(
+            Bucket=R2_BUCKET_NAME,
+            Key=dest_blob_name,
+            CopySource={'Bucket': R2_BUCKET_NAME, 'Key': source_blob_name}
+        )
+        logger.debug(f"Copied {source_blob_name} to {dest_blob_name} in R2 bucket {R2_BUCKET_NAME}.")
+        return True
+    except ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        response_status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if error_code == 'NoSuchKey' or response_status == 404:
+            logger.debug(f"Copy source does not exist: {source_blob_name} in R2 bucket {R2_BUCKET_NAME}.")
+        else:
+            logger.error(f"Failed to copy {source_blob_name} to {dest_blob_name} in R2 bucket {R2_BUCKET_NAME}: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"An unexpected error occurred copying {source_blob_name} to {dest_blob_name}: {e}")
+        return False
+
 def delete_blob(blob_name: str) -> bool:
     """Deletes a blob from the R2 bucket.
 
@@ -219,6 +510,100 @@ def delete_blob(blob_name: str) -> bool:
         logger.error(f"An unexpected error occurred during deletion of {blob_name}: {e}")
         return False
 
+def _delete_objects(s3_client, keys: list[str]) -> list[str]:
+    """Issues one DeleteObjects request (max 1000 keys) and returns the keys that were deleted."""
+    response = s3_client.delete_objects(
+        Bucket=R2_BUCKET_NAME,
+        Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True}
+    )
+    # Quiet mode only reports failures, everything else was deleted
+    failed = {err['Key'] for err in response.get('Errors', [])}
+    for err in response.get('Errors', []):
+        logger.error(f"Failed to delete {err.get('Key')} from R2 bucket {R2_BUCKET_NAME}: {err.get('Code')} {err.get('Message')}")
+    return [k for k in keys if k not in failed]
+
+def delete_blobs_bulk(keys: list[str]) -> list[str]:
+    """Deletes a list of blobs using batched DeleteObjects calls (1000 keys per request).
+
+    Args:
+        keys: The object keys to remove.
+
+    Returns:
+        A list of the keys that were successfully deleted. Returns an
+        empty list if nothing was passed or on error.
+    """
+    if not keys:
+        return []
+    s3_client = get_r2_client()
+    if not s3_client or not R2_BUCKET_NAME:
+        logger.error("Cannot delete blobs: R2 client or bucket name not configured.")
+        return []
+
+    deleted_keys = []
+    try:
+        for start in range(0, len(keys), R2_DELETE_BATCH_SIZE):
+            deleted_keys.extend(_delete_objects(s3_client, keys[start:start + R2_DELETE_BATCH_SIZE]))
+        logger.info(f"Deleted {len(deleted_keys)}/{len(keys)} blobs from R2 bucket {R2_BUCKET_NAME}.")
+        return deleted_keys
+    except ClientError as e:
+        logger.error(f"Failed to bulk delete blobs from R2 bucket {R2_BUCKET_NAME}: {e}")
+        return deleted_keys
+    except Exception as e:
+        logger.error(f"An unexpected error occurred during bulk blob deletion: {e}")
+        return deleted_keys
+
+def delete_blobs_if_unchanged(key_etags: dict[str, str | None]) -> list[str]:
+    """Deletes blobs whose current ETag still matches the one given for them.
+
+    Blobs rewritten since their ETag was read (or with no recorded ETag) are left
+    in place. Each key costs a HEAD; the matching ones go out in one bulk delete.
+
+    Returns:
+        A list of the keys that were deleted.
+    """
+    unchanged = [key for key, etag in key_etags.items() if etag and get_blob_etag(key) == etag]
+    skipped = len(key_etags) - len(unchanged)
+    if skipped:
+        logger.info(f"Kept {skipped} blobs that changed since they were read.")
+    return delete_blobs_bulk(unchanged)
+
+def delete_prefix(prefix: str) -> list[str]:
+    """Deletes every blob under a prefix using batched DeleteObjects calls.
+
+    Keys are streamed page by page from list_objects_v2 (max 1000 per page)
+    straight into a delete_objects request, so N blobs cost ceil(N/1000)
+    round trips instead of N.
+
+    Args:
+        prefix: The key prefix whose objects should be removed.
+
+    Returns:
+        A list of the keys that were successfully deleted. Returns an
+        empty list if nothing matched or on error.
+    """
+    s3_client = get_r2_client()
+    if not s3_client or not R2_BUCKET_NAME:
+        logger.error("Cannot delete prefix: R2 client or bucket name not configured.")
+        return []
+
+    deleted_keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    try:
+        for page in paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix=prefix):
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            if not keys:
+                continue
+            deleted_keys.extend(_delete_objects(s3_client, keys))
+
+        logger.info(f"Deleted {len(deleted_keys)} blobs with prefix '{prefix}' from R2 bucket {R2_BUCKET_NAME}.")
+        return deleted_keys
+    except ClientError as e:
+        logger.error(f"Failed to delete blobs with prefix '{prefix}' from R2 bucket {R2_BUCKET_NAME}: {e}")
+        return deleted_keys
+    except Exception as e:
+        logger.error(f"An unexpected error occurred deleting prefix '{prefix}': {e}")
+        return deleted_keys
+
 def generate_presigned_url(blob_name: str, expiration: int = 3600) -> str | None:
     """Generates a presigned URL for temporary GET access to a blob.
 
@@ -249,4 +634,69 @@ def generate_presigned_url(blob_name: str, expiration: int = 3600) -> str | None
         return None
     except Exception as e:
         logger.error(f"An unexpected error occurred generating presigned URL for {blob_name}: {e}")
-        return None 
\ No newline at end of file
+        return None 
+# --- Per-line batch metadata shards ---
+# A batch's metadata.json holds every take in the batch, so rewriting it for a
+# single line costs O(takes in batch). Line-level writers instead store that
+# line's takes under {batch_prefix}/lines/{line_key}.json. A shard, when present,
+# supersedes the takes for its line in metadata.json until it is folded back in
+# by whoever next rewrites the full file (see tasks.compact_batch_metadata).
+
+def line_meta_blob_key(batch_prefix: str, line_key: str) -> str:
+    """Returns the R2 key of the per-line metadata shard for a batch line."""
+    return f"{batch_prefix}/lines/{line_key}.json"
+
+def load_line_meta(batch_prefix: str, line_key: str) -> dict | None:
+    """Loads a line's metadata shard ({'line': ..., 'takes': [...]}), or None if there isn't one."""
+    data = download_blob_to_memory(line_meta_blob_key(batch_prefix, line_key))
+    if not data:
+        return None
+    try:
+        return loads_json_blob(data)
+    except ValueError as e:
+        logger.error(f"Failed to parse line metadata shard for '{line_key}' in {batch_prefix}: {e}")
+        return None
+
+def save_line_meta(batch_prefix: str, line_key: str, line_meta: dict) -> bool:
+    """Writes a line's metadata shard. Returns True on success."""
+    return upload_json_blob(line_meta_blob_key(batch_prefix, line_key), line_meta)
+
+def merge_line_meta_shards(batch_prefix: str, metadata: dict) -> dict[str, str | None]:
+    """Overlays any per-line shards onto a batch's metadata dict in place.
+
+    Each shard's takes replace that line's takes in metadata['takes'], and the
+    most recent 'last_regenerated_line' annotation wins.
+
+    Returns:
+        {shard_key: etag} for the shard versions that were merged (empty if there
+        were none). Pass it to delete_blobs_if_unchanged once the merged metadata
+        is saved, so a shard rewritten in the meantime survives.
+    """
+    shard_blobs = list_blobs_in_prefix(f"{batch_prefix}/lines/")
+    if not shard_blobs:
+        return {}
+
+    merged_keys = {}
+    shard_takes = {}
+    for blob in shard_blobs:
+        data, etag = download_blob_with_etag(blob['Key'])
+        if not data:
+            continue
+        try:
+            line_meta = loads_json_blob(data)
+        except ValueError as e:
+            logger.error(f"Skipping unparseable line metadata shard {blob['Key']}: {e}")
+            continue
+        shard_takes[line_meta.get('line')] = line_meta.get('takes', [])
+        last_regen = line_meta.get('last_regenerated_line')
+        current = metadata.get('last_regenerated_line') or {}
+        if last_regen and last_regen.get('at', '') > current.get('at', ''):
+            metadata['last_regenerated_line'] = last_regen
+        merged_keys[blob['Key']] = etag
+
+    if shard_takes:
+        takes = [t for t in metadata.get('takes', []) if t.get('line') not in shard_takes]
+        for line_takes in shard_takes.values():
+            takes.extend(line_takes)
+        metadata['takes'] = takes
+    return merged_keys
@@ -0,0 +1,73 @@
+"""
+Redis-backed token buckets shared by every worker process.
+
+The per-process AIMD limiter in utils_elevenlabs only reacts once ElevenLabs has
+already started throttling, and each process adapts on its own. A bucket kept in
+the broker's Redis lets all running tasks draw from one per-minute budget
+(requests, characters), so the fleet as a whole stays under the account quota.
+"""
+import logging
+import time
+import redis
+from backend import utils_redis
+
+logger = logging.getLogger(__name__)
+
+# Refill by elapsed time, then either take `cost` tokens or report how long to wait.
+# Uses the Redis clock so workers on different hosts agree on elapsed time.
+_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_per_second = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * refill_per_second)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / refill_per_second
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_per_second) + 1)
+return tostring(wait)
+"""
+
+class RedisTokenBucket:
+    """Token bucket holding up to `rate` tokens, refilled at `rate` per `per` seconds.
+
+    State lives in a Redis hash under `key` and is updated atomically by a Lua
+    script. If Redis is unavailable the bucket fails open (logs and lets the
+    caller through) so generation isn't blocked by a cache outage.
+    """
+
+    def __init__(self, key: str, rate: float, per: float = 60.0):
+        self.key = key
+        self.capacity = float(rate)
+        self.refill_per_second = float(rate) / per
+        self._script = None
+
+    def _take(self, cost: float) -> float:
+        """Takes `cost` tokens if available. Returns 0, or the seconds to wait before retrying."""
+        client = utils_redis.get_redis_client()
+        if client is None:
+            return 0.0
+        if self._script is None:
+            self._script = client.register_script(_TAKE_SCRIPT)
+        try:
+            return float(self._script(keys=[self.key], args=[self.capacity, self.refill_per_second, cost]))
+        except redis.RedisError as e:
+            logger.warning(f"Rate limit bucket {self.key} unavailable, not throttling: {e}")
+            return 0.0
+
+    def acquire(self, cost: float = 1.0) -> None:
+        """Blocks until `cost` tokens have been taken (costs above capacity are clamped)."""
+        cost = min(float(cost), self.capacity)
+        while True:
+            wait = self._take(cost)
+            if wait <= 0:
+                return
+            time.sleep(wait)
@@ -0,0 +1,34 @@
+"""
+Shared Redis connection for small pieces of task-side state (checkpoints, caches).
+
+Reuses the broker URL and TLS options already resolved in celery_app so workers
+talk to the same Redis instance without extra configuration.
+"""
+import logging
+import threading
+import redis
+from backend.celery_app import broker_url, ssl_opts
+
+logger = logging.getLogger(__name__)
+
+_redis_client = None
+_redis_client_lock = threading.Lock()
+
+def get_redis_client() -> redis.Redis | None:
+    """Returns a shared Redis client for the Celery broker instance, or None if it can't be created."""
+    global _redis_client
+    if _redis_client is not None:
+        return _redis_client
+
+    with _redis_client_lock:
+        if _redis_client is not None:
+            return _redis_client
+        try:
+            kwargs = {}
+            if ssl_opts:
+                kwargs['ssl_cert_reqs'] = ssl_opts['ssl_cert_reqs']
+            _redis_client = redis.Redis.from_url(broker_url, **kwargs)
+            return _redis_client
+        except Exception as e:
+            logger.error(f"Failed to create Redis client for {broker_url}: {e}")
+            return None